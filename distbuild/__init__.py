@@ -50,12 +50,13 @@ from worker_build_scheduler import (WorkerBuildQueuer,
                                     WorkerBuildFinished,
                                     WorkerBuildFailed,
                                     WorkerBuildStepStarted)
+from build_graph import BuildGraph, map_build_graph
 from build_controller import (BuildController, BuildFailed, BuildProgress,
                               BuildSteps, BuildStepStarted,
                               BuildStepAlreadyStarted, BuildOutput,
                               BuildStepFinished, BuildStepFailed,
                               BuildFinished, BuildCancel,
-                              build_step_name, map_build_graph)
+                              build_step_name)
 from initiator import Initiator
 from protocol import message
 
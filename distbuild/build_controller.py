@@ -24,13 +24,8 @@ import urlparse
 import json
 
 import distbuild
-
-
-# Artifact build states
-UNKNOWN = 'unknown'
-UNBUILT = 'not-built'
-BUILDING = 'building'
-BUILT = 'built'
+from build_graph import (UNKNOWN, UNBUILT, BUILDING, BUILT, BuildGraph,
+                         map_build_graph)
 
 
 class _Start(object): pass
@@ -134,19 +129,6 @@ def build_step_name(artifact):
     return artifact.name
 
 
-def map_build_graph(artifact, callback):
-    result = []
-    done = set()
-    queue = [artifact]
-    while queue:
-        a = queue.pop()
-        if a not in done:
-            result.append(callback(a))
-            queue.extend(a.source.dependencies)
-            done.add(a)
-    return result
-
-
 class BuildController(distbuild.StateMachine):
 
     '''Control one build-request fulfillment.
@@ -328,15 +310,14 @@ class BuildController(distbuild.StateMachine):
         distbuild.crash_point()
 
         self._artifact = event.artifact
+        self._graph = BuildGraph(self._artifact)
         self._helper_id = self._idgen.next()
         artifact_names = []
 
-        def set_state_and_append(artifact):
+        for artifact in self._graph.artifacts:
             artifact.state = UNKNOWN
             artifact_names.append(artifact.basename())
 
-        map_build_graph(self._artifact, set_state_and_append)
-
         url = urlparse.urljoin(self._artifact_cache_server, '/1.0/artifacts')
         msg = distbuild.message('http-request',
             id=self._helper_id,
@@ -352,10 +333,6 @@ class BuildController(distbuild.StateMachine):
 
     def _maybe_handle_cache_response(self, event_source, event):
 
-        def set_status(artifact):
-            is_in_cache = cache_state[artifact.basename()]
-            artifact.state = BUILT if is_in_cache else UNBUILT
-
         if self._helper_id != event.msg['id']:
             return    # this event is not for us
 
@@ -372,11 +349,13 @@ class BuildController(distbuild.StateMachine):
             return
 
         cache_state = json.loads(event.msg['body'])
-        map_build_graph(self._artifact, set_status)
+        for artifact in self._graph.artifacts:
+            is_in_cache = cache_state[artifact.basename()]
+            artifact.state = BUILT if is_in_cache else UNBUILT
+        self._graph.start()
         self.mainloop.queue_event(self, _Annotated())
 
-        count = sum(map_build_graph(self._artifact,
-                    lambda a: 1 if a.state == UNBUILT else 0))
+        count = sum(1 for a in self._graph.artifacts if a.state == UNBUILT)
 
         progress = BuildProgress(
             self._request['id'],
@@ -387,16 +366,6 @@ class BuildController(distbuild.StateMachine):
             logging.info('There seems to be nothing to build')
             self.mainloop.queue_event(self, _Built())
 
-    def _find_artifacts_that_are_ready_to_build(self):
-        def is_ready_to_build(artifact):
-            return (artifact.state == UNBUILT and
-                    all(a.state == BUILT
-                        for a in artifact.source.dependencies))
-
-        return [a 
-                for a in map_build_graph(self._artifact, lambda a: a)
-                if is_ready_to_build(a)]
-
     def _queue_worker_builds(self, event_source, event):
         distbuild.crash_point()
 
@@ -417,14 +386,12 @@ class BuildController(distbuild.StateMachine):
                                 (dep.name, dep.state))
 
         while True:
-            ready = self._find_artifacts_that_are_ready_to_build()
+            artifact = self._graph.pop_ready()
 
-            if len(ready) == 0:
+            if artifact is None:
                 logging.debug('No new artifacts queued for building')
                 break
 
-            artifact = ready[0]
-
             logging.debug(
                 'Requesting worker-build of %s (%s)' %
                     (artifact.name, artifact.source.cache_key))
@@ -432,16 +399,7 @@ class BuildController(distbuild.StateMachine):
                                                    self._request['id'])
             self.mainloop.queue_event(distbuild.WorkerBuildQueuer, request)
 
-            artifact.state = BUILDING
-            if artifact.source.morphology['kind'] == 'chunk':
-                # Chunk artifacts are not built independently
-                # so when we're building any chunk artifact
-                # we're also building all the chunk artifacts
-                # in this source
-                for a in ready:
-                    if a.source == artifact.source:
-                        a.state = BUILDING
-
+            self._graph.mark_building(artifact)
 
     def _maybe_notify_initiator_disconnected(self, event_source, event):
         if event.id != self._request['id']:
@@ -542,12 +500,7 @@ class BuildController(distbuild.StateMachine):
         self.mainloop.queue_event(BuildController, progress)
 
     def _find_artifact(self, cache_key):
-        artifacts = map_build_graph(self._artifact, lambda a: a)
-        wanted = [a for a in artifacts if a.source.cache_key == cache_key]
-        if wanted:
-            return wanted[0]
-        else:
-            return None
+        return self._graph.find_artifact(cache_key)
             
     def _maybe_check_result_and_queue_more_builds(self, event_source, event):
         distbuild.crash_point()
@@ -566,18 +519,7 @@ class BuildController(distbuild.StateMachine):
             self._request['id'], build_step_name(artifact))
         self.mainloop.queue_event(BuildController, finished)
 
-        artifact.state = BUILT
-
-        def set_state(a):
-            if a.source == artifact.source:
-                a.state = BUILT
-
-        if artifact.source.morphology['kind'] == 'chunk':
-            # Building a single chunk artifact
-            # yields all chunk artifacts for the given source
-            # so we set the state of this source's artifacts
-            # to BUILT
-            map_build_graph(self._artifact, set_state)
+        self._graph.mark_built(artifact)
 
         self._queue_worker_builds(None, event)
 
@@ -0,0 +1,123 @@
+# distbuild/build_graph.py -- keep track of what can be built next
+#
+# Copyright (C) 2015  Codethink Limited
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import collections
+
+
+# Artifact build states
+UNKNOWN = 'unknown'
+UNBUILT = 'not-built'
+BUILDING = 'building'
+BUILT = 'built'
+
+
+def map_build_graph(artifact, callback):
+    result = []
+    done = set()
+    queue = [artifact]
+    while queue:
+        a = queue.pop()
+        if a not in done:
+            result.append(callback(a))
+            queue.extend(a.source.dependencies)
+            done.add(a)
+    return result
+
+
+class BuildGraph(object):
+
+    '''Keep track of which artifacts in a build graph can be built next.
+
+    The build state of each artifact is kept in its ``state`` attribute.
+    Once every artifact has been given its initial state (BUILT or
+    UNBUILT), ``start`` counts, for every artifact, the dependencies
+    that are not built yet. After that, marking an artifact as built only
+    updates the counts of the artifacts that depend on it, and those that
+    reach zero are added to a queue of artifacts that are ready to build,
+    so nothing needs to walk the whole graph again.
+
+    '''
+
+    def __init__(self, artifact):
+        self.artifact = artifact
+        self.artifacts = map_build_graph(artifact, lambda a: a)
+
+        self._by_cache_key = {}
+        self._by_source = {}
+        self._dependents = {}
+        for a in self.artifacts:
+            self._by_cache_key.setdefault(a.source.cache_key, a)
+            self._by_source.setdefault(a.source, []).append(a)
+            self._dependents[a] = []
+        for a in self.artifacts:
+            for dep in set(a.source.dependencies):
+                self._dependents[dep].append(a)
+
+        self._pending = {}
+        self._ready = collections.deque()
+
+    def find_artifact(self, cache_key):
+        return self._by_cache_key.get(cache_key)
+
+    def start(self):
+        '''Find the artifacts that are ready to build initially.'''
+
+        self._ready.clear()
+        for a in self.artifacts:
+            self._pending[a] = sum(1 for dep in set(a.source.dependencies)
+                                   if dep.state != BUILT)
+            if a.state == UNBUILT and self._pending[a] == 0:
+                self._ready.append(a)
+
+    def pop_ready(self):
+        '''Return the next artifact that is ready to build, or None.'''
+
+        while self._ready:
+            artifact = self._ready.popleft()
+            if artifact.state == UNBUILT:
+                return artifact
+        return None
+
+    def mark_building(self, artifact):
+        artifact.state = BUILDING
+        if artifact.source.morphology['kind'] == 'chunk':
+            # Chunk artifacts are not built independently
+            # so when we're building any chunk artifact
+            # we're also building all the chunk artifacts
+            # in this source
+            for a in self._by_source[artifact.source]:
+                if a.state == UNBUILT:
+                    a.state = BUILDING
+
+    def mark_built(self, artifact):
+        if artifact.source.morphology['kind'] == 'chunk':
+            # Building a single chunk artifact
+            # yields all chunk artifacts for the given source
+            artifacts = self._by_source[artifact.source]
+        else:
+            artifacts = [artifact]
+
+        for a in artifacts:
+            if a.state == BUILT:
+                continue
+            a.state = BUILT
+            for dependent in self._dependents[a]:
+                self._pending[dependent] -= 1
+                if (self._pending[dependent] == 0 and
+                        dependent.state == UNBUILT):
+                    self._ready.append(dependent)
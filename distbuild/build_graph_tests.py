@@ -0,0 +1,117 @@
+# distbuild/build_graph_tests.py -- unit tests for build graph tracking
+#
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+
+import distbuild
+from distbuild.build_graph import BUILDING, BUILT, UNBUILT
+
+
+class MockSource(object):
+
+    def __init__(self, name, kind, dependencies=()):
+        self.name = name
+        self.cache_key = '%s.cache_key' % name
+        self.morphology = {'kind': kind}
+        self.dependencies = list(dependencies)
+
+
+class MockArtifact(object):
+
+    def __init__(self, name, source, state=UNBUILT):
+        self.name = name
+        self.source = source
+        self.state = state
+
+
+class BuildGraphTests(unittest.TestCase):
+
+    def setUp(self):
+        # system -> stratum -> chunk-bins, chunk-libs (one chunk source)
+        #                   -> other
+        self.chunk_source = MockSource('chunk', 'chunk')
+        self.bins = MockArtifact('chunk-bins', self.chunk_source)
+        self.libs = MockArtifact('chunk-libs', self.chunk_source)
+        self.other = MockArtifact(
+            'other', MockSource('other', 'chunk', [self.libs]))
+        self.stratum = MockArtifact(
+            'stratum', MockSource('stratum', 'stratum',
+                                  [self.bins, self.libs, self.other]))
+        self.system = MockArtifact(
+            'system', MockSource('system', 'system', [self.stratum]))
+        self.graph = distbuild.BuildGraph(self.system)
+
+    def ready_artifacts(self):
+        ready = []
+        while True:
+            artifact = self.graph.pop_ready()
+            if artifact is None:
+                return ready
+            ready.append(artifact)
+            self.graph.mark_building(artifact)
+
+    def test_lists_every_artifact_once(self):
+        self.assertEqual(
+            sorted(a.name for a in self.graph.artifacts),
+            ['chunk-bins', 'chunk-libs', 'other', 'stratum', 'system'])
+
+    def test_finds_artifact_by_cache_key(self):
+        self.assertEqual(self.graph.find_artifact('stratum.cache_key'),
+                         self.stratum)
+        self.assertEqual(self.graph.find_artifact('nonexistent'), None)
+
+    def test_artifacts_without_dependencies_are_ready(self):
+        self.graph.start()
+        ready = self.ready_artifacts()
+        self.assertEqual(len(ready), 1)
+        self.assertEqual(ready[0].source, self.chunk_source)
+
+    def test_building_one_chunk_artifact_builds_the_others(self):
+        self.graph.start()
+        self.ready_artifacts()
+        self.assertEqual(self.bins.state, BUILDING)
+        self.assertEqual(self.libs.state, BUILDING)
+        self.graph.mark_built(self.bins)
+        self.assertEqual(self.libs.state, BUILT)
+
+    def test_dependents_become_ready_when_built(self):
+        self.graph.start()
+        self.ready_artifacts()
+        self.graph.mark_built(self.bins)
+        self.assertEqual(self.ready_artifacts(), [self.other])
+        self.graph.mark_built(self.other)
+        self.assertEqual(self.ready_artifacts(), [self.stratum])
+        self.graph.mark_built(self.stratum)
+        self.assertEqual(self.ready_artifacts(), [self.system])
+        self.graph.mark_built(self.system)
+        self.assertEqual(self.ready_artifacts(), [])
+
+    def test_cached_artifacts_are_not_built(self):
+        for a in (self.bins, self.libs, self.other):
+            a.state = BUILT
+        self.graph.start()
+        self.assertEqual(self.ready_artifacts(), [self.stratum])
+
+    def test_marking_built_twice_is_harmless(self):
+        self.graph.start()
+        self.ready_artifacts()
+        self.graph.mark_built(self.bins)
+        self.graph.mark_built(self.libs)
+        self.assertEqual(self.ready_artifacts(), [self.other])
+        self.graph.mark_built(self.other)
+        self.assertEqual(self.ready_artifacts(), [self.stratum])
@@ -24,9 +24,29 @@ class EventSource(object):
     
     An event source watches one file descriptor, and returns events
     related to it. The events may vary depending on the file descriptor.
-    The actual watching is done using select.select.
+    The actual watching is done by the main loop, using select.epoll
+    where it is available and select.select otherwise.
+
+    By default the main loop asks every event source for its select
+    parameters on every iteration. An event source that sets
+    ``reports_changes`` to True instead promises to call ``changed``
+    whenever its select parameters change, or it becomes finished, and
+    the main loop then only asks again when that happens, or after
+    the event source has been asked for events. Its ``get_events``
+    method is only called when one of its file descriptors is ready, or
+    its timeout has expired.
     
     '''
+
+    reports_changes = False
+
+    mainloop = None
+
+    def changed(self):
+        '''Tell the main loop that the select parameters have changed.'''
+
+        if self.mainloop is not None:
+            self.mainloop.update_event_source(self)
     
     def get_select_params(self):
         '''Return parameters to use for select for this event source.
@@ -43,7 +63,9 @@ class EventSource(object):
     def get_events(self, r, w, x):
         '''Return events related to this file descriptor.
         
-        The arguments are the return values of select.select.
+        The arguments are lists of the readable, writeable and
+        exceptional file descriptors, like the return values of
+        select.select.
         
         '''
         
@@ -57,4 +79,3 @@ class EventSource(object):
         '''
         
         return False
-
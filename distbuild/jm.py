@@ -17,13 +17,12 @@
 
 
 import fcntl
-import json
 import logging
 import os
 import socket
 import sys
-import yaml
 
+import protocol
 from sm import StateMachine 
 from stringbuffer import StringBuffer
 from sockbuf import (SocketBuffer, SocketBufferNewData, 
@@ -48,14 +47,24 @@ class _Close2(object):
 
 class JsonMachine(StateMachine):
 
-    '''A state machine for sending/receiving JSON messages across TCP.'''
+    '''A state machine for sending/receiving JSON messages across TCP.
+
+    Messages are sent with the legacy encoding until the other end says
+    it supports a newer protocol version, after which the highest
+    version both ends support is used (see distbuild.protocol). Set
+    ``protocol_version`` to limit the version this end will use.
+
+    '''
 
     max_buffer = 16 * 1024
 
+    protocol_version = protocol.PROTOCOL_VERSION
+
     def __init__(self, conn):
         StateMachine.__init__(self, 'rw')
         self.conn = conn
         self.debug_json = False
+        self.peer_protocol_version = None
 
     def __repr__(self):
         return '<JsonMachine at 0x%x: socket %s, max_buffer %s>' % \
@@ -82,7 +91,12 @@ class JsonMachine(StateMachine):
         '''Send a message to the other side.'''
         if self.debug_json:
             logging.debug('JsonMachine: Sending message %s' % repr(msg))
-        s = json.dumps(yaml.safe_dump(msg))
+        if self.peer_protocol_version is None:
+            version = protocol.LEGACY_VERSION
+        else:
+            version = min(self.protocol_version, self.peer_protocol_version)
+        s = protocol.encode_message(msg, version,
+                                    advertise=self.protocol_version)
         if self.debug_json:
             logging.debug('JsonMachine: As %s' % repr(s))
         self.sockbuf.write('%s\n' % s)
@@ -109,7 +123,13 @@ class JsonMachine(StateMachine):
             line = line.rstrip()
             if self.debug_json:
                 logging.debug('JsonMachine: line: %s' % repr(line))
-            msg = yaml.load(json.loads(line))
+            msg, version = protocol.decode_message(line)
+            if (self.peer_protocol_version is None or
+                    version > self.peer_protocol_version):
+                if self.debug_json:
+                    logging.debug('JsonMachine: peer supports protocol '
+                                  'version %d' % version)
+                self.peer_protocol_version = version
             self.mainloop.queue_event(self, JsonNewMessage(msg))
 
     def _send_eof(self, event_source, event):
@@ -1,4 +1,4 @@
-# mainloop/mainloop.py -- select-based main loop
+# mainloop/mainloop.py -- epoll-based main loop
 #
 # Copyright (C) 2012, 2014  Codethink Limited
 #
@@ -16,15 +16,168 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import bisect
+import collections
+import errno
 import fcntl
+import heapq
 import logging
+import math
 import os
 import select
+import time
+
+
+# Kinds of interest in a file descriptor, as bit flags.
+READ = 1
+WRITE = 2
+EXCEPTION = 4
+
+
+def _fileno(obj):
+    if isinstance(obj, (int, long)):
+        return obj
+    return obj.fileno()
+
+
+class EpollPoller(object):
+
+    '''Watch file descriptors using select.epoll.
+
+    Interest in each file descriptor is registered with the kernel once,
+    and changed only when it changes, so waiting does not depend on the
+    number of file descriptors.
+
+    epoll always reports hang-ups and errors, and keeps reporting them
+    until the file descriptor is closed. They are reported as whichever
+    of READ and WRITE the file descriptor is watched for, since reading
+    or writing is how its owner will find out what happened. If it is
+    watched for neither, the file descriptor is no longer watched until
+    the interest in it changes, rather than waking up every poll.
+
+    '''
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._interest = {}
+
+    def _mask(self, interest):
+        mask = 0
+        if interest & READ:
+            mask |= select.EPOLLIN
+        if interest & WRITE:
+            mask |= select.EPOLLOUT
+        if interest & EXCEPTION:
+            mask |= select.EPOLLPRI
+        return mask
+
+    def register(self, fd, interest):
+        try:
+            self._epoll.register(fd, self._mask(interest))
+        except IOError, e:
+            if e.errno != errno.EEXIST:  # pragma: no cover
+                raise
+            self._epoll.modify(fd, self._mask(interest))
+        self._interest[fd] = interest
+
+    def modify(self, fd, interest):
+        try:
+            self._epoll.modify(fd, self._mask(interest))
+        except IOError, e:
+            # The kernel forgets a file descriptor when it is closed, so
+            # the number may have been reused since it was registered.
+            if e.errno != errno.ENOENT:  # pragma: no cover
+                raise
+            self._epoll.register(fd, self._mask(interest))
+        self._interest[fd] = interest
+
+    def unregister(self, fd):
+        self._interest.pop(fd, None)
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, ValueError):
+            # Already closed, which unregistered it, and the number may
+            # have been reused for a file that is not registered.
+            pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        else:
+            # epoll works in milliseconds and rounds down, which would
+            # wake us up just before a timer is due.
+            timeout = math.ceil(timeout * 1000) / 1000.0
+        try:
+            ready = self._epoll.poll(timeout)
+        except IOError, e:  # pragma: no cover
+            if e.errno != errno.EINTR:
+                raise
+            return []
+
+        result = []
+        for fd, mask in ready:
+            watched = self._interest.get(fd, 0)
+            interest = 0
+            if mask & select.EPOLLIN:
+                interest |= READ
+            if mask & select.EPOLLOUT:
+                interest |= WRITE
+            if mask & select.EPOLLPRI:
+                interest |= EXCEPTION
+            if mask & (select.EPOLLHUP | select.EPOLLERR):
+                interest |= watched & (READ | WRITE)
+            interest &= watched
+            if interest:
+                result.append((fd, interest))
+            else:
+                self.unregister(fd)
+        return result
+
+
+class SelectPoller(object):
+
+    '''Watch file descriptors using select.select.
+
+    This is used where select.epoll is not available.
+
+    '''
+
+    def __init__(self):
+        self._interest = {}
+
+    def register(self, fd, interest):
+        self._interest[fd] = interest
+
+    def modify(self, fd, interest):
+        self._interest[fd] = interest
+
+    def unregister(self, fd):
+        del self._interest[fd]
+
+    def poll(self, timeout):
+        r = [fd for fd, i in self._interest.iteritems() if i & READ]
+        w = [fd for fd, i in self._interest.iteritems() if i & WRITE]
+        x = [fd for fd, i in self._interest.iteritems() if i & EXCEPTION]
+        r, w, x = select.select(r, w, x, timeout)
+
+        ready = collections.defaultdict(int)
+        for fds, interest in ((r, READ), (w, WRITE), (x, EXCEPTION)):
+            for fd in fds:
+                ready[fd] |= interest
+        return ready.items()
+
+
+def make_poller():
+    '''Return the best poller for this system.'''
+
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    return SelectPoller()  # pragma: no cover
 
 
 class MainLoop(object):
 
-    '''A select-based main loop.
+    '''An epoll-based main loop.
     
     The main loop watches a set of file descriptors wrapped in 
     EventSource objects, and when something happens with them,
@@ -33,21 +186,72 @@ class MainLoop(object):
     can create further events, which are processed further.
     
     When nothing is happening, the main loop sleeps in the
-    select.select call.
+    select.epoll call (or select.select, where there is no epoll).
+
+    The file descriptors of an event source are registered when it is
+    added, and only again when the event source reports that its select
+    parameters have changed (see EventSource.reports_changes). Timeouts
+    are kept in a heap. So the cost of an iteration depends on how many
+    event sources are ready, not on how many there are. Event sources
+    that do not report changes are asked for their select parameters on
+    every iteration.
+
+    An event is only given to the state machines that have a transition
+    for its event source and class, in the order the machines were
+    added, so the cost of an event does not depend on how many other
+    machines there are.
+
+    The main loop counts iterations, events and the time spent waiting
+    and handling events in ``counters``. Iterations that take longer
+    than ``slow_iteration`` seconds to handle their events are logged
+    as warnings.
     
     '''
 
-    def __init__(self):
+    slow_iteration = 1.0
+
+    def __init__(self, poller=None):
         self._machines = []
-        self._sources = []
-        self._events = []
+        self._events = collections.deque()
+        self._machine_seq = {}
+        self._next_seq = 0
+        self._interested = {}
+
+        self._poller = poller or make_poller()
+        self._sources = {}
+        self._unreporting = set()
+        # event source -> list of (obj, fd, interest) it watches
+        self._watches = {}
+        # fd -> {(event source, obj): interest}
+        self._fds = {}
+        # fd -> interest registered with the poller
+        self._registered = {}
+        # Heap of (deadline, token, event source). An entry is stale, and
+        # skipped, if its token is no longer the one in self._deadlines.
+        self._timeouts = []
+        self._deadlines = {}
+        self._next_token = 0
+
         self.dump_filename = None
+        self.counters = {
+            'iterations': 0,
+            'events': 0,
+            'deliveries': 0,
+            'wait_time': 0.0,
+            'dispatch_time': 0.0,
+            'max_dispatch_time': 0.0,
+        }
         
     def add_state_machine(self, machine):
         logging.debug('MainLoop.add_state_machine: %s' % machine)
         machine.mainloop = self
         machine.setup()
         self._machines.append(machine)
+        self._machine_seq[machine] = self._next_seq
+        self._next_seq += 1
+        for event_key in machine.get_event_keys():
+            self._add_interest(machine, event_key)
+        machine.set_event_key_listener(self._add_interest)
         if self.dump_filename:
             filename = '%s%s.dot' % (self.dump_filename, 
                                      machine.__class__.__name__)
@@ -56,53 +260,181 @@ class MainLoop(object):
     def remove_state_machine(self, machine):
         logging.debug('MainLoop.remove_state_machine: %s' % machine)
         self._machines.remove(machine)
+        machine.set_event_key_listener(None)
+        entry = (self._machine_seq.pop(machine), machine)
+        for event_key in machine.get_event_keys():
+            interested = self._interested[event_key]
+            interested.remove(entry)
+            if not interested:
+                del self._interested[event_key]
+
+    def _add_interest(self, machine, event_key):
+        # Keep each list in the order the machines were added, which is
+        # the order they get their events in.
+        entry = (self._machine_seq[machine], machine)
+        bisect.insort(self._interested.setdefault(event_key, []), entry)
     
     def add_event_source(self, event_source):
         logging.debug('MainLoop.add_event_source: %s' % event_source)
-        self._sources.append(event_source)
+        self._sources[event_source] = self._next_seq
+        self._next_seq += 1
+        self._watches[event_source] = []
+        if getattr(event_source, 'reports_changes', False):
+            event_source.mainloop = self
+        else:
+            self._unreporting.add(event_source)
+        self.update_event_source(event_source)
     
     def remove_event_source(self, event_source):
         logging.debug('MainLoop.remove_event_source: %s' % event_source)
-        self._sources.remove(event_source)
-    
-    def _setup_select(self):
-        r = []
-        w = []
-        x = []
-        timeout = None
+        self._set_watches(event_source, [])
+        self._deadlines.pop(event_source, None)
+        del self._sources[event_source]
+        del self._watches[event_source]
+        self._unreporting.discard(event_source)
+        if getattr(event_source, 'reports_changes', False):
+            event_source.mainloop = None
 
-        self._sources = [s for s in self._sources if not s.is_finished()]
-        
-        for event_source in self._sources:
-            sr, sw, sx, st = event_source.get_select_params()
-            r.extend(sr)
-            w.extend(sw)
-            x.extend(sx)
-            if timeout is None:
-                timeout = st
-            elif st is not None:
-                timeout = min(timeout, st)
-
-        return r, w, x, timeout
+    def update_event_source(self, event_source):
+        '''Ask an event source for its select parameters again.'''
+
+        if event_source not in self._sources:
+            return
+        if event_source.is_finished():
+            self.remove_event_source(event_source)
+            return
+
+        r, w, x, timeout = event_source.get_select_params()
+        watches = []
+        for objs, kind in ((r, READ), (w, WRITE), (x, EXCEPTION)):
+            for obj in objs:
+                watches.append((obj, _fileno(obj), kind))
+        self._set_watches(event_source, watches)
+        self._set_timeout(event_source, timeout)
+
+    def _set_watches(self, event_source, watches):
+        old = self._watches[event_source]
+        if old == watches:
+            return
+        self._watches[event_source] = watches
+
+        changed_fds = set()
+        for obj, fd, interest in old:
+            self._fds[fd].pop((event_source, obj), None)
+            changed_fds.add(fd)
+        for obj, fd, interest in watches:
+            watchers = self._fds.setdefault(fd, {})
+            key = (event_source, obj)
+            watchers[key] = watchers.get(key, 0) | interest
+            changed_fds.add(fd)
+
+        for fd in changed_fds:
+            watchers = self._fds[fd]
+            if not watchers:
+                del self._fds[fd]
+                del self._registered[fd]
+                self._poller.unregister(fd)
+                continue
+            interest = 0
+            for i in watchers.itervalues():
+                interest |= i
+            if fd not in self._registered:
+                self._poller.register(fd, interest)
+            elif self._registered[fd] != interest:
+                self._poller.modify(fd, interest)
+            self._registered[fd] = interest
+
+    def _set_timeout(self, event_source, timeout):
+        if timeout is None:
+            self._deadlines.pop(event_source, None)
+            return
+        token = self._next_token
+        self._next_token += 1
+        self._deadlines[event_source] = token
+        heapq.heappush(self._timeouts,
+                       (time.time() + timeout, token, event_source))
+
+    def _next_timeout(self):
+        while self._timeouts:
+            deadline, token, event_source = self._timeouts[0]
+            if self._deadlines.get(event_source) == token:
+                return max(0, deadline - time.time())
+            heapq.heappop(self._timeouts)
+        return None
+
+    def _expired_timeouts(self, now):
+        expired = []
+        while self._timeouts and self._timeouts[0][0] <= now:
+            deadline, token, event_source = heapq.heappop(self._timeouts)
+            if self._deadlines.get(event_source) == token:
+                del self._deadlines[event_source]
+                expired.append(event_source)
+        return expired
 
     def _run_once(self):
-        r, w, x, timeout = self._setup_select()
-        assert r or w or x or timeout is not None
-        r, w, x = select.select(r, w, x, timeout)
+        for event_source in list(self._unreporting):
+            self.update_event_source(event_source)
 
-        for event_source in self._sources:
-            if event_source.is_finished():
-                self.remove_event_source(event_source)
-            else:
-                for event in event_source.get_events(r, w, x):
-                    self.queue_event(event_source, event)
+        timeout = self._next_timeout()
+        assert self._fds or timeout is not None
+        started = time.time()
+        ready_fds = self._poller.poll(timeout)
+        woken = time.time()
+
+        ready = {}
+        for fd, interest in ready_fds:
+            for (event_source, obj), wanted in self._fds.get(fd, {}).items():
+                rwx = ready.setdefault(event_source, ([], [], []))
+                for i, kind in enumerate((READ, WRITE, EXCEPTION)):
+                    if interest & wanted & kind:
+                        rwx[i].append(obj)
+        for event_source in self._expired_timeouts(woken):
+            ready.setdefault(event_source, ([], [], []))
 
+        # Ask event sources for events in the order they were added.
+        for event_source in sorted(ready, key=self._sources.get):
+            if event_source not in self._sources:
+                continue
+            r, w, x = ready[event_source]
+            for event in event_source.get_events(r, w, x):
+                self.queue_event(event_source, event)
+            if event_source not in self._unreporting:
+                self.update_event_source(event_source)
+
+        events, deliveries = self._dispatch_events()
+        self._count_iteration(started, woken, time.time(),
+                              events, deliveries)
+
+    def _dispatch_events(self):
+        events = 0
+        deliveries = 0
         for event_source, event in self._dequeue_events():
-            for machine in self._machines[:]:
+            events += 1
+            interested = self._interested.get(
+                (event_source, event.__class__), [])
+            for seq, machine in interested[:]:
+                deliveries += 1
                 for new_event in machine.handle_event(event_source, event):
                     self.queue_event(event_source, new_event)
-                if machine.state is None:
+                if machine.state is None and machine in self._machine_seq:
                     self.remove_state_machine(machine)
+        return events, deliveries
+
+    def _count_iteration(self, started, woken, finished, events, deliveries):
+        dispatch_time = finished - woken
+        counters = self.counters
+        counters['iterations'] += 1
+        counters['events'] += events
+        counters['deliveries'] += deliveries
+        counters['wait_time'] += woken - started
+        counters['dispatch_time'] += dispatch_time
+        counters['max_dispatch_time'] = max(counters['max_dispatch_time'],
+                                            dispatch_time)
+        if dispatch_time > self.slow_iteration:
+            logging.warning(
+                'MainLoop: slow iteration: %.3fs to handle %d events '
+                '(%d deliveries to %d state machines)' %
+                    (dispatch_time, events, deliveries, len(self._machines)))
 
     def run(self):
         '''Run the main loop.
@@ -115,7 +447,7 @@ class MainLoop(object):
         logging.debug('MainLoop starts')
         while self._machines:
             self._run_once()
-        logging.debug('MainLoop ends')
+        logging.debug('MainLoop ends: %s' % self.counters)
 
     def queue_event(self, event_source, event):
         '''Add an event to queue of events to be processed.'''
@@ -124,6 +456,6 @@ class MainLoop(object):
 
     def _dequeue_events(self):
         while self._events:
-            event_source, event = self._events.pop(0)
+            event_source, event = self._events.popleft()
 
             yield event_source, event
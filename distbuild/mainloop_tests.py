@@ -0,0 +1,367 @@
+# distbuild/mainloop_tests.py -- unit tests for the main loop
+#
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import distbuild
+
+
+class DummyEventSource(object):
+
+    pass
+
+
+class DummyEvent(object):
+
+    pass
+
+
+class OtherEvent(object):
+
+    pass
+
+
+class RecordingMachine(distbuild.StateMachine):
+
+    def __init__(self, name, log, spec):
+        distbuild.StateMachine.__init__(self, 'init')
+        self.name = name
+        self.log = log
+        self.spec = spec
+
+    def setup(self):
+        self.add_transitions(
+            [(state, source, event_class, new_state, self.record)
+             for state, source, event_class, new_state in self.spec])
+
+    def record(self, event_source, event):
+        self.log.append((self.name, event.__class__))
+
+    def handle_event(self, event_source, event):
+        self.log.append((self.name, 'handle_event'))
+        return distbuild.StateMachine.handle_event(self, event_source, event)
+
+
+class MainLoopDispatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.mainloop = distbuild.MainLoop()
+        self.source = DummyEventSource()
+        self.log = []
+
+    def add_machine(self, name, *spec):
+        machine = RecordingMachine(name, self.log, spec)
+        self.mainloop.add_state_machine(machine)
+        return machine
+
+    def dispatch(self, event):
+        self.mainloop.queue_event(self.source, event)
+        return self.mainloop._dispatch_events()
+
+    def test_only_gives_events_to_interested_machines(self):
+        self.add_machine('a', ('init', self.source, DummyEvent, 'init'))
+        self.add_machine('b', ('init', self.source, OtherEvent, 'init'))
+        self.add_machine('c', ('init', DummyEventSource, DummyEvent, 'init'))
+        self.assertEqual(self.dispatch(DummyEvent()), (1, 1))
+        self.assertEqual(self.log, [('a', 'handle_event'),
+                                    ('a', DummyEvent)])
+
+    def test_gives_events_to_machines_in_order_added(self):
+        for name in 'cab':
+            self.add_machine(name,
+                             ('init', self.source, DummyEvent, 'init'))
+        self.dispatch(DummyEvent())
+        self.assertEqual([name for name, what in self.log
+                          if what == DummyEvent],
+                         ['c', 'a', 'b'])
+
+    def test_machine_gets_events_for_transitions_added_later(self):
+        machine = self.add_machine('a')
+        machine.add_transition('init', self.source, DummyEvent, 'init',
+                               machine.record)
+        self.dispatch(DummyEvent())
+        self.assertEqual(self.log[-1], ('a', DummyEvent))
+
+    def test_removes_finished_machines(self):
+        self.add_machine('a', ('init', self.source, DummyEvent, None))
+        self.dispatch(DummyEvent())
+        self.assertEqual(self.mainloop._machines, [])
+        del self.log[:]
+        self.assertEqual(self.dispatch(DummyEvent()), (1, 0))
+        self.assertEqual(self.log, [])
+
+    def test_handles_events_queued_by_callbacks(self):
+        machine = self.add_machine('a',
+                                   ('init', self.source, OtherEvent, 'init'))
+        machine.add_transition(
+            'init', self.source, DummyEvent, 'init',
+            lambda event_source, event: [OtherEvent()])
+        self.assertEqual(self.dispatch(DummyEvent()), (2, 2))
+        self.assertEqual(self.log[-1], ('a', OtherEvent))
+
+    def test_dumps_state_machines_as_dot_files(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.mainloop.dump_filename = os.path.join(tempdir, 'dump-')
+            self.add_machine('a', ('init', self.source, DummyEvent, 'init'))
+            self.assertEqual(os.listdir(tempdir),
+                             ['dump-RecordingMachine.dot'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_counts_iterations(self):
+        self.mainloop._count_iteration(0.0, 1.0, 1.5, 4, 5)
+        self.assertEqual(self.mainloop.counters['iterations'], 1)
+        self.assertEqual(self.mainloop.counters['events'], 4)
+        self.assertEqual(self.mainloop.counters['deliveries'], 5)
+        self.assertEqual(self.mainloop.counters['wait_time'], 1.0)
+        self.assertEqual(self.mainloop.counters['dispatch_time'], 0.5)
+        self.assertEqual(self.mainloop.counters['max_dispatch_time'], 0.5)
+
+    def test_counts_slow_iterations(self):
+        self.mainloop.slow_iteration = 0.1
+        self.mainloop._count_iteration(0.0, 1.0, 2.0, 1, 1)
+        self.assertEqual(self.mainloop.counters['max_dispatch_time'], 1.0)
+
+
+class ListSource(distbuild.EventSource):
+
+    '''An event source that does not report changes.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+
+    def get_select_params(self):
+        return [self.sock], [], [], None
+
+    def get_events(self, r, w, x):
+        if self.sock in r:
+            self.sock.recv(100)
+            return [DummyEvent()]
+        return []
+
+    def is_finished(self):
+        return self.closed
+
+
+class EventSourceTests(unittest.TestCase):
+
+    def make_poller(self):
+        return distbuild.mainloop.EpollPoller()
+
+    def setUp(self):
+        self.mainloop = distbuild.MainLoop(poller=self.make_poller())
+        self.log = []
+        self.ours, self.theirs = socket.socketpair()
+
+    def tearDown(self):
+        self.theirs.close()
+        if self.ours.fileno() >= 0:
+            self.ours.close()
+
+    def watch(self, source, *event_classes):
+        machine = RecordingMachine(
+            'm', self.log,
+            [('init', source, event_class, 'init')
+             for event_class in event_classes])
+        self.mainloop.add_state_machine(machine)
+        self.mainloop.add_event_source(source)
+
+    def events(self):
+        del self.log[:]
+        self.mainloop._run_once()
+        return [what for name, what in self.log if what != 'handle_event']
+
+    def test_socket_readable(self):
+        source = distbuild.SocketEventSource(self.ours)
+        source.stop_writing()
+        self.watch(source, distbuild.SocketReadable, distbuild.SocketWriteable)
+        self.theirs.send('hello')
+        self.assertEqual(self.events(), [distbuild.SocketReadable])
+
+    def test_toggles_write_interest(self):
+        source = distbuild.SocketEventSource(self.ours)
+        self.watch(source, distbuild.SocketReadable, distbuild.SocketWriteable)
+        self.assertEqual(self.events(), [distbuild.SocketWriteable])
+        source.stop_writing()
+        self.theirs.send('hello')
+        self.assertEqual(self.events(), [distbuild.SocketReadable])
+        source.read(100)
+        source.start_writing()
+        self.assertEqual(self.events(), [distbuild.SocketWriteable])
+
+    def test_removes_closed_source(self):
+        source = distbuild.SocketEventSource(self.ours)
+        self.watch(source, distbuild.SocketWriteable)
+        source.close()
+        self.assertEqual(self.mainloop._fds, {})
+        self.assertRaises(AssertionError, self.mainloop._run_once)
+
+    def test_timer(self):
+        timer = distbuild.TimerEventSource(0.01)
+        self.watch(timer, distbuild.Timer)
+        timer.start()
+        self.assertEqual(self.events(), [distbuild.Timer])
+        self.assertEqual(self.events(), [distbuild.Timer])
+        timer.stop()
+        self.assertEqual(self.mainloop._next_timeout(), None)
+
+    def test_earliest_timer_fires_first(self):
+        slow = distbuild.TimerEventSource(60)
+        fast = distbuild.TimerEventSource(0.01)
+        self.watch(slow, distbuild.Timer)
+        self.watch(fast, distbuild.Timer)
+        slow.start()
+        fast.start()
+        self.assertEqual(self.events(), [distbuild.Timer])
+        self.assertTrue(self.mainloop._next_timeout() < 1)
+
+    def test_asks_sources_that_do_not_report_changes_every_time(self):
+        source = ListSource(self.ours)
+        self.watch(source, DummyEvent)
+        self.theirs.send('hello')
+        self.assertEqual(self.events(), [DummyEvent])
+        source.closed = True
+        timer = distbuild.TimerEventSource(0)
+        self.watch(timer, distbuild.Timer)
+        timer.start()
+        self.assertEqual(self.events(), [distbuild.Timer])
+        self.assertFalse(source in self.mainloop._sources)
+
+    def test_ignores_updates_from_removed_sources(self):
+        source = ListSource(self.ours)
+        self.mainloop.update_event_source(source)
+        self.assertEqual(self.mainloop._fds, {})
+
+    def test_skips_sources_removed_by_earlier_sources(self):
+        other_ours, other_theirs = socket.socketpair()
+        try:
+            first = ListSource(self.ours)
+            second = ListSource(other_ours)
+            self.watch(first, DummyEvent)
+            self.watch(second, DummyEvent)
+            original_get_events = first.get_events
+
+            def get_events(r, w, x):
+                self.mainloop.remove_event_source(second)
+                return original_get_events(r, w, x)
+
+            first.get_events = get_events
+            self.theirs.send('hello')
+            other_theirs.send('hello')
+            self.assertEqual(self.events(), [DummyEvent])
+        finally:
+            other_ours.close()
+            other_theirs.close()
+
+    def test_runs_until_no_machines_are_left(self):
+        timer = distbuild.TimerEventSource(0)
+        machine = RecordingMachine(
+            'm', self.log, [('init', timer, distbuild.Timer, None)])
+        self.mainloop.add_state_machine(machine)
+        self.mainloop.add_event_source(timer)
+        timer.start()
+        self.mainloop.run()
+        self.assertEqual(self.log[-1], ('m', distbuild.Timer))
+
+
+class SelectEventSourceTests(EventSourceTests):
+
+    def make_poller(self):
+        return distbuild.mainloop.SelectPoller()
+
+
+class EpollPollerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = distbuild.mainloop.EpollPoller()
+        self.ours, self.theirs = socket.socketpair()
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def test_registering_again_changes_interest(self):
+        fd = self.ours.fileno()
+        self.poller.register(fd, distbuild.mainloop.READ)
+        self.poller.register(fd, distbuild.mainloop.WRITE)
+        self.assertEqual(self.poller.poll(0), [(fd, distbuild.mainloop.WRITE)])
+
+    def test_modifying_unknown_fd_registers_it(self):
+        fd = self.ours.fileno()
+        self.poller.modify(fd, distbuild.mainloop.WRITE)
+        self.assertEqual(self.poller.poll(0), [(fd, distbuild.mainloop.WRITE)])
+
+    def test_unregistering_closed_and_reused_fd_is_harmless(self):
+        sock, other = socket.socketpair()
+        fd = sock.fileno()
+        self.poller.register(fd, distbuild.mainloop.READ)
+        sock.close()
+        other.close()
+        # The fd number is reused, but the new file is not registered.
+        reused, other = socket.socketpair()
+        try:
+            self.assertEqual(reused.fileno(), fd)
+            self.poller.unregister(fd)
+        finally:
+            reused.close()
+            other.close()
+
+    def test_reports_hang_up_as_read_when_watched_for_reading(self):
+        fd = self.ours.fileno()
+        self.poller.register(fd, distbuild.mainloop.READ)
+        self.theirs.close()
+        self.assertEqual(self.poller.poll(0), [(fd, distbuild.mainloop.READ)])
+
+    def test_reports_hang_up_as_write_when_watched_for_writing(self):
+        fd = self.ours.fileno()
+        self.poller.register(fd, distbuild.mainloop.WRITE)
+        self.theirs.close()
+        self.assertEqual(self.poller.poll(0),
+                         [(fd, distbuild.mainloop.WRITE)])
+
+    def test_stops_watching_hung_up_fd_nobody_would_read_or_write(self):
+        fd = self.ours.fileno()
+        self.poller.register(fd, distbuild.mainloop.EXCEPTION)
+        self.theirs.close()
+        self.assertEqual(self.poller.poll(0), [])
+        self.assertEqual(self.poller._epoll.poll(0), [])
+        self.poller.modify(fd, distbuild.mainloop.READ)
+        self.assertEqual(self.poller.poll(0), [(fd, distbuild.mainloop.READ)])
+
+    def test_reports_urgent_data_as_exception(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, addr = listener.accept()
+        try:
+            self.poller.register(server.fileno(),
+                                 distbuild.mainloop.EXCEPTION)
+            client.send('!', socket.MSG_OOB)
+            self.assertEqual(self.poller.poll(1),
+                             [(server.fileno(),
+                               distbuild.mainloop.EXCEPTION)])
+        finally:
+            for sock in (listener, client, server):
+                sock.close()
@@ -16,7 +16,45 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
-'''Construct protocol message objects (dicts).'''
+'''Construct protocol message objects (dicts), and encode them for the wire.
+
+Messages are sent as one line of text each. There are two encodings,
+identified by protocol version numbers:
+
+* Version 1 (LEGACY_VERSION) is a JSON string containing the message
+  as a YAML document. This is what older versions of distbuild send and
+  understand.
+
+* Version 2 (JSON_VERSION) is a plain JSON object, which is much
+  cheaper to encode and decode. It holds the message, and the highest
+  version the sender supports.
+
+* Version 3 (GRAPH_VERSION) uses the same encoding as version 2. A peer
+  that supports it also understands the compact build graph encoding
+  from distbuild.serialise in the exec-requests it is sent.
+
+The receiver can tell the encodings apart from the first character of
+the line, so it can always decode either. The sender must only use
+version 2 once it knows the other end understands it. To find out
+without upsetting older peers, version 1 messages start with a YAML
+comment giving the highest version the sender supports, which the YAML
+parser ignores. A peer that sees the comment, or the version in a
+version 2 message, can switch to the highest version both ends support.
+
+There is no separate handshake, because older peers fail on message
+types they do not know. A peer's version is only learnt from the first
+message it sends. In particular, a controller only learns that a
+worker supports version 3 once the worker has answered its first
+exec-request, so that request carries the older build graph encoding;
+later ones on the same connection use the compact one.
+
+'''
+
+
+import json
+import re
+
+import yaml
 
 
 _required_fields = {
@@ -109,3 +147,87 @@ def message(message_type, **kwargs):
     msg['type'] = message_type
     return msg
 
+
+
+LEGACY_VERSION = 1
+JSON_VERSION = 2
+GRAPH_VERSION = 3
+
+PROTOCOL_VERSION = GRAPH_VERSION
+
+
+_yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_yaml_dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+_version_comment = '# distbuild-protocol: %d\n'
+_version_pattern = re.compile(r'# distbuild-protocol: (\d+)\n')
+
+
+def encode_message(msg, version, advertise=PROTOCOL_VERSION):
+    '''Encode a message as one line of text, without the newline.
+
+    ``version`` is the protocol version to use. The line advertises that
+    the sender supports protocol version ``advertise``. Version 1 lines
+    advertise nothing if that is None, and later ones advertise
+    ``version``.
+
+    Messages that cannot be encoded as JSON, because they contain byte
+    strings that are not valid UTF-8, are always sent as version 1.
+
+    '''
+
+    if version >= JSON_VERSION:
+        envelope = {
+            'version': version if advertise is None else advertise,
+            'message': msg,
+        }
+        try:
+            return json.dumps(envelope, separators=(',', ':'))
+        except UnicodeDecodeError:
+            pass
+
+    text = yaml.dump(msg, Dumper=_yaml_dumper)
+    if advertise is not None:
+        text = _version_comment % advertise + text
+    return json.dumps(text)
+
+
+def decode_message(line):
+    '''Decode a line from ``encode_message``.
+
+    Return the message and the protocol version the sender supports, as
+    far as can be told from the line, which is 1 unless the sender says
+    otherwise.
+
+    '''
+
+    if line.startswith('{'):
+        envelope = ascii_to_str(json.loads(line))
+        return envelope['message'], envelope['version']
+
+    text = json.loads(line)
+    m = _version_pattern.match(text)
+    version = int(m.group(1)) if m else LEGACY_VERSION
+    return yaml.load(text, Loader=_yaml_loader), version
+
+
+def ascii_to_str(obj):
+    '''Convert ASCII unicode strings in a decoded JSON value to str.
+
+    The YAML parser gives plain strings for ASCII text, and unicode
+    otherwise. Doing the same for JSON means that message handlers see
+    the same types whichever encoding was used.
+
+    '''
+
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode('ascii')
+        except UnicodeEncodeError:
+            return obj
+    elif isinstance(obj, dict):
+        return dict((ascii_to_str(k), ascii_to_str(v))
+                    for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        return [ascii_to_str(item) for item in obj]
+    return obj
@@ -0,0 +1,220 @@
+# distbuild/protocol_tests.py -- unit tests for message encoding
+#
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import socket
+import unittest
+
+import yaml
+
+import distbuild
+import distbuild.serialise_tests
+from distbuild.protocol import (decode_message, encode_message,
+                                LEGACY_VERSION, JSON_VERSION, GRAPH_VERSION)
+
+
+# A version that a newer peer might support.
+NEWER_VERSION = JSON_VERSION + 1
+
+
+class EncodingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.msg = distbuild.message(
+            'step-output', id=123, step_name='foo', stdout='output\n',
+            stderr=u'caf\xe9')
+
+    def test_json_round_trip(self):
+        line = encode_message(self.msg, JSON_VERSION, advertise=None)
+        self.assertTrue(line.startswith('{'))
+        self.assertEqual(decode_message(line), (self.msg, JSON_VERSION))
+
+    def test_json_encoding_advertises_version(self):
+        line = encode_message(self.msg, JSON_VERSION, advertise=NEWER_VERSION)
+        self.assertEqual(decode_message(line), (self.msg, NEWER_VERSION))
+
+    def test_legacy_round_trip(self):
+        line = encode_message(self.msg, LEGACY_VERSION, advertise=None)
+        self.assertEqual(decode_message(line), (self.msg, LEGACY_VERSION))
+
+    def test_legacy_encoding_is_understood_by_old_decoder(self):
+        line = encode_message(self.msg, LEGACY_VERSION)
+        self.assertEqual(yaml.load(json.loads(line)), self.msg)
+
+    def test_legacy_encoding_advertises_version(self):
+        line = encode_message(self.msg, LEGACY_VERSION, advertise=7)
+        self.assertEqual(decode_message(line), (self.msg, 7))
+
+    def test_decodes_message_from_old_encoder(self):
+        line = json.dumps(yaml.safe_dump(self.msg))
+        self.assertEqual(decode_message(line), (self.msg, LEGACY_VERSION))
+
+    def test_ascii_strings_are_decoded_as_str(self):
+        line = encode_message(self.msg, JSON_VERSION)
+        msg, version = decode_message(line)
+        self.assertEqual(type(msg['type']), str)
+        self.assertEqual(type(msg['stdout']), str)
+        self.assertEqual(type(msg['stderr']), unicode)
+
+    def test_ascii_strings_in_lists_are_decoded_as_str(self):
+        msg = distbuild.message('build-finished', id=123,
+                                urls=[u'http://example.com/'])
+        decoded, version = decode_message(encode_message(msg, JSON_VERSION))
+        self.assertEqual(type(decoded['urls'][0]), str)
+
+    def test_uses_legacy_encoding_for_binary_data(self):
+        self.msg['stdout'] = '\xff\xfe'
+        line = encode_message(self.msg, JSON_VERSION)
+        self.assertFalse(line.startswith('{'))
+        self.assertEqual(decode_message(line)[0], self.msg)
+
+
+class Receiver(distbuild.StateMachine):
+
+    def __init__(self, conn, protocol_version, expected):
+        distbuild.StateMachine.__init__(self, 'receiving')
+        self.conn = conn
+        self.protocol_version = protocol_version
+        self.expected = expected
+        self.received = []
+
+    def setup(self):
+        self.jm = distbuild.JsonMachine(self.conn)
+        self.jm.protocol_version = self.protocol_version
+        self.mainloop.add_state_machine(self.jm)
+        self.add_transitions([
+            ('receiving', self.jm, distbuild.JsonNewMessage, 'receiving',
+                self._received),
+            ('receiving', self.jm, distbuild.JsonEof, None, None),
+        ])
+
+    def _received(self, event_source, event):
+        self.received.append(event.msg)
+        if len(self.received) == self.expected:
+            self.jm.close()
+
+
+class NegotiationTests(unittest.TestCase):
+
+    def exchange(self, version_a, version_b):
+        sock_a, sock_b = socket.socketpair()
+        mainloop = distbuild.MainLoop()
+        a = Receiver(sock_a, version_a, 3)
+        b = Receiver(sock_b, version_b, 3)
+        mainloop.add_state_machine(a)
+        mainloop.add_state_machine(b)
+        for i in range(3):
+            a.jm.send({'type': 'test', 'n': i})
+            b.jm.send({'type': 'test', 'n': i})
+            mainloop._run_once()
+        mainloop.run()
+        self.assertEqual(a.received, [{'type': 'test', 'n': i}
+                                      for i in range(3)])
+        self.assertEqual(b.received, a.received)
+        return a.jm, b.jm
+
+    def test_switches_to_json_when_both_ends_support_it(self):
+        a, b = self.exchange(JSON_VERSION, JSON_VERSION)
+        self.assertEqual(a.peer_protocol_version, JSON_VERSION)
+        self.assertEqual(b.peer_protocol_version, JSON_VERSION)
+
+    def test_agrees_on_newer_version_when_both_ends_support_it(self):
+        a, b = self.exchange(NEWER_VERSION, NEWER_VERSION)
+        self.assertEqual(a.peer_protocol_version, NEWER_VERSION)
+        self.assertEqual(b.peer_protocol_version, NEWER_VERSION)
+
+    def test_agrees_on_highest_version_both_ends_support(self):
+        a, b = self.exchange(NEWER_VERSION, JSON_VERSION)
+        self.assertEqual(a.peer_protocol_version, JSON_VERSION)
+        self.assertEqual(b.peer_protocol_version, NEWER_VERSION)
+
+    def test_keeps_legacy_encoding_for_legacy_peer(self):
+        a, b = self.exchange(JSON_VERSION, LEGACY_VERSION)
+        self.assertEqual(a.peer_protocol_version, LEGACY_VERSION)
+        self.assertEqual(b.peer_protocol_version, JSON_VERSION)
+
+
+class MockArtifact(distbuild.serialise_tests.MockArtifact):
+
+    def basename(self):
+        return '%s.chunk.%s' % (self.source.cache_key, self.name)
+
+
+class CompactGraphTests(unittest.TestCase):
+
+    def setUp(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.controller_sock = socket.create_connection(
+            listener.getsockname())
+        self.worker_sock, addr = listener.accept()
+        listener.close()
+
+        self.mainloop = distbuild.MainLoop()
+        self.worker = Receiver(self.worker_sock, GRAPH_VERSION, None)
+        self.mainloop.add_state_machine(self.worker)
+        self.wc = distbuild.WorkerConnection(
+            None, self.controller_sock, 'http://cache.example.com:8080/',
+            8080, 'morph')
+        self.mainloop.add_state_machine(self.wc)
+        # Wake up regularly, so that a test fails rather than hangs.
+        self.timer = distbuild.TimerEventSource(0.1)
+        self.mainloop.add_event_source(self.timer)
+        self.timer.start()
+
+    def tearDown(self):
+        self.controller_sock.close()
+        self.worker_sock.close()
+
+    def run_until(self, condition):
+        for i in xrange(50):
+            self.mainloop._dispatch_events()
+            if condition():
+                return
+            self.mainloop._run_once()
+        self.fail('Timed out')  # pragma: no cover
+
+    def send_job(self):
+        artifact = MockArtifact('chunk', 'chunk')
+        job = distbuild.worker_build_scheduler.Job(1, artifact, 'initiator')
+        count = len(self.worker.received)
+        self.mainloop.queue_event(
+            self.wc, distbuild.worker_build_scheduler._HaveAJob(job))
+        self.run_until(lambda: len(self.worker.received) > count)
+        msg = self.worker.received[-1]
+        self.assertEqual(msg['type'], 'exec-request')
+        return msg['stdin_contents']
+
+    def test_sends_compact_graph_once_worker_has_replied(self):
+        # The controller speaks first, so the first job goes out before
+        # it knows what the worker supports.
+        self.assertFalse(self.send_job().startswith('{'))
+        self.worker.jm.send({'type': 'exec-output', 'id': 1,
+                             'stdout': '', 'stderr': ''})
+        self.run_until(lambda: self.wc._jm.peer_protocol_version is not None)
+        self.assertEqual(self.wc._jm.peer_protocol_version, GRAPH_VERSION)
+
+        self.mainloop.queue_event(distbuild.BuildController,
+                                  distbuild.BuildCancel('initiator'))
+        self.run_until(lambda: self.worker.received[-1]['type'] ==
+                       'exec-cancel')
+        graph = self.send_job()
+        self.assertTrue(graph.startswith('{"distbuild-graph":'))
+        self.assertEqual(distbuild.deserialise_artifact(graph).name,
+                         'chunk')
@@ -16,15 +16,79 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+'''Serialise build graphs for sending between distbuild nodes.
+
+There are two encodings. The legacy one is a single JSON string holding
+a YAML document, in which every object is keyed by its Python id().
+
+The compact one is a sequence of lines, each holding one JSON list,
+that can be decoded one line at a time. The first line is a header
+object. Each following line is a record, and its first item says which
+kind of record it is:
+
+* ``["t", STRING]`` adds STRING to the string table. Source and artifact
+  records refer to strings by their index in this table, so that names,
+  repositories and refs that occur many times are only sent once.
+
+* ``["o", KEY, VALUE]`` adds a JSON value to the object table. KEY is
+  the SHA1 of the canonical JSON form of VALUE. Morphologies, and the
+  build environment in cache ids, are sent this way, so identical ones
+  are only sent once. The artifact names and cache keys of the
+  dependencies in cache ids go in the string table.
+
+* ``["s", ID, ...]`` is a source (see _SOURCE_FIELDS).
+
+* ``["a", ID, SOURCE_ID, NAME, ARCH]`` is an artifact of a source.
+
+* ``["d", ARTIFACT_ID, [SOURCE_ID, ...]]`` lists the dependents of an
+  artifact.
+
+* ``["e", ROOT_ARTIFACT_ID]`` ends the graph.
+
+Records only refer to records that come before them, so that each can
+be turned into objects as soon as it is read.
+
+'''
+
+
+import cStringIO
+import hashlib
 import json
 import yaml
 
 import morphlib
 import logging
 
+from protocol import ascii_to_str
+
+
+# Version of the compact encoding, given in its header.
+GRAPH_FORMAT_VERSION = 1
+
+# The fields of a compact source record, after the record kind and ID.
+_SOURCE_FIELDS = ('name', 'repo_name', 'original_ref', 'sha1', 'tree',
+                  'morphology', 'filename', 'cache_id', 'cache_key',
+                  'build_mode', 'prefix', 'dependencies')
+
+
+def serialise_artifact(artifact, compact=True):
+    '''Serialise an Artifact object and its dependencies into string form.
 
-def serialise_artifact(artifact):
-    '''Serialise an Artifact object and its dependencies into string form.'''
+    The compact encoding is used unless ``compact`` is False, or the
+    graph contains byte strings that cannot be encoded as JSON.
+
+    '''
+
+    if compact:
+        try:
+            return _serialise_compact(artifact)
+        except UnicodeDecodeError, e:
+            logging.warning('Cannot encode build graph compactly, using '
+                            'legacy encoding: %s' % e)
+    return _serialise_legacy(artifact)
+
+
+def _serialise_legacy(artifact):
 
     def encode_morphology(morphology):
         result = {}
@@ -114,16 +178,236 @@ def serialise_artifact(artifact):
     return json.dumps(yaml.dump(content))
 
 
+def _canonical_json(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def _serialise_compact(artifact):
+    lines = []
+    strings = {}
+    objects = set()
+    source_ids = {}
+    artifact_ids = {}
+
+    def emit(record):
+        lines.append(json.dumps(record, separators=(',', ':')))
+
+    def string(s):
+        if s is None:
+            return None
+        if s not in strings:
+            strings[s] = len(strings)
+            emit(['t', s])
+        return strings[s]
+
+    def obj(value):
+        canonical = _canonical_json(value)
+        key = hashlib.sha1(canonical).hexdigest()
+        if key not in objects:
+            objects.add(key)
+            lines.append('["o","%s",%s]' % (key, canonical))
+        return key
+
+    def encode_cache_id(cache_id):
+        if cache_id is None:
+            return None
+        rest = dict(cache_id)
+        env = rest.pop('env', None)
+        kids = rest.pop('kids', None)
+        if kids is not None:
+            kids = [[string(k['artifact']), string(k['cache-key'])]
+                    for k in kids]
+        return [None if env is None else obj(env), kids, rest]
+
+    def encode_source(source, prune_leaf=False):
+        source_ids[source] = len(source_ids)
+        morphology = dict((k, source.morphology[k])
+                          for k in source.morphology.keys())
+        if source.morphology['kind'] == 'chunk':
+            build_mode = string(source.build_mode)
+            prefix = string(source.prefix)
+        else:
+            build_mode = prefix = None
+        if prune_leaf:
+            dependencies = []
+        else:
+            dependencies = [artifact_ids[d] for d in source.dependencies]
+        emit(['s', source_ids[source],
+              string(source.name),
+              string(source.repo_name),
+              string(source.original_ref),
+              string(source.sha1),
+              string(source.tree),
+              obj(morphology),
+              string(source.filename),
+              encode_cache_id(source.cache_id),
+              string(source.cache_key),
+              build_mode,
+              prefix,
+              dependencies])
+
+    if artifact.source.morphology['kind'] == 'system': # pragma: no cover
+        system_arch = artifact.source.morphology['arch']
+    else:
+        system_arch = None
+
+    def encode_artifact(a):
+        artifact_ids[a] = len(artifact_ids)
+        arch = system_arch or a.arch
+        emit(['a', artifact_ids[a], source_ids[a.source], string(a.name),
+              string(arch)])
+
+    emit({
+        'distbuild-graph': GRAPH_FORMAT_VERSION,
+        'default_split_rules': {
+            'chunk': morphlib.artifactsplitrule.DEFAULT_CHUNK_RULES,
+            'stratum': morphlib.artifactsplitrule.DEFAULT_STRATUM_RULES,
+        },
+    })
+
+    # Artifact.walk() returns dependencies before the artifacts that
+    # depend on them, so every source's dependencies have been sent by
+    # the time the source is.
+    visited = []
+    for a in artifact.walk():
+        if a.source not in source_ids:
+            encode_source(a.source)
+            for sa in sorted(a.source.artifacts.itervalues(),
+                             key=lambda sa: sa.name):
+                encode_artifact(sa)
+                visited.append(sa)
+
+    # Include the strata that depend on the artifacts, as we need them
+    # to be able to tell whether two sources are in the same stratum.
+    # Other dependents outside the graph are not needed.
+    for a in visited:
+        dependents = []
+        for source in a.dependents:
+            if source not in source_ids:
+                if source.morphology['kind'] != 'stratum':
+                    continue
+                encode_source(source, prune_leaf=True)
+            dependents.append(source_ids[source])
+        if dependents:
+            emit(['d', artifact_ids[a], dependents])
+
+    emit(['e', artifact_ids[artifact]])
+    return '\n'.join(lines)
+
+
 def deserialise_artifact(encoded):
     '''Re-construct the Artifact object (and dependencies).
     
-    The argument should be a string returned by ``serialise_artifact``.
-    The reconstructed Artifact objects will be sufficiently like the
-    originals that they can be used as a build graph, and other such
-    purposes, by Morph.
+    The argument should be a string returned by ``serialise_artifact``,
+    or a file to read one from. The reconstructed Artifact objects will
+    be sufficiently like the originals that they can be used as a build
+    graph, and other such purposes, by Morph.
     
     '''
 
+    if isinstance(encoded, basestring):
+        encoded = cStringIO.StringIO(encoded)
+    first_line = encoded.readline()
+    if first_line.startswith('{'):
+        header = ascii_to_str(json.loads(first_line))
+        if header.get('distbuild-graph') != GRAPH_FORMAT_VERSION:
+            raise ValueError('Unknown build graph format: %s' %
+                             header.get('distbuild-graph'))
+        return _deserialise_compact(header, encoded)
+    return _deserialise_legacy(first_line)
+
+
+def _make_split_rules(morphology, default_split_rules):
+    kind = morphology['kind']
+    ruler = getattr(morphlib.artifactsplitrule, 'unify_%s_matches' % kind)
+    if kind in ('chunk', 'stratum'):
+        return ruler(morphology, default_split_rules[kind])
+    else: # pragma: no cover
+        return ruler(morphology)
+
+
+def _deserialise_compact(header, lines):
+    default_split_rules = header['default_split_rules']
+    strings = []
+    objects = {}
+    morphologies = {}
+    sources = {}
+    artifacts = {}
+
+    def string(index):
+        return None if index is None else strings[index]
+
+    def morphology(key):
+        if key not in morphologies:
+            m = morphlib.morphology.Morphology(objects[key])
+            morphologies[key] = (m, _make_split_rules(m, default_split_rules))
+        return morphologies[key]
+
+    def decode_cache_id(encoded):
+        if encoded is None:
+            return None
+        env_key, kids, cache_id = encoded
+        if env_key is not None:
+            cache_id['env'] = objects[env_key]
+        if kids is not None:
+            cache_id['kids'] = [{'artifact': strings[name],
+                                 'cache-key': strings[cache_key]}
+                                for name, cache_key in kids]
+        return cache_id
+
+    def decode_source(record):
+        fields = dict(zip(_SOURCE_FIELDS, record[2:]))
+        m, split_rules = morphology(fields['morphology'])
+        source = morphlib.source.Source(string(fields['name']),
+                                        string(fields['repo_name']),
+                                        string(fields['original_ref']),
+                                        string(fields['sha1']),
+                                        string(fields['tree']),
+                                        m,
+                                        string(fields['filename']),
+                                        split_rules)
+        if m['kind'] == 'chunk':
+            source.build_mode = string(fields['build_mode'])
+            source.prefix = string(fields['prefix'])
+        source.cache_id = decode_cache_id(fields['cache_id'])
+        source.cache_key = string(fields['cache_key'])
+        source.dependencies = [artifacts[aid]
+                               for aid in fields['dependencies']]
+        source.artifacts = {}
+        sources[record[1]] = source
+
+    def decode_artifact(record):
+        aid, sid, name, arch = record[1:]
+        source = sources[sid]
+        artifact = morphlib.artifact.Artifact(source, string(name))
+        artifact.arch = string(arch)
+        source.artifacts[artifact.name] = artifact
+        artifacts[aid] = artifact
+
+    for line in lines:
+        record = ascii_to_str(json.loads(line))
+        kind = record[0]
+        if kind == 't':
+            strings.append(record[1])
+        elif kind == 'o':
+            objects[record[1]] = record[2]
+        elif kind == 's':
+            decode_source(record)
+        elif kind == 'a':
+            decode_artifact(record)
+        elif kind == 'd':
+            artifacts[record[1]].dependents = [sources[sid]
+                                               for sid in record[2]]
+        elif kind == 'e':
+            return artifacts[record[1]]
+        else:
+            raise ValueError('Unknown build graph record: %r' % kind)
+
+    raise ValueError('Build graph ends unexpectedly')
+
+
+def _deserialise_legacy(encoded):
+
     def decode_morphology(le_dict):
         '''Convert a dict into something that kinda acts like a Morphology.
         
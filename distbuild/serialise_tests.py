@@ -16,6 +16,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import json
+import StringIO
 import unittest
 
 import distbuild
@@ -64,6 +66,8 @@ class MockSource(object):
         self.cache_id = {
             'blip': '%s.blip' % name,
             'integer': 42,
+            'env': {'PATH': '/usr/bin:/bin'},
+            'kids': [{'artifact': 'kid', 'cache-key': 'kid.cache_key'}],
         }
         self.cache_key = '%s.cache_key' % name
         self.artifacts = {}
@@ -131,20 +135,21 @@ class SerialisationTests(unittest.TestCase):
                                       b.source.dependencies[i])
 
     def verify_round_trip(self, artifact):
-        encoded = distbuild.serialise_artifact(artifact)
-        decoded = distbuild.deserialise_artifact(encoded)
-        self.assertEqualArtifacts(artifact, decoded)
-        
-        objs = {}
-        queue = [decoded]
-        while queue:
-            obj = queue.pop()
-            k = obj.source.cache_key
-            if k in objs:
-                self.assertTrue(obj is objs[k])
-            else:
-                objs[k] = obj
-            queue.extend(obj.source.dependencies)
+        for compact in (True, False):
+            encoded = distbuild.serialise_artifact(artifact, compact=compact)
+            decoded = distbuild.deserialise_artifact(encoded)
+            self.assertEqualArtifacts(artifact, decoded)
+
+            objs = {}
+            queue = [decoded]
+            while queue:
+                obj = queue.pop()
+                k = obj.source.cache_key
+                if k in objs:
+                    self.assertTrue(obj is objs[k])
+                else:
+                    objs[k] = obj
+                queue.extend(obj.source.dependencies)
 
     def test_returns_string(self):
         encoded = distbuild.serialise_artifact(self.art1)
@@ -172,3 +177,71 @@ class SerialisationTests(unittest.TestCase):
         self.art1.source.dependencies = [self.art2, self.art3]
         self.verify_round_trip(self.art1)
 
+    def test_reads_compact_graph_from_file(self):
+        self.art1.source.dependencies = [self.art2]
+        encoded = distbuild.serialise_artifact(self.art1)
+        decoded = distbuild.deserialise_artifact(
+            StringIO.StringIO(encoded + '\n'))
+        self.assertEqualArtifacts(self.art1, decoded)
+
+    def test_reads_legacy_graph_from_file(self):
+        encoded = distbuild.serialise_artifact(self.art1, compact=False)
+        decoded = distbuild.deserialise_artifact(
+            StringIO.StringIO(encoded + '\n'))
+        self.assertEqualArtifacts(self.art1, decoded)
+
+    def test_sends_identical_morphologies_and_strings_once(self):
+        self.art2.source.morphology = self.art3.source.morphology
+        self.art2.source.repo_name = self.art3.source.repo_name
+        self.art1.source.dependencies = [self.art2, self.art3]
+        encoded = distbuild.serialise_artifact(self.art1)
+        records = [json.loads(line) for line in encoded.splitlines()[1:]]
+        morphologies = [r for r in records
+                        if r[0] == 'o' and 'kind' in r[2]]
+        self.assertEqual(len(morphologies), 2)
+        environments = [r for r in records if r[0] == 'o' and 'PATH' in r[2]]
+        self.assertEqual(len(environments), 1)
+        strings = [r[1] for r in records if r[0] == 't']
+        self.assertEqual(strings.count('name3.source.repo_name'), 1)
+
+    def test_only_includes_stratum_dependents(self):
+        self.art2.source.morphology = MockMorphology('name2', 'stratum')
+        self.art4.source.dependencies = [self.art3]
+        self.art3.dependents = [self.art2.source, self.art4.source]
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art3))
+        self.assertEqual([s.name for s in decoded.dependents], ['name2'])
+
+    def test_rejects_truncated_graph(self):
+        self.art1.source.dependencies = [self.art2]
+        encoded = distbuild.serialise_artifact(self.art1)
+        truncated = '\n'.join(encoded.splitlines()[:-1])
+        self.assertRaises(ValueError, distbuild.deserialise_artifact,
+                          truncated)
+
+    def test_sends_missing_strings_and_cache_ids(self):
+        self.art1.source.repo_name = None
+        self.art1.source.cache_id = None
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art1))
+        self.assertEqual(decoded.source.repo_name, None)
+        self.assertEqual(decoded.source.cache_id, None)
+
+    def test_uses_legacy_encoding_for_binary_strings(self):
+        self.art1.source.sha1 = '\xff\xfe'
+        encoded = distbuild.serialise_artifact(self.art1)
+        self.assertFalse(encoded.startswith('{'))
+
+    def test_rejects_unknown_graph_format(self):
+        encoded = distbuild.serialise_artifact(self.art1)
+        lines = encoded.splitlines()
+        lines[0] = json.dumps({'distbuild-graph': 99})
+        self.assertRaises(ValueError, distbuild.deserialise_artifact,
+                          '\n'.join(lines))
+
+    def test_rejects_unknown_records(self):
+        encoded = distbuild.serialise_artifact(self.art1)
+        lines = encoded.splitlines()
+        lines.insert(1, json.dumps(['x']))
+        self.assertRaises(ValueError, distbuild.deserialise_artifact,
+                          '\n'.join(lines))
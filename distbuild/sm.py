@@ -50,6 +50,8 @@ class StateMachine(object):
     
     def __init__(self, initial_state):
         self._transitions = {}
+        self._event_keys = set()
+        self._event_key_listener = None
         self.state = self._initial_state = initial_state
         self.debug_transitions = False
 
@@ -77,6 +79,12 @@ class StateMachine(object):
             'Transition %s already registered' % str(key)
         self._transitions[key] = (new_state, callback)
 
+        event_key = (source, event_class)
+        if event_key not in self._event_keys:
+            self._event_keys.add(event_key)
+            if self._event_key_listener is not None:
+                self._event_key_listener(self, event_key)
+
     def add_transitions(self, specification):
         '''Add many transitions.
         
@@ -89,6 +97,28 @@ class StateMachine(object):
         for t in specification:
             self.add_transition(*t)
     
+    def get_event_keys(self):
+        '''Return the (event source, event class) pairs we handle.
+
+        These are the pairs for which there is a transition from at least
+        one state. The main loop only gives the machine events that match
+        one of them.
+
+        '''
+
+        return set(self._event_keys)
+
+    def set_event_key_listener(self, listener):
+        '''Call ``listener(machine, event_key)`` for new event keys.
+
+        The listener is called whenever a transition is added for an
+        (event source, event class) pair that the machine did not handle
+        before. Set it to None to stop.
+
+        '''
+
+        self._event_key_listener = listener
+
     def handle_event(self, event_source, event):
         '''Handle a given event.
         
@@ -96,3 +96,24 @@ class StateMachineTests(unittest.TestCase):
         self.assertEqual(self.event_sources, [self.event_source])
         self.assertEqual(self.events, [self.event])
 
+    def test_lists_event_keys(self):
+        spec = [
+            ('init', self.event_source, DummyEvent, 'next', None),
+            ('next', self.event_source, DummyEvent, 'init', None),
+            ('init', self.event_source, str, 'init', None),
+        ]
+        self.sm.add_transitions(spec)
+        self.assertEqual(self.sm.get_event_keys(),
+                         set([(self.event_source, DummyEvent),
+                              (self.event_source, str)]))
+
+    def test_tells_listener_about_new_event_keys(self):
+        keys = []
+        self.sm.set_event_key_listener(
+            lambda machine, key: keys.append(key))
+        spec = [
+            ('init', self.event_source, DummyEvent, 'next', None),
+            ('next', self.event_source, DummyEvent, 'init', None),
+        ]
+        self.sm.add_transitions(spec)
+        self.assertEqual(keys, [(self.event_source, DummyEvent)])
@@ -18,13 +18,17 @@
 
 import time
 
+from eventsrc import EventSource
+
 
 class Timer(object):
 
     pass
 
 
-class TimerEventSource(object):
+class TimerEventSource(EventSource):
+
+    reports_changes = True
 
     def __init__(self, interval):
         self.interval = interval
@@ -34,9 +38,11 @@ class TimerEventSource(object):
     def start(self):
         self.enabled = True
         self.last_event = time.time()
+        self.changed()
         
     def stop(self):
         self.enabled = False
+        self.changed()
         
     def get_select_params(self):
         if self.enabled:
@@ -56,4 +62,3 @@ class TimerEventSource(object):
 
     def is_finished(self):
         return False
-
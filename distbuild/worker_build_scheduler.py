@@ -471,10 +471,17 @@ class WorkerConnection(distbuild.StateMachine):
             '--build-log-on-stdout',
             self._job.artifact.name,
         ]
+        # Only send the compact build graph encoding to workers that
+        # have told us they understand it. Workers only say so in their
+        # replies, so the first build on a connection never uses it.
+        peer_version = self._jm.peer_protocol_version
+        compact = (peer_version is not None and
+                   peer_version >= distbuild.protocol.GRAPH_VERSION)
         msg = distbuild.message('exec-request',
             id=self._job.id,
             argv=argv,
-            stdin_contents=distbuild.serialise_artifact(self._job.artifact),
+            stdin_contents=distbuild.serialise_artifact(
+                self._job.artifact, compact=compact),
         )
         self._jm.send(msg)
 
@@ -14,4 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import fetcher
 import repocache
+import server
+import stats
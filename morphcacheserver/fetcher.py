@@ -0,0 +1,186 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import os
+import threading
+import time
+import urllib
+import urllib2
+
+
+class ArtifactFetchError(Exception):
+
+    def __init__(self, failures):
+        Exception.__init__(
+            self, 'Failed to fetch %s' % ', '.join(
+                '%s (%s)' % (name, error)
+                for name, error in sorted(failures.iteritems())))
+        self.failures = failures
+
+
+class _Download(object):
+
+    '''One artifact being downloaded, which several requests may wait for.
+
+    ``users`` counts the requests that wait for it. It is kept in the
+    temporary file until a request publishes it, or the last of them
+    gives up on it.
+
+    '''
+
+    def __init__(self, tmpname):
+        self.tmpname = tmpname
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.users = 1
+        self.published = False
+
+
+class ArtifactFetcher(object):
+
+    '''Copy artifacts from another cache server into the artifact cache.
+
+    The artifacts asked for by one call of ``fetch`` are downloaded at
+    the same time, up to ``max_downloads`` at once across all calls.
+    Each is streamed to a temporary file in ``buffer_size`` pieces. The
+    files are only renamed into place once all of the artifacts are
+    complete, so that a client never finds part of a set. If an artifact
+    is already being downloaded for another request, that download is
+    waited for instead of starting another.
+
+    '''
+
+    def __init__(self, artifact_dir, max_downloads=8,
+                 buffer_size=1024 * 1024, timeout=600, stats=None):
+        self.artifact_dir = artifact_dir
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.stats = stats
+        self._slots = threading.Semaphore(max_downloads)
+        self._lock = threading.Lock()
+        self._downloads = {}
+
+    def fetch(self, server, cacheid, artifacts):
+        '''Fetch ``cacheid.artifact`` from ``server`` for each artifact.
+
+        Return a dict giving the size, disk usage and download time of
+        each artifact, by filename. If any of them could not be fetched,
+        ArtifactFetchError is raised once the others have finished, and
+        none of them are put in the cache, unless another request that
+        shares their downloads succeeds.
+
+        '''
+
+        waiting = []
+        for artifact in artifacts:
+            name = '%s.%s' % (cacheid, artifact)
+            url = 'http://%s/1.0/artifacts?filename=%s' % (
+                server, urllib.quote(name))
+            waiting.append((name, self._start(name, url)))
+
+        try:
+            results = {}
+            failures = {}
+            for name, download in waiting:
+                download.done.wait()
+                if download.error is not None:
+                    failures[name] = download.error
+                else:
+                    results[name] = download.result
+            if failures:
+                raise ArtifactFetchError(failures)
+            with self._lock:
+                for name, download in waiting:
+                    if not download.published:
+                        os.rename(download.tmpname,
+                                  os.path.join(self.artifact_dir, name))
+                        download.published = True
+            return results
+        finally:
+            for name, download in waiting:
+                self._release(name, download)
+
+    def _start(self, name, url):
+        with self._lock:
+            download = self._downloads.get(name)
+            if download is not None:
+                logging.debug('Waiting for the download of %s' % name)
+                self._count('fetch_shared_total')
+                download.users += 1
+                return download
+            tmpname = os.path.join(self.artifact_dir, '.dl.%s' % name)
+            download = self._downloads[name] = _Download(tmpname)
+
+        thread = threading.Thread(target=self._run,
+                                  args=(url, download))
+        thread.daemon = True
+        thread.start()
+        return download
+
+    def _release(self, name, download):
+        with self._lock:
+            download.users -= 1
+            if download.users == 0:
+                del self._downloads[name]
+                if not download.published and \
+                        os.path.exists(download.tmpname):
+                    os.unlink(download.tmpname)
+
+    def _run(self, url, download):
+        try:
+            with self._slots:
+                download.result = self._download(url, download.tmpname)
+        except Exception as e:
+            logging.error('Failed to fetch %s: %s' % (url, e))
+            download.error = str(e) or e.__class__.__name__
+            self._count('fetch_failures_total')
+        finally:
+            download.done.set()
+
+    def _download(self, url, tmpname):
+        started = time.time()
+        try:
+            in_fh = urllib2.urlopen(url, timeout=self.timeout)
+            try:
+                with open(tmpname, 'wb') as out_fh:
+                    while True:
+                        data = in_fh.read(self.buffer_size)
+                        if not data:
+                            break
+                        out_fh.write(data)
+            finally:
+                in_fh.close()
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+        seconds = time.time() - started
+
+        stinfo = os.stat(tmpname)
+        if self.stats is not None:
+            self.stats.observe('fetch_seconds', seconds)
+            self.stats.increment('fetch_bytes_total', stinfo.st_size)
+        return {
+            'size': stinfo.st_size,
+            'used': stinfo.st_blocks * 512,
+            'seconds': round(seconds, 3),
+        }
+
+    def _count(self, name):
+        if self.stats is not None:
+            self.stats.increment(name)
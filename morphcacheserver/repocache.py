@@ -15,11 +15,15 @@
 
 
 import cliapp
+import collections
+import logging
 import os
 import re
-import string
+import threading
 import urlparse
 
+import morphlib
+
 
 class RepositoryNotFoundError(cliapp.AppException):
 
@@ -44,76 +48,274 @@ class UnresolvedNamedReferenceError(cliapp.AppException):
                 (ref, repo))
 
 
+class FileNotFoundError(cliapp.AppException):
+
+    def __init__(self, repo, ref, filename):
+        cliapp.AppException.__init__(
+                self, 'File %s does not exist in ref %s of repo %s' %
+                (filename, ref, repo))
+
+
+class LRUCache(object):
+
+    '''A dict that forgets the least recently used items when full.
+
+    Each item has a size, and items are forgotten once the sizes add up
+    to more than ``max_size``. ``on_evict`` is called with the value of
+    every item that is forgotten.
+
+    '''
+
+    def __init__(self, max_size, on_evict=lambda value: None):
+        self.max_size = max_size
+        self.size = 0
+        self._on_evict = on_evict
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = value, size
+            return value
+
+    def put(self, key, value, size=1):
+        if size > self.max_size:
+            return
+        evicted = []
+        with self._lock:
+            if key in self._items:
+                evicted.append(self._items.pop(key))
+            self._items[key] = value, size
+            self.size += size - sum(old_size for v, old_size in evicted)
+            while self.size > self.max_size:
+                old_key, (old_value, old_size) = self._items.popitem(
+                    last=False)
+                self.size -= old_size
+                evicted.append((old_value, old_size))
+        for old_value, old_size in evicted:
+            if old_value is not value:
+                self._on_evict(old_value)
+
+
+class RepoHandle(object):
+
+    '''A repository directory, and a reader for its objects.'''
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def get_object(self, name):
+        '''Return (sha1, kind, contents) of an object, or None.
+
+        morphlib.gitdir.CatFileBatchError is raised if the object cannot
+        be read without running git separately.
+
+        '''
+
+        if '\n' in name:
+            # No object can be named like that in a cat-file request.
+            return None
+        with self._lock:
+            if self._reader is None:
+                self._reader = morphlib.gitdir.CatFileBatch(self.repo_dir)
+            reader = self._reader
+        try:
+            return reader.get(name)
+        except morphlib.gitdir.CatFileBatchError:
+            # The process may have been closed by eviction, or stopped
+            # working, so start a new one for the next request.
+            with self._lock:
+                if self._reader is reader:
+                    self._reader = None
+            reader.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+
+def _tree_entry_kind(mode):
+    if mode == '40000':
+        return 'tree'
+    elif mode == '160000':
+        return 'commit'
+    return 'blob'
+
+
 class RepoCache(object):
-    
-    def __init__(self, app, repo_cache_dir, bundle_cache_dir, direct_mode):
+
+    '''Answer questions about the git repositories in the cache.
+
+    Anything looked up by SHA1 never changes, so the answers are kept
+    in an object cache of up to ``object_cache_size`` bytes. Objects
+    are read through a long-running ``git cat-file --batch`` process for
+    each repository, and up to ``max_open_repos`` repositories are kept
+    open. Named refs are always resolved with ``git rev-parse``, since
+    they move when the cache is updated.
+
+    If ``stats`` is given, the hits and misses of the object cache are
+    counted in it.
+
+    '''
+
+    def __init__(self, app, repo_cache_dir, bundle_cache_dir, direct_mode,
+                 object_cache_size=64 * 1024 * 1024, max_open_repos=64,
+                 stats=None):
         self.app = app
         self.repo_cache_dir = repo_cache_dir
         self.bundle_cache_dir = bundle_cache_dir
         self.direct_mode = direct_mode
+        self.stats = stats
+        self._objects = LRUCache(object_cache_size)
+        self._repos = LRUCache(max_open_repos,
+                               on_evict=lambda handle: handle.close())
 
-    def resolve_ref(self, repo_url, ref):
+    @property
+    def object_cache_bytes(self):
+        return self._objects.size
+
+    @property
+    def open_repos(self):
+        return len(self._repos)
+
+    def _count(self, kind, result):
+        if self.stats is not None:
+            self.stats.increment('object_cache_requests_total',
+                                 kind=kind, result=result)
+
+    def _cached(self, kind, key, compute, size=len):
+        '''Return the cached value for key, or compute and cache it.'''
+
+        key = (kind,) + key
+        value = self._objects.get(key)
+        if value is not None:
+            self._count(kind, 'hit')
+            return value
+        self._count(kind, 'miss')
+        value = compute()
+        self._objects.put(key, value, size(value))
+        return value
+
+    def _repo(self, repo_url):
+        handle = self._repos.get(repo_url)
+        if handle is not None:
+            return handle
         quoted_url = self._quote_url(repo_url)
         repo_dir = os.path.join(self.repo_cache_dir, quoted_url)
         if not os.path.exists(repo_dir):
             repo_dir = "%s.git" % repo_dir
             if not os.path.exists(repo_dir):
                 raise RepositoryNotFoundError(repo_url)
+        handle = RepoHandle(repo_dir)
+        self._repos.put(repo_url, handle)
+        return handle
+
+    def _get_object(self, repo, name):
+        '''Return (sha1, kind, contents) of an object, or None.
+
+        Return False if the object could not be read through the
+        long-running process, in which case git should be run instead.
+
+        '''
+
         try:
-            if re.match('^[0-9a-fA-F]{40}$', ref):
-                sha1 = ref
-            else:
-                if (not self.direct_mode and
-                    not ref.startswith('refs/origin/')):
-                    ref = 'refs/origin/' + ref
-                sha1 = self._rev_parse(repo_dir, ref)
-            return sha1, self._tree_from_commit(repo_dir, sha1)
-
-        except cliapp.AppException:
-            raise
+            return repo.get_object(name)
+        except morphlib.gitdir.CatFileBatchError as e:
+            logging.warning('Cannot read %s in %s with git cat-file '
+                            '--batch: %s' % (name, repo.repo_dir, e))
+            return False
+
+    def resolve_ref(self, repo_url, ref):
+        repo = self._repo(repo_url)
+        if self._is_valid_sha1(ref):
+            sha1 = ref
+        else:
+            if (not self.direct_mode and
+                not ref.startswith('refs/origin/')):
+                ref = 'refs/origin/' + ref
+            sha1 = self._rev_parse(repo.repo_dir, ref)
+        return sha1, self._cached(
+            'tree', (repo.repo_dir, sha1),
+            lambda: self._tree_from_commit(repo, repo_url, sha1))
 
-    def _tree_from_commit(self, repo_dir, commitsha):
-        commit_info = self.app.runcmd(['git', 'log', '-1',
-                                       '--format=format:%T', commitsha],
-                                      cwd=repo_dir)
-        return commit_info.strip()
+    def _tree_from_commit(self, repo, repo_url, commitsha):
+        obj = self._get_object(repo, '%s^{tree}' % commitsha)
+        if obj is None:
+            raise InvalidReferenceError(repo_url, commitsha)
+        elif obj is False:
+            commit_info = self.app.runcmd(['git', 'log', '-1',
+                                           '--format=format:%T', commitsha],
+                                          cwd=repo.repo_dir)
+            return commit_info.strip()
+        return obj[0]
 
     def cat_file(self, repo_url, ref, filename):
-        quoted_url = self._quote_url(repo_url)
-        repo_dir = os.path.join(self.repo_cache_dir, quoted_url)
-        if not os.path.exists(repo_dir):
-            repo_dir = "%s.git" % repo_dir
-            if not os.path.exists(repo_dir):
-                raise RepositoryNotFoundError(repo_url)
+        repo = self._repo(repo_url)
         if not self._is_valid_sha1(ref):
             raise UnresolvedNamedReferenceError(repo_url, ref)
-        if not os.path.exists(repo_dir):
-            raise RepositoryNotFoundError(repo_url)
-        try:
-            sha1 = self._rev_parse(repo_dir, ref)
-        except BaseException:
-            raise InvalidReferenceError(repo_url, ref)
+        return self._cached(
+            'file', (repo.repo_dir, ref, filename),
+            lambda: self._cat_file(repo, repo_url, ref, filename))
 
-        return self._cat_file(repo_dir, sha1, filename)
+    def _cat_file(self, repo, repo_url, ref, filename):
+        obj = self._get_object(repo, '%s:%s' % (ref, filename))
+        if obj is False:
+            try:
+                sha1 = self._rev_parse(repo.repo_dir, ref)
+            except BaseException:
+                raise InvalidReferenceError(repo_url, ref)
+            return self.app.runcmd(
+                    ['git', 'cat-file', 'blob', '%s:%s' % (sha1, filename)],
+                    cwd=repo.repo_dir)
+        if obj is None or obj[1] != 'blob':
+            if self._get_object(repo, '%s^{commit}' % ref) is None:
+                raise InvalidReferenceError(repo_url, ref)
+            raise FileNotFoundError(repo_url, ref, filename)
+        return obj[2]
 
     def ls_tree(self, repo_url, ref, path):
-        quoted_url = self._quote_url(repo_url)
-        repo_dir = os.path.join(self.repo_cache_dir, quoted_url)
-        if not os.path.exists(repo_dir):
-            repo_dir = "%s.git" % repo_dir
-            if not os.path.exists(repo_dir):
-                raise RepositoryNotFoundError(repo_url)
+        repo = self._repo(repo_url)
         if not self._is_valid_sha1(ref):
             raise UnresolvedNamedReferenceError(repo_url, ref)
-        if not os.path.exists(repo_dir):
-            raise RepositoryNotFoundError(repo_url)
+        return self._cached(
+            'tree-listing', (repo.repo_dir, ref, path),
+            lambda: self._ls_tree(repo, repo_url, ref, path),
+            size=lambda data: 100 * len(data))
+
+    def _ls_tree(self, repo, repo_url, ref, path):
+        if not path:
+            obj = self._get_object(repo, '%s^{tree}' % ref)
+            if obj is None:
+                raise InvalidReferenceError(repo_url, ref)
+            elif obj is not False:
+                data = {}
+                for mode, basename, sha1 in morphlib.gitdir.parse_tree(obj[2]):
+                    data[basename] = {
+                        'mode': mode.zfill(6),
+                        'kind': _tree_entry_kind(mode),
+                        'sha1': sha1,
+                    }
+                return data
 
         try:
-            sha1 = self._rev_parse(repo_dir, ref)
+            sha1 = self._rev_parse(repo.repo_dir, ref)
         except BaseException:
             raise InvalidReferenceError(repo_url, ref)
 
-        lines = self._ls_tree(repo_dir, sha1, path).strip()
+        lines = self.app.runcmd(['git', 'ls-tree', sha1, path],
+                                cwd=repo.repo_dir).strip()
         lines = lines.splitlines()
         data = {}
         for line in lines:
@@ -137,22 +339,11 @@ class RepoCache(object):
                 quoted_url = quoted_url[1:]
             return quoted_url
         else:
-            valid_chars = string.digits + string.letters + '%_'
-            transl = lambda x: x if x in valid_chars else '_'
-            return ''.join([transl(x) for x in url])
+            return re.sub('[^0-9A-Za-z%_]', '_', url)
 
     def _rev_parse(self, repo_dir, ref):
         return self.app.runcmd(['git', 'rev-parse', '--verify', ref],
                                cwd=repo_dir)[0:40]
 
-    def _cat_file(self, repo_dir, sha1, filename):
-        return self.app.runcmd(
-                ['git', 'cat-file', 'blob', '%s:%s' % (sha1, filename)],
-                cwd=repo_dir)
-
-    def _ls_tree(self, repo_dir, sha1, path):
-        return self.app.runcmd(['git', 'ls-tree', sha1, path], cwd=repo_dir)
-
     def _is_valid_sha1(self, ref):
-        valid_chars = 'abcdefABCDEF0123456789'
-        return len(ref) == 40 and all([x in valid_chars for x in ref])
+        return re.match('^[0-9a-fA-F]{40}$', ref) is not None
@@ -0,0 +1,398 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import Queue
+import re
+import select
+import socket
+import threading
+import time
+import wsgiref.simple_server
+
+
+def _find_sendfile():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+    return sendfile
+
+_libc_sendfile = _find_sendfile()
+
+
+def sendfile(out_fd, in_fd, offset, length):
+    '''Copy length bytes from offset in in_fd to out_fd, in the kernel.
+
+    Return the number of bytes sent, which is less than length only if
+    the file is shorter than expected. Raise NotImplementedError if the
+    sendfile system call is not available.
+
+    '''
+
+    if _libc_sendfile is None:
+        raise NotImplementedError('sendfile is not available')
+    position = ctypes.c_int64(offset)
+    sent = 0
+    while sent < length:
+        n = _libc_sendfile(out_fd, in_fd, ctypes.byref(position),
+                           min(length - sent, 1 << 30))
+        if n < 0:
+            e = ctypes.get_errno()
+            if e in (errno.EINTR, errno.EAGAIN):
+                continue
+            raise OSError(e, os.strerror(e))
+        if n == 0:
+            break
+        sent += n
+    return sent
+
+
+class FileRange(object):
+
+    '''Part of an open file, which can be read like a file.
+
+    The server sends this with sendfile. Other servers read it.
+
+    '''
+
+    def __init__(self, f, offset, length):
+        self.file = f
+        self.offset = offset
+        self.length = length
+        self.position = 0
+        f.seek(offset)
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    '''Return the (offset, length) requested by a Range header.
+
+    Return None if the whole file should be sent, because there is no
+    header, or it is not a single byte range. Return False if the range
+    is outside a file of the given size.
+
+    '''
+
+    match = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        length = min(int(last), size)
+        if length == 0:
+            return False
+        return size - length, length
+    first = int(first)
+    last = size - 1 if last == '' else min(int(last), size - 1)
+    if first > last:
+        return False if first >= size else None
+    return first, last - first + 1
+
+
+def open_file_range(filename, range_header=None):
+    '''Open a file to be sent in reply to a GET request.
+
+    Return the HTTP status, a list of headers and the body. Only the
+    part of the file asked for in ``range_header`` is sent, so that
+    interrupted downloads can be resumed. IOError is raised if the file
+    cannot be opened.
+
+    '''
+
+    f = open(filename, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    headers = [('Accept-Ranges', 'bytes')]
+    requested = parse_range(range_header, size)
+    if requested is False:
+        f.close()
+        headers.append(('Content-Range', 'bytes */%d' % size))
+        return 416, headers, ''
+    elif requested is None:
+        offset, length, status = 0, size, 200
+    else:
+        offset, length = requested
+        status = 206
+        headers.append(('Content-Range', 'bytes %d-%d/%d'
+                        % (offset, offset + length - 1, size)))
+    headers.append(('Content-Length', str(length)))
+    return status, headers, FileRange(f, offset, length)
+
+
+class RequestBody(object):
+
+    '''The body of a request, which can be read like a file.
+
+    Only ``length`` bytes can be read, so that the application cannot
+    read into the next request on the connection.
+
+    '''
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def _limit(self, size):
+        if size is None or size < 0 or size > self.remaining:
+            return self.remaining
+        return size
+
+    def read(self, size=-1):
+        data = self.rfile.read(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.rfile.readline(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self, max_size):
+        '''Skip what the application did not read of the body.
+
+        Return False if that could not be done, because there was more
+        than ``max_size`` bytes of it, or the client sent less than it
+        said it would.
+
+        '''
+
+        if self.remaining > max_size:
+            return False
+        while self.remaining > 0:
+            if not self.read(min(self.remaining, 64 * 1024)):
+                return False
+        return True
+
+
+class ServerHandler(wsgiref.simple_server.ServerHandler):
+
+    '''Run a WSGI application for one request of a kept-alive connection.
+
+    Files returned through ``wsgi.file_wrapper`` are sent with sendfile.
+
+    '''
+
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        wsgiref.simple_server.ServerHandler.cleanup_headers(self)
+        # Without a length, the end of the response can only be shown
+        # by closing the connection.
+        if 'Content-Length' not in self.headers:
+            self.request_handler.close_connection = 1
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+    def handle_error(self):
+        self.request_handler.close_connection = 1
+        wsgiref.simple_server.ServerHandler.handle_error(self)
+
+    def sendfile(self):
+        filelike = self.result.filelike
+        if isinstance(filelike, FileRange):
+            offset = filelike.offset + filelike.position
+            length = filelike.length - filelike.position
+        elif isinstance(filelike, file):
+            offset = filelike.tell()
+            length = os.fstat(filelike.fileno()).st_size - offset
+        else:
+            return False
+        if _libc_sendfile is None:
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        sent = sendfile(self.request_handler.connection.fileno(),
+                        filelike.fileno(), offset, length)
+        self.bytes_sent += sent
+        if sent < length:
+            # The file was truncated while it was being sent, so the
+            # Content-Length that was sent is wrong.
+            self.request_handler.close_connection = 1
+        return True
+
+
+class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+    '''Handle the requests on an HTTP/1.1 connection until it is closed.
+
+    An idle connection holds a server thread. So that idle clients do
+    not keep other clients waiting for long, the connection is closed if
+    no new request comes within ``keepalive_timeout`` seconds of the
+    last one, or within ``busy_keepalive_timeout`` seconds if other
+    connections are waiting for a thread.
+
+    The part of a request body that the application does not read is
+    skipped before the next request, or the connection is closed if
+    there is more than ``max_unread_body`` bytes of it.
+
+    '''
+
+    protocol_version = 'HTTP/1.1'
+    keepalive_timeout = 15
+    busy_keepalive_timeout = 1
+    max_unread_body = 64 * 1024
+
+    def setup(self):
+        wsgiref.simple_server.WSGIRequestHandler.setup(self)
+        # Headers and bodies are written separately, which would
+        # otherwise be held back until the client acknowledges them.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request():
+            # Do not wait for ever for the rest of a request either.
+            self.connection.settimeout(self.keepalive_timeout)
+            self.handle_one_request()
+
+    def _wait_for_request(self):
+        '''Return whether the client started another request in time.'''
+
+        # A pipelined request may have been read already with the last.
+        buffered = getattr(self.rfile, '_rbuf', None)
+        if buffered is not None and buffered.tell() > 0:
+            return True
+        start = time.time()
+        while True:
+            idle = time.time() - start
+            if idle >= self.keepalive_timeout:
+                return False
+            if (idle >= self.busy_keepalive_timeout and
+                    self.server.connections_waiting()):
+                return False
+            timeout = min(self.busy_keepalive_timeout,
+                          self.keepalive_timeout - idle)
+            readable, writable, failed = select.select(
+                [self.connection], [], [], timeout)
+            if readable:
+                return True
+
+    def _request_body(self):
+        if 'Transfer-Encoding' in self.headers:
+            # There is no telling where a chunked body ends.
+            self.close_connection = 1
+            return RequestBody(self.rfile, 0)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = 1
+            return RequestBody(self.rfile, 0)
+        return RequestBody(self.rfile, length)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.error:
+            # The client went away, or sent nothing before the timeout.
+            self.close_connection = 1
+            return
+        self.connection.settimeout(None)
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        if self.request_version != 'HTTP/1.1':
+            self.close_connection = 1
+
+        body = self._request_body()
+        handler = ServerHandler(
+            body, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if not self.close_connection and \
+                not body.drain(self.max_unread_body):
+            self.close_connection = 1
+
+
+class ThreadPoolWSGIServer(wsgiref.simple_server.WSGIServer):
+
+    '''A WSGI server that handles connections in a pool of threads.
+
+    ``threads`` connections are handled at once. Further connections
+    wait until a thread is free. If the threads are only holding idle
+    kept-alive connections, that takes about
+    RequestHandler.busy_keepalive_timeout seconds.
+
+    '''
+
+    request_queue_size = 128
+
+    def __init__(self, server_address, threads, app,
+                 handler_class=RequestHandler):
+        wsgiref.simple_server.WSGIServer.__init__(
+            self, server_address, handler_class)
+        self.set_app(app)
+        self._requests = Queue.Queue()
+        for i in xrange(threads):
+            thread = threading.Thread(target=self._handle_requests)
+            thread.daemon = True
+            thread.start()
+
+    def connections_waiting(self):
+        '''Return whether any connections are waiting for a thread.'''
+        return not self._requests.empty()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _handle_requests(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
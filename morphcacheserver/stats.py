@@ -0,0 +1,82 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import threading
+
+
+class Stats(object):
+
+    '''Counters and timings of the cache server, for monitoring.
+
+    ``render`` returns them in the Prometheus text format. Every metric
+    name is prefixed with ``morph_cache_server_``. Counters and timings
+    may have labels, given as keyword arguments. Gauges are functions
+    that are called when the stats are rendered.
+
+    '''
+
+    prefix = 'morph_cache_server_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._gauges = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.iteritems()))
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            count, total = self._timings.get(key, (0, 0.0))
+            self._timings[key] = (count + 1, total + seconds)
+
+    def add_gauge(self, name, func):
+        self._gauges[name] = func
+
+    def _line(self, name, labels, value):
+        if labels:
+            name += '{%s}' % ','.join('%s="%s"' % label for label in labels)
+        return '%s%s %s\n' % (self.prefix, name, value)
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.iteritems())
+            timings = sorted(self._timings.iteritems())
+
+        lines = []
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s%s counter\n' % (self.prefix, name))
+            lines.append(self._line(name, labels, value))
+        for (name, labels), (count, total) in timings:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s%s summary\n' % (self.prefix, name))
+            lines.append(self._line(name + '_count', labels, count))
+            lines.append(self._line(name + '_sum', labels, '%.6f' % total))
+        for name, func in sorted(self._gauges.iteritems()):
+            lines.append('# TYPE %s%s gauge\n' % (self.prefix, name))
+            lines.append(self._line(name, (), func()))
+        return ''.join(lines)
@@ -48,6 +48,7 @@ class Error(cliapp.AppException):
 
 
 import artifact
+import artifactcacheindex
 import artifactcachereference
 import artifactresolver
 import artifactsplitrule
@@ -58,14 +59,17 @@ import buildcommand
 import buildenvironment
 import buildsystem
 import builder
+import buildscheduler
 import cachedrepo
 import cachekeycomputer
+import chunkstore
 import extensions
 import extractedtarball
 import fsutils
 import git
 import gitdir
 import gitindex
+import httpconnection
 import localartifactcache
 import localrepocache
 import mountableimage
@@ -77,6 +81,7 @@ import morphset
 import remoteartifactcache
 import remoterepocache
 import repoaliasresolver
+import resolutioncache
 import savefile
 import source
 import sourcepool
@@ -15,10 +15,12 @@
 
 
 import cliapp
+import collections
 import logging
 import os
 import pipes
 import sys
+import threading
 import time
 import urlparse
 import extensions
@@ -53,6 +55,19 @@ defaults = {
 
 class Morph(cliapp.Application):
 
+    # Builds may run in several threads at once, each with its own status
+    # prefix, so the prefix is kept per thread and output is serialised.
+    _thread_state = threading.local()
+    _output_lock = threading.Lock()
+
+    @property
+    def status_prefix(self):
+        return getattr(self._thread_state, 'status_prefix', '')
+
+    @status_prefix.setter
+    def status_prefix(self, value):
+        self._thread_state.status_prefix = value
+
     def add_settings(self):
         self.settings.boolean(['verbose', 'v'],
                               'show what is happening in much detail')
@@ -130,6 +145,36 @@ class Morph(cliapp.Application):
                               metavar='N',
                               default=defaults['max-jobs'],
                               group=group_build)
+        self.settings.integer(['max-parallel-builds'],
+                              'build up to N sources at the same time when '
+                              'they do not depend on each other; the '
+                              'max-jobs setting is shared between them '
+                              '(default: %default)',
+                              metavar='N',
+                              default=1,
+                              group=group_build)
+        self.settings.choice(['staging-backend'],
+                             ['hardlink', 'overlay'],
+                             'how to put build dependencies into staging '
+                             'areas: hardlink every chunk into each staging '
+                             'area, or mount a shared, merged layer of '
+                             'chunks with overlayfs (default: hardlink)',
+                             group=group_build)
+        self.settings.choice(['source-extraction'],
+                             ['copy', 'tree'],
+                             'how to put chunk sources into the build '
+                             'directory: copy the cached git repository and '
+                             'check out the commit, or write only the files '
+                             'in the commit, without a .git directory '
+                             '(default: copy)',
+                             group=group_build)
+        self.settings.choice(['chunk-compression'],
+                             morphlib.bins.chunk_compressions,
+                             'compress chunk artifacts as they are '
+                             'created: none, gzip, xz or zstd, which need '
+                             'the xz or zstd command; chunks are unpacked '
+                             'whatever their compression (default: none)',
+                             group=group_build)
         self.settings.boolean(['no-ccache'], 'do not use ccache',
                               group=group_build)
         self.settings.boolean(['no-distcc'],
@@ -183,6 +228,15 @@ class Morph(cliapp.Application):
                                metavar='SIZE',
                                group=group_storage,
                                default='4G')
+        self.settings.bytesize(['chunk-cache-max-size'],
+                               'keep at most SIZE bytes of unpacked chunks, '
+                               'and as much again of staging area layers, '
+                               'in tempdir for use by later builds, removing '
+                               'the least recently used ones first; 0 means '
+                               'no limit (default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='0')
         # The cachedir default size of 4G comes from twice the size of the
         # largest system artifact.
         # It's twice the size because it needs space for all the chunks that
@@ -264,6 +318,7 @@ class Morph(cliapp.Application):
 
         tmpdir = self.settings['tempdir']
         for required_dir in (os.path.join(tmpdir, 'chunks'),
+                             os.path.join(tmpdir, 'layers'),
                              os.path.join(tmpdir, 'staging'),
                              os.path.join(tmpdir, 'failed'),
                              os.path.join(tmpdir, 'deployments'),
@@ -297,30 +352,66 @@ class Morph(cliapp.Application):
                    morphlib.util.sanitise_morphology_path(args[2]))
             args = args[3:]
 
-    def cache_repo_and_submodules(self, cache, url, ref, done):
-        subs_to_process = set()
-        subs_to_process.add((url, ref))
-        while subs_to_process:
-            url, ref = subs_to_process.pop()
-            done.add((url, ref))
-            cached_repo = cache.cache_repo(url)
-            cached_repo.update()
+    def cache_repo_and_submodules(self, cache, url, ref, done,
+                                  max_workers=8):
+        '''Make sure ref and the submodule commits it uses are cached.
+
+        A repository is only updated from its remote if it does not
+        contain the commit it is needed for already. Submodules are
+        dealt with one level at a time, and the repositories of each
+        level are fetched concurrently.
+
+        ``done`` is a set of ``(url, ref)`` pairs that have been dealt
+        with already, and is added to as more are dealt with.
 
+        '''
+
+        def cache_one_repo(item):
+            url, refs = item
+            return self._cache_repo_at_refs(cache, url, refs)
+
+        todo = [(url, ref)]
+        while todo:
+            # Several submodules may use the same repository, which must
+            # only be updated by one thread.
+            refs_by_url = collections.OrderedDict()
+            for url, ref in todo:
+                if (url, ref) not in done:
+                    done.add((url, ref))
+                    refs_by_url.setdefault(url, []).append(ref)
+            results = morphlib.util.map_concurrently(
+                cache_one_repo, refs_by_url.items(), max_workers)
+            todo = [sub for subs in results for sub in subs]
+
+    def _cache_repo_at_refs(self, cache, url, refs):
+        '''Cache refs in url, returning the submodules they use.'''
+
+        cached_repo = cache.cache_repo(url)
+        submodules_used = []
+        for ref in refs:
+            if cached_repo.requires_update_for_ref(ref):
+                self.status(msg='Updating %(url)s to get %(ref)s',
+                            url=url, ref=ref, chatty=True)
+                cached_repo.update()
+
+            if '.gitmodules' not in cached_repo.list_files(ref,
+                                                           recurse=False):
+                continue
             try:
                 submodules = morphlib.git.Submodules(self, cached_repo.path,
                                                      ref)
                 submodules.load()
             except morphlib.git.NoModulesFileError:
-                pass
-            else:
-                for submod in submodules:
-                    if (submod.url, submod.commit) not in done:
-                        subs_to_process.add((submod.url, submod.commit))
+                continue
+            submodules_used.extend(
+                (submod.url, submod.commit) for submod in submodules)
+        return submodules_used
 
     def _write_status(self, text):
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
-        self.output.write('%s %s\n' % (timestamp, text))
-        self.output.flush()
+        with self._output_lock:
+            self.output.write('%s %s\n' % (timestamp, text))
+            self.output.flush()
 
     def status(self, **kwargs):
         '''Show user a status update.
@@ -0,0 +1,265 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import contextlib
+import errno
+import logging
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+
+class ArtifactCacheIndex(object):
+
+    '''An index of the files in a local artifact cache directory.
+
+    The size and last use of every file is kept in an SQLite database,
+    by the cache key its name starts with, so the files of a cache key
+    can be found, and the least recently used cache keys chosen, without
+    looking at every file in the cache. Several processes may use the
+    same index.
+
+    Files are added when they are saved through the artifact cache.
+    Files put in the directory some other way are added when they are
+    used, and by ``rebuild``, which lists the whole directory. The index
+    should be rebuilt when ``needs_rebuild`` says so. Uses of files are
+    written to the index in batches, so ``flush`` should be called
+    before the process exits.
+
+    '''
+
+    def __init__(self, filename, dirname, rebuild_interval=24 * 60 * 60,
+                 flush_count=100, flush_interval=60):
+        self.filename = filename
+        self.dirname = dirname
+        self.rebuild_interval = rebuild_interval
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._last_flush = time.time()
+        self._db = sqlite3.connect(filename, timeout=60,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        with self._transaction():
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'name TEXT PRIMARY KEY, cachekey TEXT NOT NULL, '
+                'size INTEGER NOT NULL, last_used REAL NOT NULL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS files_by_cachekey '
+                'ON files (cachekey)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS info ('
+                'key TEXT PRIMARY KEY, value)')
+
+    @contextlib.contextmanager
+    def _transaction(self, mode='IMMEDIATE'):
+        with self._lock:
+            self._db.execute('BEGIN %s' % mode)
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    @staticmethod
+    def cachekey(name):
+        '''Return the cache key of a file in the cache, or None.'''
+
+        if '.' not in name:
+            # Only files being saved have no cache key.
+            return None
+        return name.split('.', 1)[0]
+
+    def _stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.dirname, name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return st if stat.S_ISREG(st.st_mode) else None
+
+    def _row(self, name, last_used=None):
+        '''Return the row for a file in the directory, or None.'''
+
+        cachekey = self.cachekey(name)
+        st = self._stat(name)
+        if cachekey is None or st is None:
+            return None
+        return (name, cachekey, st.st_size,
+                st.st_mtime if last_used is None else last_used)
+
+    def add(self, name, last_used=None):
+        '''Add or update a file that is in the directory.'''
+
+        row = self._row(name, last_used)
+        if row is None:
+            return
+        with self._transaction():
+            self._db.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', row)
+
+    def touch(self, name):
+        '''Record that a file was used now.
+
+        Uses are remembered, and written to the index together by
+        ``flush`` once there are ``flush_count`` of them, or
+        ``flush_interval`` seconds have passed, so that using a file
+        does not usually wait for other processes using the index.
+
+        '''
+
+        now = time.time()
+        with self._lock:
+            self._touched[name] = now
+            due = (len(self._touched) >= self.flush_count or
+                   now - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        '''Write the uses recorded by ``touch`` to the index.'''
+
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._last_flush = time.time()
+        if not touched:
+            return
+        with self._transaction():
+            for name, last_used in touched.iteritems():
+                if self._db.execute(
+                        'UPDATE files SET last_used = ? WHERE name = ?',
+                        (last_used, name)).rowcount:
+                    continue
+                row = self._row(name, last_used)
+                if row is not None:
+                    self._db.execute(
+                        'INSERT INTO files VALUES (?, ?, ?, ?)', row)
+
+    def forget(self, cachekey):
+        '''Remove the files of a cache key from the index.
+
+        Return their names, so they can be removed from the directory.
+
+        '''
+
+        self.flush()
+        with self._transaction():
+            names = [name for name, in self._db.execute(
+                'SELECT name FROM files WHERE cachekey = ?', (cachekey,))]
+            self._db.execute('DELETE FROM files WHERE cachekey = ?',
+                             (cachekey,))
+        return names
+
+    def contents(self):
+        '''Return what is known about each cache key.
+
+        A list of ``(cachekey, names, last_used, size)`` tuples is
+        returned, where ``names`` is the set of the rest of each file's
+        name after the cache key, ``last_used`` the latest use of any of
+        them and ``size`` their total size in bytes.
+
+        '''
+
+        self.flush()
+        CacheInfo = collections.namedtuple(
+            'CacheInfo', ('names', 'last_used', 'size'))
+        contents = collections.OrderedDict()
+        for cachekey, name, size, last_used in self._query(
+                'SELECT cachekey, name, size, last_used FROM files '
+                'ORDER BY cachekey'):
+            names, max_last_used, total = contents.get(
+                cachekey, CacheInfo(set(), 0, 0))
+            names.add(name[len(cachekey) + 1:])
+            contents[cachekey] = CacheInfo(
+                names, max(max_last_used, last_used), total + size)
+        return [(cachekey, info.names, info.last_used, info.size)
+                for cachekey, info in contents.iteritems()]
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+        with self._transaction():
+            self._db.execute('DELETE FROM files')
+
+    def needs_rebuild(self):
+        '''Return whether the index should be made again from the files.'''
+
+        rows = self._query("SELECT value FROM info WHERE key = 'rebuilt'")
+        return not rows or rows[0][0] < time.time() - self.rebuild_interval
+
+    def rebuild(self):
+        '''Make the index again from the files in the directory.
+
+        The last use of each file is taken to be its modification time,
+        which the artifact cache updates when it is used, unless the
+        index has a later one.
+
+        The directory is listed into a temporary table first, so that
+        other processes can go on using the index meanwhile, and then
+        merged into the index. Files the listing did not see are only
+        dropped if they are no longer in the directory, so files added
+        by other processes while it ran are not lost.
+
+        '''
+
+        logging.debug('Rebuilding artifact cache index %s' % self.filename)
+        self.flush()
+        rows = []
+        for name in os.listdir(self.dirname):
+            row = self._row(name)
+            if row is not None:
+                rows.append(row)
+        # Only the temporary table is written, which does not stop other
+        # processes from writing to the index.
+        with self._transaction('DEFERRED'):
+            self._db.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS rebuilt ('
+                'name TEXT PRIMARY KEY, cachekey TEXT NOT NULL, '
+                'size INTEGER NOT NULL, last_used REAL NOT NULL)')
+            self._db.execute('DELETE FROM temp.rebuilt')
+            self._db.executemany(
+                'INSERT INTO temp.rebuilt VALUES (?, ?, ?, ?)', rows)
+        with self._transaction():
+            for name, in self._db.execute(
+                    'SELECT name FROM files WHERE name NOT IN '
+                    '(SELECT name FROM temp.rebuilt)').fetchall():
+                if self._stat(name) is None:
+                    self._db.execute('DELETE FROM files WHERE name = ?',
+                                     (name,))
+            self._db.execute(
+                'INSERT OR REPLACE INTO files '
+                'SELECT r.name, r.cachekey, r.size, '
+                'max(r.last_used, coalesce(f.last_used, 0)) '
+                'FROM temp.rebuilt AS r '
+                'LEFT JOIN files AS f ON f.name = r.name')
+            self._db.execute(
+                "INSERT OR REPLACE INTO info VALUES ('rebuilt', ?)",
+                (time.time(),))
+        with self._lock:
+            self._db.execute('DELETE FROM temp.rebuilt')
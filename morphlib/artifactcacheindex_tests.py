@@ -0,0 +1,188 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class ArtifactCacheIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'artifacts')
+        os.mkdir(self.dirname)
+        self.filename = os.path.join(self.tempdir, 'artifacts.index')
+        self.index = self.new_index()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_index(self):
+        return morphlib.artifactcacheindex.ArtifactCacheIndex(
+            self.filename, self.dirname)
+
+    def write(self, name, contents='', mtime=None):
+        filename = os.path.join(self.dirname, name)
+        with open(filename, 'w') as f:
+            f.write(contents)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+
+    def test_is_empty_at_first(self):
+        self.assertEqual(self.index.contents(), [])
+        self.assertTrue(self.index.needs_rebuild())
+
+    def test_adds_files_by_cache_key(self):
+        self.write('aaa.chunk.foo-bins', 'bins', 100)
+        self.write('aaa.build-log', 'log', 200)
+        self.write('bbb.stratum.bar', 'bar', 300)
+        for name in ('aaa.chunk.foo-bins', 'aaa.build-log',
+                     'bbb.stratum.bar'):
+            self.index.add(name)
+        self.assertEqual(self.index.contents(), [
+            ('aaa', set(['chunk.foo-bins', 'build-log']), 200, 7),
+            ('bbb', set(['stratum.bar']), 300, 3),
+        ])
+
+    def test_ignores_missing_and_temporary_files(self):
+        self.write('tmpABCDEF')
+        self.index.add('tmpABCDEF')
+        self.index.add('aaa.chunk.missing')
+        self.assertEqual(self.index.contents(), [])
+
+    def test_touch_updates_last_use(self):
+        self.write('aaa.chunk.foo', mtime=100)
+        self.index.add('aaa.chunk.foo')
+        self.index.touch('aaa.chunk.foo')
+        cachekey, names, last_used, size = self.index.contents()[0]
+        self.assertTrue(last_used > 100)
+
+    def test_touch_adds_files_not_in_index(self):
+        self.write('aaa.chunk.foo')
+        self.index.touch('aaa.chunk.foo')
+        self.assertEqual(len(self.index.contents()), 1)
+
+    def test_forget_returns_names_of_files(self):
+        self.write('aaa.chunk.foo')
+        self.write('aaa.meta')
+        self.write('bbb.chunk.bar')
+        for name in ('aaa.chunk.foo', 'aaa.meta', 'bbb.chunk.bar'):
+            self.index.add(name)
+        self.assertEqual(sorted(self.index.forget('aaa')),
+                         ['aaa.chunk.foo', 'aaa.meta'])
+        self.assertEqual([c[0] for c in self.index.contents()], ['bbb'])
+
+    def test_rebuild_finds_files_on_disk(self):
+        self.write('aaa.chunk.foo', 'foo', 100)
+        self.write('tmpABCDEF')
+        os.mkdir(os.path.join(self.dirname, 'some.dir'))
+        self.index.rebuild()
+        self.assertEqual(self.index.contents(),
+                         [('aaa', set(['chunk.foo']), 100, 3)])
+        self.assertFalse(self.index.needs_rebuild())
+
+    def test_rebuild_drops_files_not_on_disk(self):
+        self.write('aaa.chunk.foo')
+        self.index.add('aaa.chunk.foo')
+        os.remove(os.path.join(self.dirname, 'aaa.chunk.foo'))
+        self.index.rebuild()
+        self.assertEqual(self.index.contents(), [])
+
+    def test_is_shared_through_the_file(self):
+        self.write('aaa.chunk.foo')
+        self.index.add('aaa.chunk.foo')
+        self.assertEqual(len(self.new_index().contents()), 1)
+
+    def test_touch_is_written_when_flushed(self):
+        self.write('aaa.chunk.foo', mtime=100)
+        self.index.add('aaa.chunk.foo')
+        self.index.touch('aaa.chunk.foo')
+        other = self.new_index()
+        self.assertEqual(other.contents()[0][2], 100)
+        self.index.flush()
+        self.assertTrue(other.contents()[0][2] > 100)
+
+    def test_touches_are_flushed_when_there_are_enough(self):
+        self.index.flush_count = 2
+        self.write('aaa.chunk.foo')
+        self.write('bbb.chunk.bar')
+        self.index.touch('aaa.chunk.foo')
+        self.assertEqual(self.new_index().contents(), [])
+        self.index.touch('bbb.chunk.bar')
+        self.assertEqual(len(self.new_index().contents()), 2)
+
+    def test_touches_are_flushed_when_old_enough(self):
+        self.index.flush_interval = 0
+        self.write('aaa.chunk.foo')
+        self.index.touch('aaa.chunk.foo')
+        self.assertEqual(len(self.new_index().contents()), 1)
+
+    def test_flush_ignores_files_no_longer_on_disk(self):
+        self.index.touch('aaa.chunk.missing')
+        self.index.flush()
+        self.assertEqual(self.index.contents(), [])
+
+    def test_add_reports_errors_other_than_missing_files(self):
+        self.write('aaa.chunk.foo')
+        self.assertRaises(OSError, self.index.add, 'aaa.chunk.foo/bar')
+
+    def test_failed_transaction_is_rolled_back(self):
+        self.write('aaa.chunk.foo')
+
+        def add_and_fail():
+            with self.index._transaction():
+                self.index._db.execute(
+                    'INSERT INTO files VALUES (?, ?, ?, ?)',
+                    self.index._row('aaa.chunk.foo'))
+                raise RuntimeError('failed')
+
+        self.assertRaises(RuntimeError, add_and_fail)
+        self.assertEqual(self.index.contents(), [])
+
+    def test_clear_forgets_files_and_uses(self):
+        self.write('aaa.chunk.foo')
+        self.write('bbb.chunk.bar')
+        self.index.add('aaa.chunk.foo')
+        self.index.touch('bbb.chunk.bar')
+        self.index.clear()
+        self.assertEqual(self.index.contents(), [])
+
+    def test_rebuild_keeps_later_use_from_index(self):
+        self.write('aaa.chunk.foo', mtime=100)
+        self.index.touch('aaa.chunk.foo')
+        self.index.rebuild()
+        self.assertTrue(self.index.contents()[0][2] > 100)
+
+    def test_rebuild_keeps_files_added_while_listing(self):
+        self.write('aaa.chunk.foo')
+        other = self.new_index()
+        row = self.index._row
+
+        def row_and_add(name, *args):
+            # Another process saves a file after the directory was listed.
+            if name == 'aaa.chunk.foo':
+                self.write('bbb.chunk.bar')
+                other.add('bbb.chunk.bar')
+            return row(name, *args)
+
+        self.index._row = row_and_add
+        self.index.rebuild()
+        self.assertEqual([c[0] for c in self.index.contents()],
+                         ['aaa', 'bbb'])
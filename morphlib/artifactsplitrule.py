@@ -45,9 +45,12 @@ class FileMatch(Rule):
     '''
 
     def __init__(self, regexes):
-        # Possible optimisation: compile regexes as one pattern
         self._regexes = [re.compile(r) for r in regexes]
 
+    @property
+    def regexes(self):
+        return self._regexes
+
     def match(self, path):
         return any(r.match(path) for r in self._regexes)
 
@@ -109,6 +112,65 @@ class SourceAssign(Rule):
         return 'SourceAssign(%s, *)' % self._source
 
 
+class _FileMatcher(object):
+    '''Match a path against every rule of a SplitRules at once.
+
+    The FileMatch rules are compiled into one regular expression, with a
+    lookahead for each rule that captures a named group if the rule
+    matches, so one call to the regular expression engine finds every
+    rule a path matches. Python only allows 100 groups in a pattern, so
+    very many rules are split over several patterns. ValueError is
+    raised if the rules cannot be combined, because they are not all
+    FileMatch rules or use features that would mean something else in a
+    combined pattern.
+
+    '''
+
+    max_groups = 99
+
+    def __init__(self, rules):
+        self._patterns = []
+        parts = []
+        groups = []
+        group_count = 0
+        for index, (artifact, rule) in enumerate(rules):
+            if not isinstance(rule, FileMatch):
+                raise ValueError('%r is not a FileMatch' % rule)
+            for regex in rule.regexes:
+                # Inline flags apply to the whole pattern, and back
+                # references and conditional groups would refer to the
+                # groups of the combined pattern.
+                if regex.flags & ~re.UNICODE or \
+                        re.search(r'\\\d|\(\?P=|\(\?\(', regex.pattern):
+                    raise ValueError('%s cannot be combined' % regex.pattern)
+            alternatives = '|'.join('(?:%s)' % regex.pattern
+                                    for regex in rule.regexes) or '(?!)'
+            rule_groups = 1 + sum(regex.groups for regex in rule.regexes)
+            if group_count + rule_groups > self.max_groups and parts:
+                self._add_pattern(parts, groups)
+                parts, groups, group_count = [], [], 0
+            group = 'rule%d' % index
+            parts.append('(?:(?=(?P<%s>%s))|)' % (group, alternatives))
+            groups.append((group, artifact))
+            group_count += rule_groups
+        self._add_pattern(parts, groups)
+
+    def _add_pattern(self, parts, groups):
+        try:
+            regex = re.compile(''.join(parts))
+        except (re.error, AssertionError, OverflowError) as e:
+            raise ValueError(str(e))
+        self._patterns.append((regex, groups))
+
+    def match(self, path):
+        matched = []
+        for regex, groups in self._patterns:
+            m = regex.match(path)
+            matched.extend(artifact for group, artifact in groups
+                           if m.group(group) is not None)
+        return matched
+
+
 class SplitRules(collections.Iterable):
     '''Rules engine for splitting a source's artifacts.
 
@@ -124,12 +186,30 @@ class SplitRules(collections.Iterable):
 
     def __init__(self, *args):
         self._rules = list(*args)
+        self._file_matcher = None
 
     def __iter__(self):
         return iter(self._rules)
 
     def add(self, artifact, rule):
         self._rules.append((artifact, rule))
+        self._file_matcher = None
+
+    def _match_file(self):
+        '''Return a function giving the artifacts a path matches.
+
+        If all the rules match paths, they are combined so they can be
+        tried together, otherwise they are tried one by one.
+
+        '''
+
+        if self._file_matcher is None:
+            try:
+                self._file_matcher = _FileMatcher(self._rules).match
+            except ValueError:
+                self._file_matcher = lambda path: [
+                    a for a, r in self._rules if r.match(path)]
+        return self._file_matcher
 
     @property
     def artifacts(self):
@@ -157,6 +237,8 @@ class SplitRules(collections.Iterable):
 
         '''
 
+        if len(args) == 1 and isinstance(args[0], basestring):
+            return self._match_file()(args[0])
         return [a for a, r in self._rules if r.match(*args)]
 
     def partition(self, iterable):
@@ -174,7 +256,10 @@ class SplitRules(collections.Iterable):
         unmatched = set()
 
         for arg in iterable:
-            matched = self.match(arg)
+            if isinstance(arg, basestring):
+                matched = self._match_file()(arg)
+            else:
+                matched = self.match(arg)
             if len(matched) == 0:
                 unmatched.add(arg)
                 continue
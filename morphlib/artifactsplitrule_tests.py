@@ -0,0 +1,169 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+
+import morphlib
+from morphlib.artifactsplitrule import (ArtifactAssign, ArtifactMatch,
+                                        FileMatch, Rule, SourceAssign,
+                                        SplitRules)
+
+
+PATHS = [
+    '.', 'usr', 'usr/bin', 'usr/bin/foo', 'bin/sh', 'usr/lib/libfoo.so.1',
+    'usr/libexec/foo/helper', 'usr/include/foo.h', 'lib/libfoo.a',
+    'usr/share/pkgconfig/foo.pc', 'usr/share/doc/foo/README',
+    'usr/share/locale/de/foo.mo', 'etc/foo.conf', 'etc/FOO.CONF',
+]
+
+
+class SplitRulesTests(unittest.TestCase):
+
+    def one_by_one(self, rules, path):
+        return [a for a, r in rules if r.match(path)]
+
+    def assertMatchesOneByOne(self, rules):
+        for path in PATHS:
+            self.assertEqual(rules.match(path),
+                             self.one_by_one(rules, path))
+
+    def default_chunk_rules(self):
+        return morphlib.artifactsplitrule.unify_chunk_matches(
+            {'name': 'foo',
+             'products': [{'artifact': 'foo-conf',
+                           'include': [r'etc/.*\.conf']}]})
+
+    def test_default_chunk_rules_match_as_one_by_one(self):
+        self.assertMatchesOneByOne(self.default_chunk_rules())
+
+    def test_partition_gives_first_matches_and_overlaps(self):
+        rules = self.default_chunk_rules()
+        matches, overlaps, unmatched = rules.partition(PATHS)
+        self.assertEqual(matches['foo-conf'], ['etc/foo.conf'])
+        self.assertEqual(matches['foo-bins'], ['usr/bin/foo', 'bin/sh'])
+        self.assertEqual(overlaps['etc/foo.conf'],
+                         set(['foo-conf', 'foo-misc']))
+        self.assertEqual(unmatched, set())
+
+    def test_rule_with_no_patterns_matches_nothing(self):
+        rules = SplitRules()
+        rules.add('nothing', FileMatch([]))
+        rules.add('everything', FileMatch(['.*']))
+        self.assertEqual(rules.match('usr/bin/foo'), ['everything'])
+
+    def test_inline_flags_only_apply_to_their_rule(self):
+        rules = SplitRules()
+        rules.add('upper', FileMatch([r'(?i)etc/foo\.conf']))
+        rules.add('lower', FileMatch([r'etc/foo\.conf']))
+        self.assertEqual(rules.match('etc/FOO.CONF'), ['upper'])
+        self.assertMatchesOneByOne(rules)
+
+    def test_back_references_match_as_one_by_one(self):
+        rules = SplitRules()
+        rules.add('groups', FileMatch([r'(usr/)?(lib|bin)/']))
+        rules.add('repeated', FileMatch([r'(usr)/\1']))
+        self.assertMatchesOneByOne(rules)
+
+    def test_conditional_groups_match_as_one_by_one(self):
+        rules = SplitRules()
+        rules.add('groups', FileMatch([r'(usr/)?(lib|bin)/']))
+        rules.add('conditional', FileMatch([r'(usr/)?(?(1)lib|bin)/.*']))
+        self.assertEqual(rules.match('usr/bin/foo'), ['groups'])
+        self.assertEqual(rules.match('bin/sh'), ['groups', 'conditional'])
+        self.assertMatchesOneByOne(rules)
+
+    def test_rules_that_cannot_be_compiled_together_match_one_by_one(self):
+        rules = SplitRules()
+        rules.add('bins', FileMatch([r'(?P<dir>usr/)?bin/.*']))
+        rules.add('libs', FileMatch([r'(?P<dir>usr/)?lib/.*']))
+        self.assertMatchesOneByOne(rules)
+
+    def test_other_rules_match_files_one_by_one(self):
+        rules = SplitRules()
+        rules.add('bins', FileMatch([r'usr/bin/.*']))
+        rules.add('everything', Rule())
+        self.assertEqual(rules.match('usr/bin/foo'), ['bins', 'everything'])
+        self.assertEqual(rules.match('etc/foo.conf'), ['everything'])
+
+    def test_many_rules_match_as_one_by_one(self):
+        rules = SplitRules()
+        for i in xrange(150):
+            rules.add('artifact%d' % i,
+                      FileMatch([r'(usr/)?(lib|bin)/.*%d' % (i % 10)]))
+        rules.add('everything', FileMatch(['.*']))
+        self.assertMatchesOneByOne(rules)
+
+    def test_rules_added_later_are_used(self):
+        rules = SplitRules()
+        rules.add('bins', FileMatch(['usr/bin/.*']))
+        self.assertEqual(rules.match('etc/foo.conf'), [])
+        rules.add('misc', FileMatch(['.*']))
+        self.assertEqual(rules.match('etc/foo.conf'), ['misc'])
+
+    def test_artifact_rules_are_unchanged(self):
+        rules = SplitRules()
+        rules.add('foo-runtime', SourceAssign('foo'))
+        rules.add('foo-devel', ArtifactMatch(['.*-devel']))
+        self.assertEqual(rules.match(('foo', 'foo-devel')),
+                         ['foo-runtime', 'foo-devel'])
+        matches, overlaps, unmatched = rules.partition(
+            [('bar', 'bar-bins')])
+        self.assertEqual(unmatched, set([('bar', 'bar-bins')]))
+
+    def test_repr_shows_rules(self):
+        rules = SplitRules()
+        rules.add('a', FileMatch(['x', 'y']))
+        rules.add('b', ArtifactMatch(['.*-bins']))
+        rules.add('c', ArtifactAssign('foo', 'foo-libs'))
+        rules.add('d', SourceAssign('bar'))
+        self.assertEqual(
+            repr(rules),
+            'SplitRules(a=FileMatch(x|y), b=ArtifactMatch(.*-bins), '
+            'c=ArtifactAssign(foo, foo-libs), d=SourceAssign(bar, *))')
+
+
+class UnifyMatchesTests(unittest.TestCase):
+
+    def test_stratum_rules_assign_before_matching(self):
+        rules = morphlib.artifactsplitrule.unify_stratum_matches({
+            'name': 'core',
+            'chunks': [{'name': 'gcc',
+                        'artifacts': {'gcc-libs': 'core-runtime'}}],
+            'products': [{'artifact': 'core-devel',
+                          'include': ['.*-(devel|libs)']}],
+        })
+        self.assertEqual(rules.match(('gcc', 'gcc-libs')),
+                         ['core-runtime', 'core-devel', 'core-runtime'])
+        self.assertEqual(rules.match(('gcc', 'gcc-devel')),
+                         ['core-devel', 'core-runtime'])
+        self.assertEqual(rules.match(('gcc', 'gcc-bins')), ['core-runtime'])
+
+    def test_system_rules_take_strata_or_their_artifacts(self):
+        rules = morphlib.artifactsplitrule.unify_system_matches({
+            'name': 'base',
+            'strata': [{'morph': 'core'},
+                       {'name': 'tools', 'morph': 'strata/tools',
+                        'artifacts': ['tools-runtime']}],
+        })
+        self.assertEqual(rules.match(('core', 'core-devel')),
+                         ['base-rootfs'])
+        self.assertEqual(rules.match(('tools', 'tools-runtime')),
+                         ['base-rootfs'])
+        self.assertEqual(rules.match(('tools', 'tools-devel')), [])
+
+    def test_cluster_rules_match_nothing(self):
+        rules = morphlib.artifactsplitrule.unify_cluster_matches({})
+        self.assertEqual(list(rules), [])
@@ -22,13 +22,16 @@ Binaries are chunks, strata, and system images.
 
 
 import cliapp
+import collections
 import logging
 import os
 import sys
 import re
 import errno
+import gzip
 import stat
 import shutil
+import subprocess
 import tarfile
 
 import morphlib
@@ -79,51 +82,207 @@ if sys.version_info < (2, 7, 3): # pragma: no cover
                 raise ExtractError("could not change owner")
     tarfile.TarFile.chown = fixed_chown
 
-def create_chunk(rootdir, f, include, dump_memory_profile=None):
-    '''Create a chunk from the contents of a directory.
-    
-    ``f`` is an open file handle, to which the tar file is written.
+# Chunk artifacts may be compressed. gzip is done in Python; xz and
+# zstd are done by running the command, as Python 2 has no module for
+# them. Compressed chunks are recognised by their first bytes when they
+# are unpacked, so they can be mixed freely with uncompressed ones.
+chunk_compressions = ['none', 'gzip', 'xz', 'zstd']
 
-    '''
+_compress_commands = {
+    'xz': ['xz', '--compress', '--stdout'],
+    'zstd': ['zstd', '--compress', '--stdout', '--quiet'],
+}
 
-    dump_memory_profile = dump_memory_profile or (lambda msg: None)
+_decompress_commands = {
+    'xz': ['xz', '--decompress', '--stdout'],
+    'zstd': ['zstd', '--decompress', '--stdout', '--quiet'],
+}
 
-    # This timestamp is used to normalize the mtime for every file in
-    # chunk artifact. This is useful to avoid problems from smallish
-    # clock skew. It needs to be recent enough, however, that GNU tar
-    # does not complain about an implausibly old timestamp.
-    normalized_timestamp = 683074800
+_magic_numbers = [
+    ('\x1f\x8b', 'gzip'),
+    ('\xfd7zXZ\x00', 'xz'),
+    ('\x28\xb5\x2f\xfd', 'zstd'),
+]
 
-    dump_memory_profile('at beginning of create_chunk')
-    
-    path_pairs = [(relname, os.path.join(rootdir, relname))
-                  for relname in include]
-    tar = tarfile.open(fileobj=f, mode='w')
-    for relname, filename in path_pairs:
+
+class CompressionError(cliapp.AppException):
+
+    def __init__(self, argv, returncode):
+        cliapp.AppException.__init__(
+            self, '%s failed with exit code %s' % (argv[0], returncode))
+
+
+def detect_compression(f):
+    '''Return the compression used in a binary, from its first bytes.
+
+    ``f`` is left where it was. If it cannot seek, 'none' is returned.
+
+    '''
+
+    try:
+        position = f.tell()
+        start = f.read(6)
+        f.seek(position)
+    except (AttributeError, IOError):
+        return 'none'
+    for magic, compression in _magic_numbers:
+        if start.startswith(magic):
+            return compression
+    return 'none'
+
+
+def _wait_for(process, argv):
+    returncode = process.wait()
+    if returncode != 0:
+        raise CompressionError(argv, returncode)
+
+
+# This timestamp is used to normalize the mtime for every file in
+# chunk artifact. This is useful to avoid problems from smallish
+# clock skew. It needs to be recent enough, however, that GNU tar
+# does not complain about an implausibly old timestamp.
+normalized_timestamp = 683074800
+
+
+class _ChunkWriter(object):
+
+    '''A chunk being written as a tar file to an open file handle.'''
+
+    def __init__(self, f, compression):
+        self.f = f
+        self.process = None
+        if compression == 'none':
+            self.out = f
+        elif compression == 'gzip':
+            # The file name and time are left out of the gzip header, so
+            # the same files give the same artifact.
+            self.out = gzip.GzipFile(filename='', mode='wb',
+                                     compresslevel=6, fileobj=f, mtime=0)
+        else:
+            self.argv = _compress_commands[compression]
+            f.flush()
+            self.process = subprocess.Popen(
+                self.argv, stdin=subprocess.PIPE, stdout=f, close_fds=True)
+            self.out = self.process.stdin
+        self.tar = tarfile.open(fileobj=self.out,
+                                mode='w|' if self.process else 'w')
+
+    def gettarinfo(self, filename, relname):
+        tarinfo = self.tar.gettarinfo(filename, arcname=relname)
         # Normalize mtime for everything.
-        tarinfo = tar.gettarinfo(filename,
-                                 arcname=relname)
         tarinfo.ctime = normalized_timestamp
         tarinfo.mtime = normalized_timestamp
+        return tarinfo
+
+    def add(self, tarinfo, filename):
         if tarinfo.isreg():
-            with open(filename, 'rb') as f:
-                tar.addfile(tarinfo, fileobj=f)
+            with open(filename, 'rb') as member:
+                self.tar.addfile(tarinfo, fileobj=member)
         else:
-            tar.addfile(tarinfo)
-    tar.close()
+            self.tar.addfile(tarinfo)
+
+    def close(self, finish=True):
+        try:
+            if finish:
+                self.tar.close()
+            elif self.process is not None:
+                # Otherwise the abandoned stream tries to write its end
+                # to the closed pipe when it is garbage collected.
+                self.tar.fileobj.closed = True
+        finally:
+            if self.out is not self.f:
+                self.out.close()
+            if self.process is not None:
+                _wait_for(self.process, self.argv)
+
+
+def create_chunks(rootdir, chunks, dump_memory_profile=None,
+                  compression='none'):
+    '''Create several chunks from the contents of a directory at once.
+
+    ``chunks`` is a list of ``(f, include)`` pairs: each chunk is
+    written to the open file handle ``f`` and holds the files named in
+    ``include``, relative to ``rootdir``. The directory is gone through
+    once, in sorted order, and each file is added to every chunk that
+    includes it as it is reached. A file is only looked at again if it
+    goes into more than one chunk and may be a hard link, so the
+    directories shared by the chunks are looked at once. Chunks are
+    compressed as they are written, as with ``create_chunk``. The files
+    are not removed; use ``remove_chunk_files`` for that.
 
-    for relname, filename in reversed(path_pairs):
+    '''
+
+    dump_memory_profile = dump_memory_profile or (lambda msg: None)
+    dump_memory_profile('at beginning of create_chunks')
+
+    writers = []
+    chunks_by_path = collections.defaultdict(list)
+    finished = False
+    try:
+        for f, include in chunks:
+            writer = _ChunkWriter(f, compression)
+            writers.append(writer)
+            for relname in include:
+                chunks_by_path[relname].append(writer)
+
+        for relname in sorted(chunks_by_path):
+            filename = os.path.join(rootdir, relname)
+            tarinfo = None
+            for writer in chunks_by_path[relname]:
+                # Whether a file is a hard link depends on what is
+                # already in the chunk.
+                if tarinfo is None or tarinfo.isreg() or tarinfo.islnk():
+                    tarinfo = writer.gettarinfo(filename, relname)
+                writer.add(tarinfo, filename)
+        finished = True
+    finally:
+        errors = []
+        for writer in writers:
+            try:
+                writer.close(finished)
+            except (CompressionError, IOError, OSError) as e:
+                errors.append(e)
+        if finished and errors:
+            raise errors[0]
+    dump_memory_profile('after creating chunks')
+
+
+def remove_chunk_files(rootdir, include):
+    '''Remove the files put in chunks, leaving only directories.'''
+
+    for relname in include:
+        filename = os.path.join(rootdir, relname)
         if os.path.isdir(filename) and not os.path.islink(filename):
             continue
         else:
             os.remove(filename)
+
+
+def create_chunk(rootdir, f, include, dump_memory_profile=None,
+                 compression='none'):
+    '''Create a chunk from the contents of a directory.
+    
+    ``f`` is an open file handle, to which the tar file is written. It is
+    compressed as it is written if ``compression`` is one of
+    ``chunk_compressions`` other than 'none'. The output must then be a
+    real file, rather than a file-like object, unless it is 'gzip'. The
+    files put in the chunk are removed afterwards.
+
+    '''
+
+    dump_memory_profile = dump_memory_profile or (lambda msg: None)
+
+    dump_memory_profile('at beginning of create_chunk')
+    create_chunks(rootdir, [(f, include)], compression=compression)
+    remove_chunk_files(rootdir, include)
     dump_memory_profile('after removing in create_chunks')
 
 
 def unpack_binary_from_file(f, dirname):  # pragma: no cover
     '''Unpack a binary into a directory.
 
-    The directory must exist already.
+    The directory must exist already. Binaries compressed with any of
+    ``chunk_compressions`` are decompressed as they are unpacked.
 
     '''
 
@@ -196,7 +355,18 @@ def unpack_binary_from_file(f, dirname):  # pragma: no cover
                 return ret
         return make_something
 
-    tf = tarfile.open(fileobj=f, errorlevel=2)
+    process = None
+    compression = detect_compression(f)
+    if compression in _decompress_commands:
+        argv = _decompress_commands[compression]
+        # The command reads from the file descriptor, so it must be
+        # where the file object is, whatever was buffered.
+        os.lseek(f.fileno(), f.tell(), os.SEEK_SET)
+        process = subprocess.Popen(argv, stdin=f, stdout=subprocess.PIPE,
+                                   close_fds=True)
+        tf = tarfile.open(fileobj=process.stdout, mode='r|', errorlevel=2)
+    else:
+        tf = tarfile.open(fileobj=f, errorlevel=2)
     tf.makedir = monkey_patcher(tf.makedir)
     tf.makefile = monkey_patcher(tf.makefile)
     tf.makeunknown = monkey_patcher(tf.makeunknown)
@@ -208,6 +378,13 @@ def unpack_binary_from_file(f, dirname):  # pragma: no cover
         tf.extractall(path=dirname)
     finally:
         tf.close()
+        if process is not None:
+            # Read whatever follows the end of the archive, so the
+            # command does not fail writing it.
+            while process.stdout.read(1024 * 1024):
+                pass
+            process.stdout.close()
+            _wait_for(process, argv)
 
 
 def unpack_binary(filename, dirname):
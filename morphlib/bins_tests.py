@@ -107,9 +107,10 @@ class ChunkTests(BinsTest):
 
         self.instdir_orig_files = self.recursive_lstat(self.instdir)
 
-    def create_chunk(self, includes):
+    def create_chunk(self, includes, compression='none'):
         self.populate_instdir()
-        morphlib.bins.create_chunk(self.instdir, self.chunk_f, includes)
+        morphlib.bins.create_chunk(self.instdir, self.chunk_f, includes,
+                                   compression=compression)
         self.chunk_f.flush()
 
     def unpack_chunk(self):
@@ -141,6 +142,91 @@ class ChunkTests(BinsTest):
         self.assertRaises(IOError, f.read)
         f.close()
 
+    def test_creates_and_unpacks_gzip_chunk_exactly(self):
+        self.create_chunk(['bin', 'bin/foo', 'lib', 'lib/libfoo.so'],
+                          compression='gzip')
+        with open(self.chunk_file, 'rb') as f:
+            self.assertEqual(morphlib.bins.detect_compression(f), 'gzip')
+        self.unpack_chunk()
+        self.assertEqual(self.instdir_orig_files,
+                         self.recursive_lstat(self.unpacked))
+
+    def test_creates_and_unpacks_xz_chunk_exactly(self):
+        self.create_chunk(['bin', 'bin/foo', 'lib', 'lib/libfoo.so'],
+                          compression='xz')
+        with open(self.chunk_file, 'rb') as f:
+            self.assertEqual(morphlib.bins.detect_compression(f), 'xz')
+        self.unpack_chunk()
+        self.assertEqual(self.instdir_orig_files,
+                         self.recursive_lstat(self.unpacked))
+
+    def test_creates_several_chunks_at_once(self):
+        self.populate_instdir()
+        os.link(os.path.join(self.instdir, 'bin', 'foo'),
+                os.path.join(self.instdir, 'lib', 'foo'))
+        lib_file = os.path.join(self.tempdir, 'lib-chunk')
+        with open(lib_file, 'wb') as lib_f:
+            morphlib.bins.create_chunks(
+                self.instdir, [(self.chunk_f, ['bin', 'bin/foo']),
+                               (lib_f, ['lib', 'lib/foo', 'lib/libfoo.so'])])
+        self.chunk_f.flush()
+
+        self.unpack_chunk()
+        self.assertEqual([x for x, y in self.recursive_lstat(self.unpacked)],
+                         ['.', 'bin', 'bin/foo'])
+        shutil.rmtree(self.unpacked)
+        os.mkdir(self.unpacked)
+        morphlib.bins.unpack_binary(lib_file, self.unpacked)
+        self.assertEqual([x for x, y in self.recursive_lstat(self.unpacked)],
+                         ['.', 'lib', 'lib/foo', 'lib/libfoo.so'])
+
+    def test_remove_chunk_files_leaves_directories(self):
+        self.populate_instdir()
+        morphlib.bins.remove_chunk_files(self.instdir,
+                                         ['bin', 'bin/foo', 'lib'])
+        self.assertEqual([x for x, y in self.recursive_lstat(self.instdir)],
+                         ['.', 'bin', 'lib', 'lib/libfoo.so'])
+
+    def test_detects_uncompressed_chunk(self):
+        self.create_chunk(['bin'])
+        with open(self.chunk_file, 'rb') as f:
+            self.assertEqual(morphlib.bins.detect_compression(f), 'none')
+            self.assertEqual(f.tell(), 0)
+
+
+    def test_cannot_detect_compression_of_a_pipe(self):
+        read_fd, write_fd = os.pipe()
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            self.assertEqual(morphlib.bins.detect_compression(f), 'none')
+
+    def test_reports_failed_compression(self):
+        morphlib.bins._compress_commands['failing'] = [
+            'sh', '-c', 'cat >/dev/null; exit 3']
+        try:
+            self.assertRaises(morphlib.bins.CompressionError,
+                              self.create_chunk, ['bin', 'bin/foo'],
+                              compression='failing')
+        finally:
+            del morphlib.bins._compress_commands['failing']
+
+    def test_reports_first_error_rather_than_failed_compression(self):
+        # Compression fails when a chunk is abandoned half written, but
+        # what went wrong before that is what should be reported.
+        self.populate_instdir()
+        morphlib.bins._compress_commands['failing'] = [
+            'sh', '-c', 'cat >/dev/null; exit 3']
+        lib_file = os.path.join(self.tempdir, 'lib-chunk')
+        try:
+            with open(lib_file, 'wb') as lib_f:
+                self.assertRaises(
+                    OSError, morphlib.bins.create_chunks, self.instdir,
+                    [(self.chunk_f, ['bin', 'bin/foo']),
+                     (lib_f, ['lib', 'lib/no-such-file'])],
+                    compression='failing')
+        finally:
+            del morphlib.bins._compress_commands['failing']
+
 
 class ExtractTests(unittest.TestCase):
 
@@ -16,10 +16,10 @@
 
 import itertools
 import os
-import shutil
 import logging
 import tempfile
 import datetime
+import threading
 
 import morphlib
 import distbuild
@@ -49,6 +49,13 @@ class BuildCommand(object):
         self.app = app
         self.lac, self.rac = self.new_artifact_caches()
         self.lrc, self.rrc = self.new_repo_caches()
+        self._cache_keys = None
+        self._resolution_cache = None
+        self._cached_submodules = set()
+
+        # Held while updating the git and artifact caches, which are not
+        # safe to modify from several builds at once.
+        self._cache_lock = threading.RLock()
 
     def build(self, repo_name, ref, filename, original_ref=None):
         '''Build a given system morphology.'''
@@ -58,11 +65,14 @@ class BuildCommand(object):
             repo_name=repo_name, ref=ref, filename=filename)
 
         self.app.status(msg='Deciding on task order')
-        srcpool = self.create_source_pool(
-            repo_name, ref, filename, original_ref)
-        self.validate_sources(srcpool)
-        root_artifact = self.resolve_artifacts(srcpool)
-        self.build_in_order(root_artifact)
+        try:
+            srcpool = self.create_source_pool(
+                repo_name, ref, filename, original_ref)
+            self.validate_sources(srcpool)
+            root_artifact = self.resolve_artifacts(srcpool)
+            self.build_in_order(root_artifact)
+        finally:
+            self.lrc.close()
 
         self.app.status(
             msg='Build of %(repo_name)s %(ref)s %(filename)s ended '
@@ -94,11 +104,15 @@ class BuildCommand(object):
 
         '''
         self.app.status(msg='Creating source pool', chatty=True)
+        if self._resolution_cache is None:
+            self._resolution_cache = morphlib.util.new_resolution_cache(
+                self.app.settings)
         srcpool = morphlib.sourceresolver.create_source_pool(
             self.lrc, self.rrc, repo_name, ref, filename,
             original_ref=original_ref,
             update_repos=not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            resolution_cache=self._resolution_cache)
         return srcpool
 
     def validate_sources(self, srcpool):
@@ -165,11 +179,16 @@ class BuildCommand(object):
         build_env = self.new_build_env(arch)
 
         self.app.status(msg='Computing cache keys', chatty=True)
-        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+        if self._cache_keys is None:
+            self._cache_keys = morphlib.util.new_cache_key_store(
+                self.app.settings)
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(
+            build_env, self._cache_keys)
 
         for source in set(a.source for a in root_artifact.walk()):
             source.cache_key = ckc.compute_key(source)
             source.cache_id = ckc.get_cache_id(source)
+        self._cache_keys.save()
 
         root_artifact.build_env = build_env
 
@@ -269,25 +288,39 @@ class BuildCommand(object):
                 yield artifact.source
 
     def build_in_order(self, root_artifact):
-        '''Build everything specified in a build order.'''
+        '''Build everything specified in a build order.
+
+        If the max-parallel-builds setting allows it, sources that do
+        not depend on each other are built at the same time.
+
+        '''
 
         self.app.status(msg='Building a set of sources', chatty=True)
         build_env = root_artifact.build_env
         ordered_sources = list(self.get_ordered_sources(root_artifact.walk()))
         old_prefix = self.app.status_prefix
-        for i, s in enumerate(ordered_sources):
+
+        def build(index, source, max_jobs):
             self.app.status_prefix = (
                 old_prefix + '[Build %(index)d/%(total)d] [%(name)s] ' % {
-                    'index': (i+1),
+                    'index': (index+1),
                     'total': len(ordered_sources),
-                    'name': s.name,
+                    'name': source.name,
                 })
+            self.cache_or_build_source(source, build_env, max_jobs)
 
-            self.cache_or_build_source(s, build_env)
+        max_parallel = self.app.settings['max-parallel-builds']
+        if max_parallel > 1:
+            scheduler = morphlib.buildscheduler.BuildScheduler(
+                ordered_sources, max_parallel, self.app.settings['max-jobs'])
+            scheduler.run(build)
+        else:
+            for i, s in enumerate(ordered_sources):
+                build(i, s, self.app.settings['max-jobs'])
 
         self.app.status_prefix = old_prefix
 
-    def cache_or_build_source(self, source, build_env):
+    def cache_or_build_source(self, source, build_env, max_jobs=None):
         '''Make artifacts of the built source available in the local cache.
 
         This can be done by retrieving from a remote artifact cache, or if
@@ -297,13 +330,14 @@ class BuildCommand(object):
         artifacts = source.artifacts.values()
         if self.rac is not None:
             try:
-                self.cache_artifacts_locally(artifacts)
+                with self._cache_lock:
+                    self.cache_artifacts_locally(artifacts)
             except morphlib.remoteartifactcache.GetError:
                 # Error is logged by the RemoteArtifactCache object.
                 pass
 
         if any(not self.lac.has(artifact) for artifact in artifacts):
-            self.build_source(source, build_env)
+            self.build_source(source, build_env, max_jobs)
 
         for a in artifacts:
             self.app.status(msg='%(kind)s %(name)s is cached at %(cachepath)s',
@@ -311,25 +345,28 @@ class BuildCommand(object):
                             cachepath=self.lac.artifact_filename(a),
                             chatty=(source.morphology['kind'] != "system"))
 
-    def build_source(self, source, build_env):
+    def build_source(self, source, build_env, max_jobs=None):
         '''Build all artifacts for one source.
 
         All the dependencies are assumed to be built and available
         in either the local or remote cache already.
 
+        If ``max_jobs`` is not given, the max-jobs setting is used.
+
         '''
         starttime = datetime.datetime.now()
         self.app.status(msg='Building %(kind)s %(name)s',
                         name=source.name,
                         kind=source.morphology['kind'])
 
-        self.fetch_sources(source)
         # TODO: Make an artifact.walk() that takes multiple root artifacts.
         # as this does a walk for every artifact. This was the status
         # quo before build logic was made to work per-source, but we can
         # now do better.
         deps = self.get_recursive_deps(source.artifacts.values())
-        self.cache_artifacts_locally(deps)
+        with self._cache_lock:
+            self.fetch_sources(source)
+            self.cache_artifacts_locally(deps)
 
         use_chroot = False
         setup_mounts = False
@@ -363,7 +400,7 @@ class BuildCommand(object):
         else:
             staging_area = self.create_staging_area(build_env, False)
 
-        self.build_and_cache(staging_area, source, setup_mounts)
+        self.build_and_cache(staging_area, source, setup_mounts, max_jobs)
         self.remove_staging_area(staging_area)
 
         td = datetime.datetime.now() - starttime
@@ -414,55 +451,43 @@ class BuildCommand(object):
                             repo_name=repo_name)
             source.repo = self.lrc.cache_repo(repo_name)
 
-        # Update submodules.
-        done = set()
+        # Update submodules. Commits never change, so any repository
+        # and commit that was dealt with for an earlier source need not
+        # be looked at again.
         self.app.cache_repo_and_submodules(
             self.lrc, source.repo.url,
-            source.sha1, done)
+            source.sha1, self._cached_submodules)
 
     def cache_artifacts_locally(self, artifacts):
-        '''Get artifacts missing from local cache from remote cache.'''
+        '''Get artifacts missing from local cache from remote cache.
 
-        def fetch_files(to_fetch):
-            '''Fetch a set of files atomically.
+        All the missing files are fetched in one batch, see
+        RemoteArtifactCache.fetch_artifacts. Each artifact is fetched
+        atomically along with its metadata, to ensure integrity of the
+        local cache.
 
-            If an error occurs during the transfer of any files, all downloaded
-            data is deleted, to ensure integrity of the local cache.
-
-            '''
-            try:
-                for remote, local in to_fetch:
-                    shutil.copyfileobj(remote, local)
-            except BaseException:
-                for remote, local in to_fetch:
-                    local.abort()
-                raise
-            else:
-                for remote, local in to_fetch:
-                    remote.close()
-                    local.close()
+        '''
 
+        to_fetch = []
         for artifact in artifacts:
-            # This block should fetch all artifact files in one go, using the
-            # 1.0/artifacts method of morph-cache-server. The code to do that
-            # needs bringing in from the distbuild.worker_build_connection
-            # module into morphlib.remoteartififactcache first.
-            to_fetch = []
-            if not self.lac.has(artifact):
-                to_fetch.append((self.rac.get(artifact),
-                                 self.lac.put(artifact)))
-
+            metadata_names = []
             if artifact.source.morphology.needs_artifact_metadata_cached:
-                if not self.lac.has_artifact_metadata(artifact, 'meta'):
-                    to_fetch.append((
-                        self.rac.get_artifact_metadata(artifact, 'meta'),
-                        self.lac.put_artifact_metadata(artifact, 'meta')))
-
-            if len(to_fetch) > 0:
+                metadata_names.append('meta')
+            if (not self.lac.has(artifact) or
+                    any(not self.lac.has_artifact_metadata(artifact, name)
+                        for name in metadata_names)):
+                to_fetch.append((artifact, metadata_names))
+
+        if len(to_fetch) > 0:
+            for artifact, metadata_names in to_fetch:
                 self.app.status(
                     msg='Fetching to local cache: artifact %(name)s',
-                    name=artifact.name)
-                fetch_files(to_fetch)
+                    name=artifact.name, chatty=(len(to_fetch) > 1))
+            if len(to_fetch) > 1:
+                self.app.status(
+                    msg='Fetching %(count)d artifacts to local cache',
+                    count=len(to_fetch))
+            self.rac.fetch_artifacts(self.lac, to_fetch)
 
     def create_staging_area(self, build_env, use_chroot=True, extra_env={},
                             extra_path=[]):
@@ -471,7 +496,11 @@ class BuildCommand(object):
         self.app.status(msg='Creating staging area')
         staging_dir = tempfile.mkdtemp(
             dir=os.path.join(self.app.settings['tempdir'], 'staging'))
-        staging_area = morphlib.stagingarea.StagingArea(
+        if self.app.settings['staging-backend'] == 'overlay':
+            staging_area_class = morphlib.stagingarea.OverlayStagingArea
+        else:
+            staging_area_class = morphlib.stagingarea.StagingArea
+        staging_area = staging_area_class(
             self.app, staging_dir, build_env, use_chroot, extra_env,
             extra_path)
         return staging_area
@@ -513,6 +542,7 @@ class BuildCommand(object):
 
         '''
 
+        handles = []
         for artifact in artifacts:
             if artifact.source.morphology['kind'] != 'chunk':
                 continue
@@ -524,21 +554,28 @@ class BuildCommand(object):
                 chunk_name=artifact.name,
                 cache=artifact.source.cache_key[:7],
                 chatty=True)
-            handle = self.lac.get(artifact)
-            staging_area.install_artifact(handle)
+            handles.append(self.lac.get(artifact))
+        try:
+            staging_area.install_artifacts(handles)
+        finally:
+            for handle in handles:
+                handle.close()
 
         if target_source.build_mode == 'staging':
             morphlib.builder.ldconfig(self.app.runcmd, staging_area.dirname)
 
-    def build_and_cache(self, staging_area, source, setup_mounts):
+    def build_and_cache(self, staging_area, source, setup_mounts,
+                        max_jobs=None):
         '''Build a source and put its artifacts into the local cache.'''
 
         self.app.status(msg='Starting actual build: %(name)s '
                             '%(sha1)s',
                         name=source.name, sha1=source.sha1[:7])
+        if max_jobs is None:
+            max_jobs = self.app.settings['max-jobs']
         builder = morphlib.builder.Builder(
             self.app, staging_area, self.lac, self.rac, self.lrc,
-            self.app.settings['max-jobs'], setup_mounts)
+            max_jobs, setup_mounts)
         return builder.build_and_cache(source)
 
 class InitiatorBuildCommand(BuildCommand):
@@ -43,8 +43,15 @@ def extract_sources(app, repo_cache, repo, sha1, srcdir): #pragma: no cover
                    source=repo.original_name,
                    target=destdir)
 
-        repo.checkout(sha1, destdir)
-        morphlib.git.reset_workdir(app.runcmd, destdir)
+        if (app.settings['source-extraction'] == 'tree' and
+                '.gitfat' not in repo.list_files(sha1, recurse=False)):
+            # Only the files are needed, so there is no need to copy the
+            # whole repository. Repositories using git-fat still need a
+            # real checkout for git-fat to fetch the large files into.
+            repo.extract_tree(sha1, destdir)
+        else:
+            repo.checkout(sha1, destdir)
+            morphlib.git.reset_workdir(app.runcmd, destdir)
         submodules = morphlib.git.Submodules(app, repo.path, sha1)
         try:
             submodules.load()
@@ -247,6 +254,12 @@ class ChunkBuilder(BuilderBase):
 
     '''Build chunk artifacts.'''
 
+    def create_metadata(self, artifact_name,
+                        contents=[]): # pragma: no cover
+        meta = BuilderBase.create_metadata(self, artifact_name, contents)
+        meta['compression'] = self.app.settings['chunk-compression']
+        return meta
+
     def create_devices(self, destdir): # pragma: no cover
         '''Creates device nodes if the morphology specifies them'''
         morphology = self.source.morphology
@@ -437,37 +450,59 @@ class ChunkBuilder(BuilderBase):
 
         system_integration = morphology.get(sys_tag) or {}
 
+        def all_parents(path):
+            while path != '':
+                yield path
+                path = os.path.dirname(path)
+
+        def parentify(filenames):
+            names = set()
+            for name in filenames:
+                names.update(all_parents(name))
+            return sorted(names)
+
         with self.build_watch('create-chunks'):
-            for chunk_artifact_name, chunk_artifact \
-                in source.artifacts.iteritems():
-                file_paths = matches[chunk_artifact_name]
-                chunk_artifact = source.artifacts[chunk_artifact_name]
-
-                def all_parents(path):
-                    while path != '':
-                        yield path
-                        path = os.path.dirname(path)
-
-                def parentify(filenames):
-                    names = set()
-                    for name in filenames:
-                        names.update(all_parents(name))
-                    return sorted(names)
-
-                extra_files = self.write_system_integration_commands(
-                                  destdir, system_integration,
-                                  chunk_artifact_name)
-                extra_files += ['baserock/%s.meta' % chunk_artifact_name]
-                parented_paths = parentify(file_paths + extra_files)
-
-                with self.local_artifact_cache.put(chunk_artifact) as f:
+            chunk_paths = []
+            with self.build_watch('write-chunk-metadata'):
+                for chunk_artifact_name, chunk_artifact \
+                    in source.artifacts.iteritems():
+                    file_paths = matches[chunk_artifact_name]
+
+                    extra_files = self.write_system_integration_commands(
+                                      destdir, system_integration,
+                                      chunk_artifact_name)
+                    extra_files += ['baserock/%s.meta' % chunk_artifact_name]
+                    parented_paths = parentify(file_paths + extra_files)
+
                     self.write_metadata(destdir, chunk_artifact_name,
                                         parented_paths)
+                    chunk_paths.append((chunk_artifact, parented_paths))
+
+            # All the chunks are written at once, in one pass over
+            # DESTDIR, rather than going through it for each chunk.
+            with self.build_watch('pack-chunks'):
+                self.app.status(msg='Creating chunk artifacts %(names)s',
+                                names=', '.join(a.name
+                                                for a, p in chunk_paths))
+                handles = []
+                try:
+                    for chunk_artifact, parented_paths in chunk_paths:
+                        handles.append(
+                            self.local_artifact_cache.put(chunk_artifact))
+                    morphlib.bins.create_chunks(
+                        destdir, zip(handles, (p for a, p in chunk_paths)),
+                        compression=self.app.settings['chunk-compression'])
+                except BaseException:
+                    for handle in handles:
+                        handle.abort()
+                    raise
+                for handle in handles:
+                    handle.close()
+                built_artifacts.extend(a for a, p in chunk_paths)
 
-                    self.app.status(msg='Creating chunk artifact %(name)s',
-                                    name=chunk_artifact_name)
-                    morphlib.bins.create_chunk(destdir, f, parented_paths)
-                built_artifacts.append(chunk_artifact)
+            with self.build_watch('remove-chunk-files'):
+                for chunk_artifact, parented_paths in chunk_paths:
+                    morphlib.bins.remove_chunk_files(destdir, parented_paths)
 
         for dirname, subdirs, files in os.walk(destdir):
             if files:
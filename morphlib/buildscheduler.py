@@ -0,0 +1,144 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import Queue
+import sys
+import threading
+
+
+class BuildScheduler(object):
+
+    '''Build independent sources concurrently, in dependency order.
+
+    ``sources`` is a list of Source objects in a valid build order, as
+    returned by ``BuildCommand.get_ordered_sources``. A source becomes
+    ready to build once every source it depends on (via the artifacts in
+    its ``dependencies`` list) has been built. Dependencies on sources
+    that are not in the list are assumed to be satisfied already.
+
+    At most ``max_parallel`` builds run at the same time. The ``max_jobs``
+    value is treated as a budget shared between the running builds: each
+    build is given a share of whatever is not in use by the builds that
+    are already running when it starts, and gives it back when it ends.
+    Every build gets at least one job.
+
+    Builds are started in the order of the ``sources`` list, so with
+    ``max_parallel`` set to 1 this is the same as building in order.
+
+    '''
+
+    def __init__(self, sources, max_parallel, max_jobs):
+        self.sources = list(sources)
+        self.max_parallel = max(1, max_parallel)
+        self.max_jobs = max(1, max_jobs)
+
+        self._index = dict((s, i) for i, s in enumerate(self.sources))
+        self._pending = {}
+        self._dependents = dict((s, []) for s in self.sources)
+        for source in self.sources:
+            deps = set(a.source for a in source.dependencies)
+            deps = [d for d in deps if d in self._index and d is not source]
+            self._pending[source] = len(deps)
+            for dep in deps:
+                self._dependents[dep].append(source)
+
+        self._ready = sorted((s for s in self.sources
+                              if self._pending[s] == 0),
+                             key=self._index.get)
+        self._running = {}
+        self._finished = Queue.Queue()
+
+    def run(self, build_cb):
+        '''Build every source by calling ``build_cb``.
+
+        ``build_cb`` is called as ``build_cb(index, source, max_jobs)``
+        from a separate thread for each source, where ``index`` is the
+        position of the source in the build order. It should build the
+        source and raise an exception if that fails.
+
+        If a build fails, no new builds are started, the ones already
+        running are allowed to finish, and the first exception is
+        re-raised.
+
+        '''
+
+        failure = None
+        built = 0
+        while built < len(self.sources):
+            if failure is None:
+                self._start_ready_builds(build_cb)
+            if not self._running:
+                break
+
+            source, exc_info = self._wait_for_build()
+            del self._running[source]
+            built += 1
+
+            if exc_info is None:
+                for dependent in self._dependents[source]:
+                    self._pending[dependent] -= 1
+                    if self._pending[dependent] == 0:
+                        self._ready.append(dependent)
+                self._ready.sort(key=self._index.get)
+            elif failure is None:
+                failure = exc_info
+
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+
+        if built < len(self.sources):  # pragma: no cover
+            raise AssertionError('Sources with unbuildable dependencies: %r'
+                                 % [s for s in self.sources
+                                    if self._pending[s] > 0])
+
+    def _start_ready_builds(self, build_cb):
+        starting = min(len(self._ready),
+                       self.max_parallel - len(self._running))
+        while starting > 0:
+            source = self._ready.pop(0)
+            jobs = self._jobs_for_next_build(starting)
+            self._running[source] = jobs
+            starting -= 1
+
+            logging.debug('Starting build of %s with %d jobs (%d running)'
+                          % (source, jobs, len(self._running)))
+            thread = threading.Thread(
+                target=self._build_in_thread,
+                args=(build_cb, self._index[source], source, jobs))
+            thread.daemon = True
+            thread.start()
+
+    def _jobs_for_next_build(self, starting):
+        free = self.max_jobs - sum(self._running.itervalues())
+        return max(1, free // starting)
+
+    def _build_in_thread(self, build_cb, index, source, jobs):
+        try:
+            build_cb(index, source, jobs)
+        except BaseException:
+            self._finished.put((source, sys.exc_info()))
+        else:
+            self._finished.put((source, None))
+
+    def _wait_for_build(self):
+        # Queue.get() cannot be interrupted by signals unless it has a
+        # timeout, so poll to let ^C through.
+        while True:
+            try:
+                return self._finished.get(timeout=1)
+            except Queue.Empty:  # pragma: no cover
+                pass
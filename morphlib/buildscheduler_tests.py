@@ -0,0 +1,177 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import threading
+import unittest
+
+import morphlib
+
+
+class FakeArtifact(object):
+
+    def __init__(self, source):
+        self.source = source
+
+
+class FakeSource(object):
+
+    def __init__(self, name, *deps):
+        self.name = name
+        self.dependencies = [FakeArtifact(d) for d in deps]
+
+    def __repr__(self):
+        return 'FakeSource(%s)' % self.name
+
+
+class BuildSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.built = []
+        self.jobs = {}
+
+    def record(self, index, source, max_jobs):
+        with self.lock:
+            self.built.append(source.name)
+            self.jobs[source.name] = max_jobs
+
+    def test_builds_everything_in_order_with_one_slot(self):
+        a = FakeSource('a')
+        b = FakeSource('b', a)
+        c = FakeSource('c')
+        d = FakeSource('d', b, c)
+        scheduler = morphlib.buildscheduler.BuildScheduler(
+            [a, b, c, d], 1, 4)
+        scheduler.run(self.record)
+        self.assertEqual(self.built, ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.jobs, {'a': 4, 'b': 4, 'c': 4, 'd': 4})
+
+    def test_dependencies_are_built_first(self):
+        a = FakeSource('a')
+        b = FakeSource('b', a)
+        c = FakeSource('c', a)
+        d = FakeSource('d', b, c)
+        scheduler = morphlib.buildscheduler.BuildScheduler(
+            [a, b, c, d], 4, 8)
+        scheduler.run(self.record)
+        self.assertEqual(self.built[0], 'a')
+        self.assertEqual(set(self.built[1:3]), set(['b', 'c']))
+        self.assertEqual(self.built[3], 'd')
+
+    def test_independent_sources_run_concurrently(self):
+        a = FakeSource('a')
+        b = FakeSource('b')
+        both_started = threading.Event()
+        started = []
+
+        def build(index, source, max_jobs):
+            with self.lock:
+                started.append(source.name)
+                if len(started) == 2:
+                    both_started.set()
+            both_started.wait(5)
+            self.assertTrue(both_started.is_set())
+
+        scheduler = morphlib.buildscheduler.BuildScheduler([a, b], 2, 8)
+        scheduler.run(build)
+        self.assertEqual(sorted(started), ['a', 'b'])
+
+    def test_shares_max_jobs_between_concurrent_builds(self):
+        sources = [FakeSource(name) for name in 'abc']
+        scheduler = morphlib.buildscheduler.BuildScheduler(sources, 3, 9)
+        scheduler.run(self.record)
+        self.assertEqual(self.jobs, {'a': 3, 'b': 3, 'c': 3})
+
+    def test_every_build_gets_at_least_one_job(self):
+        sources = [FakeSource(name) for name in 'abc']
+        scheduler = morphlib.buildscheduler.BuildScheduler(sources, 3, 1)
+        scheduler.run(self.record)
+        self.assertEqual(self.jobs, {'a': 1, 'b': 1, 'c': 1})
+
+    def test_passes_build_order_index(self):
+        a = FakeSource('a')
+        b = FakeSource('b', a)
+        indices = {}
+
+        def build(index, source, max_jobs):
+            indices[source.name] = index
+
+        scheduler = morphlib.buildscheduler.BuildScheduler([a, b], 2, 2)
+        scheduler.run(build)
+        self.assertEqual(indices, {'a': 0, 'b': 1})
+
+    def test_ignores_dependencies_outside_the_build(self):
+        outside = FakeSource('outside')
+        a = FakeSource('a', outside)
+        scheduler = morphlib.buildscheduler.BuildScheduler([a], 2, 2)
+        scheduler.run(self.record)
+        self.assertEqual(self.built, ['a'])
+
+    def test_failure_stops_dependents_and_is_reraised(self):
+        a = FakeSource('a')
+        b = FakeSource('b', a)
+
+        def build(index, source, max_jobs):
+            self.record(index, source, max_jobs)
+            if source is a:
+                raise RuntimeError('build failed')
+
+        scheduler = morphlib.buildscheduler.BuildScheduler([a, b], 2, 2)
+        self.assertRaises(RuntimeError, scheduler.run, build)
+        self.assertEqual(self.built, ['a'])
+
+    def wait_for_thread_of(self, threads, started):
+        # A build's result is queued before its thread exits, so once
+        # the thread has gone the scheduler will see that result first.
+        self.assertTrue(started.wait(5))
+        threads[0].join(5)
+
+    def test_running_builds_finish_after_a_failure(self):
+        a = FakeSource('a')
+        b = FakeSource('b')
+        c = FakeSource('c')
+        threads = []
+        a_started = threading.Event()
+
+        def build(index, source, max_jobs):
+            if source is a:
+                threads.append(threading.current_thread())
+                a_started.set()
+                raise RuntimeError('build failed')
+            self.wait_for_thread_of(threads, a_started)
+            self.record(index, source, max_jobs)
+
+        scheduler = morphlib.buildscheduler.BuildScheduler([a, b, c], 2, 2)
+        self.assertRaises(RuntimeError, scheduler.run, build)
+        # b was allowed to finish, but c was never started.
+        self.assertEqual(self.built, ['b'])
+
+    def test_reraises_first_of_several_failures(self):
+        a = FakeSource('a')
+        b = FakeSource('b')
+        threads = []
+        a_started = threading.Event()
+
+        def build(index, source, max_jobs):
+            if source is a:
+                threads.append(threading.current_thread())
+                a_started.set()
+                raise RuntimeError('a failed')
+            self.wait_for_thread_of(threads, a_started)
+            raise ValueError('b failed')
+
+        scheduler = morphlib.buildscheduler.BuildScheduler([a, b], 2, 2)
+        self.assertRaises(RuntimeError, scheduler.run, build)
@@ -261,6 +261,12 @@ build_systems = [
 ]
 
 
+# Change this whenever detect_build_system may give a different answer
+# for the same files, so that answers remembered by older versions, for
+# example in morphlib.resolutioncache, are not used.
+detection_version = 1
+
+
 def detect_build_system(file_list):
     '''Automatically detect the build system, if possible.
 
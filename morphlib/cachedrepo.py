@@ -131,6 +131,15 @@ class CachedRepo(object):
         '''
         return self._gitdir.list_files(ref, recurse)
 
+    def close(self):
+        '''Stop the git processes kept running to read the repository.
+
+        They are started again if the repository is read later.
+
+        '''
+
+        self._gitdir.close()
+
     def clone_checkout(self, ref, target_dir):
         '''Clone from the cache into the target path and check out a given ref.
 
@@ -169,6 +178,20 @@ class CachedRepo(object):
 
         self._checkout_ref_in_clone(ref, target_dir)
 
+    def extract_tree(self, ref, target_dir):
+        '''Writes the files of a commit ref into a directory.
+
+        Unlike checkout, this does not copy the repository, so the
+        target directory is not a git repository afterwards. Raises a
+        CheckoutError if the files cannot be written.
+
+        '''
+
+        sha1 = self.resolve_ref_to_commit(ref)
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+        self._checkout_tree(sha1, target_dir)
+
     def requires_update_for_ref(self, ref):
         '''Returns False if there's no need to update this cached repo.
 
@@ -241,5 +264,17 @@ class CachedRepo(object):
             raise CheckoutError(self, ref, clone_dir)
         return working_gitdir
 
+    def _checkout_tree(self, ref, target_dir):  # pragma: no cover
+        if self.is_mirror:
+            repo_dir = self.path
+        else:
+            repo_dir = os.path.join(self.path, '.git')
+        try:
+            morphlib.git.checkout_tree(
+                self._runcmd, repo_dir, ref, target_dir,
+                tempdir=self.app.settings['tempdir'])
+        except cliapp.AppException:
+            raise CheckoutError(self, ref, target_dir)
+
     def __str__(self):  # pragma: no cover
         return self.url
@@ -92,6 +92,12 @@ class CachedRepoTests(unittest.TestCase):
         self.assertEqual(self.repo.url, self.repo_url)
         self.assertEqual(self.repo.path, self.repo_path)
 
+    def test_close_closes_git_directory(self):
+        closed = []
+        self.repo._gitdir.close = lambda: closed.append(True)
+        self.repo.close()
+        self.assertEqual(closed, [True])
+
     def test_fail_clone_checkout_into_existing_directory(self):
         self.repo._gitdir.checkout = self.checkout_ref
         self.repo._clone_into = self.clone_into
@@ -141,6 +147,17 @@ class CachedRepoTests(unittest.TestCase):
         morph_filename = os.path.join(unpack_dir, 'foo.morph')
         self.assertTrue(os.path.exists(morph_filename))
 
+    def test_extract_tree_into_new_directory(self):
+        self.repo._gitdir._rev_parse = self.rev_parse
+        self.repo._checkout_tree = self.checkout_ref
+
+        unpack_dir = self.tempfs.getsyspath('unpack/dir')
+        self.repo.extract_tree('master', unpack_dir)
+
+        morph_filename = os.path.join(unpack_dir, 'foo.morph')
+        self.assertTrue(os.path.exists(morph_filename))
+        self.assertFalse(os.path.exists(os.path.join(unpack_dir, '.git')))
+
     def test_successful_update(self):
         self.repo._gitdir.update_remotes = self.update_successfully
         self.repo.update()
@@ -14,18 +14,135 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import errno
+import fcntl
 import hashlib
 import logging
+import os
+import re
 
 import morphlib
 
 
+def encode_cache_id(thing):
+    '''Return the canonical byte string for a cache id.
+
+    Dicts are written as their keys and values in key order, lists and
+    tuples as their items in order, strings as themselves and any
+    other value as its str(). Nothing else is written, so this is
+    exactly the data earlier versions of Morph hashed a piece at a
+    time, and cache keys are unchanged.
+
+    '''
+
+    parts = []
+    _encode(thing, parts)
+    return ''.join(parts)
+
+
+def _encode(thing, parts):
+    kind = type(thing)
+    if kind is str:
+        parts.append(thing)
+    elif kind is dict:
+        for key in sorted(thing):
+            _encode(key, parts)
+            _encode(thing[key], parts)
+    elif kind is list or kind is tuple:
+        for item in thing:
+            _encode(item, parts)
+    else:
+        parts.append(str(thing))
+
+
+class CacheKeyStore(object):
+
+    '''Remember cache keys between CacheKeyComputers and between runs.
+
+    Keys are looked up by a fingerprint of everything that goes into a
+    source's cache id: its repo, commit and tree, a digest of its
+    morphology, the build environment and its dependencies' cache keys.
+
+    If ``filename`` is given, the keys are loaded from that file, and
+    ``save`` appends the keys that were added since. The file is
+    started again when it has more than ``max_entries`` keys in it.
+    Lines that are not a SHA1 fingerprint and a SHA256 cache key, such
+    as one cut short when morph was killed while saving, are ignored.
+
+    '''
+
+    _line_pattern = re.compile(r'^([0-9a-f]{40}) ([0-9a-f]{64})\n?$')
+
+    def __init__(self, filename=None, max_entries=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self._keys = {}
+        self._added = []
+        self._stored = 0
+        if filename is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                damaged = 0
+                for line in f:
+                    m = self._line_pattern.match(line)
+                    if m:
+                        self._keys[m.group(1)] = m.group(2)
+                        self._stored += 1
+                    else:
+                        damaged += 1
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            if damaged:
+                logging.warning('Ignored %d damaged lines in %s' %
+                                (damaged, self.filename))
+
+    def get(self, fingerprint):
+        return self._keys.get(fingerprint)
+
+    def put(self, fingerprint, cache_key):
+        if fingerprint not in self._keys:
+            self._keys[fingerprint] = cache_key
+            self._added.append(fingerprint)
+
+    def save(self):
+        '''Write the keys added since the last save to the file.'''
+
+        if self.filename is None or not self._added:
+            return
+        if self._stored + len(self._added) > self.max_entries:
+            fingerprints = self._added[-self.max_entries:]
+            f = morphlib.savefile.SaveFile(self.filename, 'w')
+            self._stored = 0
+        else:
+            fingerprints = self._added
+            f = open(self.filename, 'a')
+            # Other morph processes may be appending to the file too.
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        with f:
+            f.write(''.join('%s %s\n' % (fp, self._keys[fp])
+                            for fp in fingerprints))
+        self._stored += len(fingerprints)
+        self._added = []
+
+
 class CacheKeyComputer(object):
 
-    def __init__(self, build_env):
+    # Change this whenever what goes into a cache id or a fingerprint
+    # changes, so that keys stored by older versions are not used.
+    fingerprint_version = 1
+
+    def __init__(self, build_env, store=None):
         self._build_env = build_env
+        self._store = store if store is not None else CacheKeyStore()
         self._calculated = {}
         self._hashed = {}
+        self._morph_digests = {}
+        self._env = self._filterenv(build_env.env)
 
     def _filterenv(self, env):
         keys = ["LOGNAME", "MORPH_ARCH", "TARGET", "TARGET_STAGE1",
@@ -36,7 +153,11 @@ class CacheKeyComputer(object):
         try:
             return self._hashed[source]
         except KeyError:
-            ret = self._hash_id(self.get_cache_id(source))
+            fingerprint = self._fingerprint(source)
+            ret = self._store.get(fingerprint)
+            if ret is None:
+                ret = self._hash_id(self.get_cache_id(source))
+                self._store.put(fingerprint, ret)
             self._hashed[source] = ret
             logging.debug(
                 'computed cache key %s for artifact %s from source ',
@@ -44,31 +165,35 @@ class CacheKeyComputer(object):
             return ret
 
     def _hash_id(self, cache_id):
-        sha = hashlib.sha256()
-        self._hash_dict(sha, cache_id)
-        return sha.hexdigest()
-
-    def _hash_thing(self, sha, thing):
-        if type(thing) == dict:
-            self._hash_dict(sha, thing)
-        elif type(thing) == list:
-            self._hash_list(sha, thing)
-        elif type(thing) == tuple:
-            self._hash_tuple(sha, thing)
-        else:
-            sha.update(str(thing))
+        return hashlib.sha256(encode_cache_id(cache_id)).hexdigest()
 
-    def _hash_dict(self, sha, d):
-        for tup in sorted(d.iteritems()):
-            self._hash_thing(sha, tup)
-
-    def _hash_list(self, sha, l):
-        for item in l:
-            self._hash_thing(sha, item)
+    def _morphology_digest(self, morphology):
+        # Morphologies are shared by all the sources made from them, so
+        # each one only needs to be encoded once.
+        try:
+            return self._morph_digests[morphology]
+        except KeyError:
+            digest = hashlib.sha1(
+                encode_cache_id(dict(morphology))).hexdigest()
+            self._morph_digests[morphology] = digest
+            return digest
 
-    def _hash_tuple(self, sha, tup):
-        for item in tup:
-            self._hash_thing(sha, item)
+    def _fingerprint(self, source):
+        parts = [
+            self.fingerprint_version,
+            source.repo_name, source.sha1, source.tree, source.filename,
+            self._morphology_digest(source.morphology),
+            self._env,
+            [(a.name, self.compute_key(a.source))
+             for a in source.dependencies],
+        ]
+        if source.morphology['kind'] == 'chunk':
+            parts += [
+                source.build_mode, source.prefix,
+                [(a, [rgx.pattern for rgx in r._regexes])
+                 for (a, r) in source.split_rules],
+            ]
+        return hashlib.sha1(encode_cache_id(parts)).hexdigest()
 
     def get_cache_id(self, source):
         try:
@@ -81,7 +206,7 @@ class CacheKeyComputer(object):
 
     def _calculate(self, source):
         keys = {
-            'env': self._filterenv(self._build_env.env),
+            'env': self._env,
             'kids': [{'artifact': a.name,
                       'cache-key': self.compute_key(a.source)}
                      for a in source.dependencies],
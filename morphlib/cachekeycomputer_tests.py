@@ -15,6 +15,11 @@
 
 
 import copy
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
 import unittest
 
 import morphlib
@@ -108,27 +113,29 @@ class CacheKeyComputerTests(unittest.TestCase):
             if artifact.name == name:
                 return artifact
 
-    def test_compute_key_hashes_all_types(self):
-        runcount = {'thing': 0, 'dict': 0, 'list': 0, 'tuple': 0}
-
-        def inccount(func, name):
-            def f(sha, item):
-                runcount[name] = runcount[name] + 1
-                func(sha, item)
-            return f
-
-        self.ckc._hash_thing = inccount(self.ckc._hash_thing, 'thing')
-        self.ckc._hash_dict = inccount(self.ckc._hash_dict, 'dict')
-        self.ckc._hash_list = inccount(self.ckc._hash_list, 'list')
-        self.ckc._hash_tuple = inccount(self.ckc._hash_tuple, 'tuple')
-
-        artifact = self._find_artifact('system-rootfs')
-        self.ckc.compute_key(artifact.source)
-
-        self.assertNotEqual(runcount['thing'], 0)
-        self.assertNotEqual(runcount['dict'], 0)
-        self.assertNotEqual(runcount['list'], 0)
-        self.assertNotEqual(runcount['tuple'], 0)
+    def test_encoding_matches_hashing_each_part(self):
+        # Earlier versions fed every part of the cache id to the hash
+        # separately. Keys must not change now that it is encoded first.
+        def hash_thing(sha, thing):
+            if type(thing) == dict:
+                for tup in sorted(thing.iteritems()):
+                    hash_thing(sha, tup)
+            elif type(thing) in (list, tuple):
+                for item in thing:
+                    hash_thing(sha, item)
+            else:
+                sha.update(str(thing))
+
+        for source in self.source_pool:
+            sha = hashlib.sha256()
+            hash_thing(sha, self.ckc.get_cache_id(source))
+            self.assertEqual(self.ckc.compute_key(source), sha.hexdigest())
+
+    def test_encoding_covers_all_types(self):
+        self.assertEqual(
+            morphlib.cachekeycomputer.encode_cache_id(
+                {'b': [1, ('x', None)], 'a': {'c': True}}),
+            'acTrueb1xNone')
 
     def _valid_sha256(self, s):
         validchars = '0123456789abcdef'
@@ -160,3 +167,85 @@ class CacheKeyComputerTests(unittest.TestCase):
         ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
 
         self.assertNotEqual(oldsha, ckc.compute_key(artifact.source))
+
+    def test_reuses_keys_from_store(self):
+        store = morphlib.cachekeycomputer.CacheKeyStore()
+        artifact = self._find_artifact('system-rootfs')
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env, store)
+        key = ckc.compute_key(artifact.source)
+
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env, store)
+        ckc._hash_id = lambda cache_id: self.fail('key was computed again')
+        self.assertEqual(ckc.compute_key(artifact.source), key)
+
+    def test_store_does_not_hide_changed_morphology(self):
+        store = morphlib.cachekeycomputer.CacheKeyStore()
+        artifact = self._find_artifact('chunk-bins')
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env, store)
+        oldkey = ckc.compute_key(artifact.source)
+
+        artifact.source.morphology['build-commands'] = ['make']
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env, store)
+        self.assertNotEqual(ckc.compute_key(artifact.source), oldkey)
+
+
+class CacheKeyStoreTests(unittest.TestCase):
+
+    fp1, fp2, fp3 = ('1' * 40, '2' * 40, '3' * 40)
+    key1, key2, key3 = ('a' * 64, 'b' * 64, 'c' * 64)
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache-keys')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_missing_file_is_empty_store(self):
+        store = morphlib.cachekeycomputer.CacheKeyStore(self.filename)
+        self.assertEqual(store.get(self.fp1), None)
+
+    def test_unreadable_file_is_an_error(self):
+        os.mkdir(self.filename)
+        self.assertRaises(IOError, morphlib.cachekeycomputer.CacheKeyStore,
+                          self.filename)
+
+    def test_does_not_write_file_if_nothing_was_added(self):
+        store = morphlib.cachekeycomputer.CacheKeyStore(self.filename)
+        store.save()
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_keeps_keys_between_runs(self):
+        store = morphlib.cachekeycomputer.CacheKeyStore(self.filename)
+        store.put(self.fp1, self.key1)
+        store.save()
+        store.put(self.fp2, self.key2)
+        store.save()
+        store = morphlib.cachekeycomputer.CacheKeyStore(self.filename)
+        self.assertEqual(store.get(self.fp1), self.key1)
+        self.assertEqual(store.get(self.fp2), self.key2)
+
+    def test_ignores_damaged_lines(self):
+        with open(self.filename, 'w') as f:
+            f.write('%s %s\n' % (self.fp1, self.key1))
+            f.write('%s %s extra\n' % (self.fp3, self.key3))
+            f.write('fp4 key4\n')
+            f.write('%s %s' % (self.fp2, self.key2[:10]))
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        store = morphlib.cachekeycomputer.CacheKeyStore(self.filename)
+        self.assertEqual(store.get(self.fp1), self.key1)
+        self.assertEqual(store.get(self.fp2), None)
+        self.assertEqual(store.get(self.fp3), None)
+        self.assertEqual(store.get('fp4'), None)
+
+    def test_starts_again_when_full(self):
+        store = morphlib.cachekeycomputer.CacheKeyStore(self.filename,
+                                                        max_entries=2)
+        store.put(self.fp1, self.key1)
+        store.put(self.fp2, self.key2)
+        store.save()
+        store.put(self.fp3, self.key3)
+        store.save()
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), '%s %s\n' % (self.fp3, self.key3))
@@ -0,0 +1,355 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+
+import morphlib
+
+
+class UnpackedChunkStore(object):
+
+    '''A store of unpacked chunk artifacts, shared between builds.
+
+    The same store is also used for staging area layers, which are made
+    of several chunks merged together (see OverlayStagingArea).
+
+    Chunks are stored by the basename of the artifact file, which starts
+    with the cache key of the chunk, so an entry never changes once it
+    has been created. For each chunk the store directory holds:
+
+    * ``NAME.d``, the unpacked contents
+    * ``NAME.manifest``, a list of everything in ``NAME.d`` along with
+      its total size, so that installing the chunk does not need to
+      look at the unpacked files again, and eviction is cheap
+    * ``NAME.lock``, which builds lock (shared) while they use the chunk,
+      and which is removed along with the chunk
+
+    An entry is published by unpacking into a temporary directory and
+    renaming it into place. If two builds unpack the same chunk at the
+    same time, the first rename wins and the other copy is thrown away,
+    so no lock is needed for that.
+
+    If ``max_size`` is not zero, the least recently used chunks are
+    removed after a new chunk has been unpacked, until the unpacked
+    chunks take up at most ``max_size`` bytes. Chunks that are being
+    installed by another build are never removed.
+
+    '''
+
+    def __init__(self, dirname, max_size=0):
+        self.dirname = dirname
+        self.max_size = max_size
+
+    def _path(self, name, suffix):
+        return os.path.join(self.dirname, name + suffix)
+
+    def has(self, name):
+        return os.path.isdir(self._path(name, '.d'))
+
+    @contextlib.contextmanager
+    def _lock(self, name, operation):
+        fd = self._lock_fd(name, operation)
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+    def _lock_fd(self, name, operation):
+        path = self._path(name, '.lock')
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, operation)
+                # The lock file is removed along with its chunk, so make
+                # sure the file that was locked is still the current one.
+                locked = os.fstat(fd)
+                current = os.stat(path)
+            except OSError, e:
+                os.close(fd)
+                if e.errno != errno.ENOENT:  # pragma: no cover
+                    raise
+            except BaseException:
+                os.close(fd)
+                raise
+            else:
+                if (locked.st_dev, locked.st_ino) == \
+                        (current.st_dev, current.st_ino):
+                    return fd
+                os.close(fd)
+
+    def reference(self, name, populate):
+        '''Return a StoreReference to the entry ``name``.
+
+        If the entry does not exist yet, it is created by calling
+        ``populate`` with the name of an empty directory to fill in.
+        The entry cannot be evicted until the reference is released.
+
+        '''
+
+        fd = self._lock_fd(name, fcntl.LOCK_SH)
+        try:
+            if self.has(name):
+                manifest = self._load_manifest(name)
+            else:
+                manifest = self._publish(name, populate)
+            os.utime(self._path(name, '.manifest'), None)
+        except BaseException:
+            os.close(fd)
+            raise
+        return StoreReference(self._path(name, '.d'), manifest, fd)
+
+    def install(self, handle, target, status=lambda **kwargs: None):
+        '''Install the chunk in the open file ``handle`` into ``target``.
+
+        The chunk is unpacked into the store first if it is not there
+        already. Every file is then hardlinked into ``target`` in one
+        pass over the chunk's manifest.
+
+        '''
+
+        name = os.path.basename(handle.name)
+
+        def unpack(dirname):
+            status(msg='Unpacking chunk from cache %(filename)s',
+                   filename=name)
+            morphlib.bins.unpack_binary_from_file(handle, dirname + '/')
+
+        with self.reference(name, unpack) as ref:
+            link_tree(ref.dirname, target, ref.manifest['entries'])
+
+        if self.max_size:
+            self.evict(self.max_size)
+
+    def _publish(self, name, populate):
+        savedir = tempfile.mkdtemp(dir=self.dirname)
+        try:
+            populate(savedir)
+            manifest = make_manifest(savedir)
+            self._save_manifest(name, manifest)
+        except BaseException:  # pragma: no cover
+            shutil.rmtree(savedir)
+            raise
+
+        try:
+            os.rename(savedir, self._path(name, '.d'))
+        except OSError:
+            # Another build created the same entry at the same time and
+            # published its copy first, so use that one.
+            if not self.has(name):  # pragma: no cover
+                raise
+            shutil.rmtree(savedir)
+        return manifest
+
+    def _save_manifest(self, name, manifest):
+        with morphlib.savefile.SaveFile(self._path(name, '.manifest'),
+                                        'w') as f:
+            f.write(json.dumps({'size': manifest['size']}) + '\n')
+            f.write(json.dumps(manifest['entries']) + '\n')
+
+    def _load_manifest(self, name):
+        try:
+            with open(self._path(name, '.manifest')) as f:
+                header = json.loads(f.readline())
+                header['entries'] = json.loads(f.readline())
+            return header
+        except (IOError, ValueError):
+            # Chunks unpacked by older versions of Morph have no manifest.
+            manifest = make_manifest(self._path(name, '.d'))
+            self._save_manifest(name, manifest)
+            return manifest
+
+    def _read_size(self, name):
+        try:
+            with open(self._path(name, '.manifest')) as f:
+                return json.loads(f.readline())['size']
+        except (IOError, ValueError):
+            return 0
+
+    def list_contents(self):
+        '''Return ``(name, size, last_used)`` for every stored chunk.'''
+
+        contents = []
+        for filename in os.listdir(self.dirname):
+            if not filename.endswith('.d'):
+                continue
+            name = filename[:-len('.d')]
+            try:
+                last_used = os.stat(self._path(name, '.manifest')).st_mtime
+            except OSError:
+                last_used = 0
+            contents.append((name, self._read_size(name), last_used))
+        return contents
+
+    def evict(self, max_size):
+        '''Remove least recently used chunks until at most max_size remain.
+
+        Return the names of the chunks that were removed.
+
+        '''
+
+        contents = sorted(self.list_contents(), key=lambda c: c[2])
+        total = sum(size for name, size, last_used in contents)
+        removed = []
+        for name, size, last_used in contents:
+            if total <= max_size:
+                break
+            if self.remove(name):
+                total -= size
+                removed.append(name)
+        return removed
+
+    def remove(self, name):
+        '''Remove a chunk, unless it is in use.
+
+        Return True if the chunk was removed.
+
+        '''
+
+        try:
+            with self._lock(name, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                if not self.has(name):
+                    return False
+                logging.debug('Removing unpacked chunk %s' % name)
+                # Move the chunk out of the way first, so nobody can see
+                # it half deleted.
+                trash = tempfile.mkdtemp(dir=self.dirname)
+                os.rename(self._path(name, '.d'), os.path.join(trash, 'd'))
+                if os.path.exists(self._path(name, '.manifest')):
+                    os.remove(self._path(name, '.manifest'))
+                # Builds waiting for the lock will see that the file has
+                # gone once they get it, and lock a new one instead.
+                os.remove(self._path(name, '.lock'))
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                logging.debug('Not removing unpacked chunk %s, it is in use'
+                              % name)
+                return False
+            raise  # pragma: no cover
+        shutil.rmtree(trash)
+        return True
+
+
+class StoreReference(object):
+
+    '''A reference to an entry in an UnpackedChunkStore.
+
+    While the reference is held, the entry in ``dirname`` will not be
+    removed. ``manifest`` is the entry's manifest, as returned by
+    ``make_manifest``.
+
+    '''
+
+    def __init__(self, dirname, manifest, fd):
+        self.dirname = dirname
+        self.manifest = manifest
+        self._fd = fd
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def make_manifest(root):
+    '''List everything below ``root`` in the order it must be created.
+
+    Return a dict with the total ``size`` of the regular files and the
+    list of ``entries``. Each entry is a list starting with a type
+    character and the path relative to ``root``: ``d`` for directories,
+    ``f`` for regular files, ``l`` for symlinks (followed by the link
+    target) and ``n`` for device nodes (followed by mode and device).
+
+    '''
+
+    entries = []
+    size = 0
+    for dirname, subdirs, basenames in os.walk(root):
+        reldir = os.path.relpath(dirname, root)
+        for basename in sorted(subdirs + basenames):
+            path = os.path.join(dirname, basename)
+            relpath = os.path.normpath(os.path.join(reldir, basename))
+            st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                entries.append(['d', relpath])
+            elif stat.S_ISLNK(st.st_mode):
+                entries.append(['l', relpath, os.readlink(path)])
+            elif stat.S_ISREG(st.st_mode):
+                entries.append(['f', relpath])
+                size += st.st_size
+            elif stat.S_ISCHR(st.st_mode) or \
+                    stat.S_ISBLK(st.st_mode):  # pragma: no cover
+                entries.append(['n', relpath, st.st_mode, st.st_rdev])
+            else:
+                raise IOError('Cannot extract %s into staging-area. '
+                              'Unsupported type.' % path)
+    return {'size': size, 'entries': entries}
+
+
+def link_tree(srcdir, destdir, entries):
+    '''Hardlink the files listed in ``entries`` from srcdir to destdir.
+
+    ``entries`` is a manifest list from ``make_manifest``. Existing files
+    in ``destdir`` are replaced, and existing directories, or symlinks to
+    directories, are merged into.
+
+    '''
+
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+
+    def replace(create, destpath):
+        try:
+            create()
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            os.remove(destpath)
+            create()
+
+    for entry in entries:
+        kind, relpath = entry[0], entry[1]
+        srcpath = os.path.join(srcdir, relpath)
+        destpath = os.path.join(destdir, relpath)
+        if kind == 'd':
+            try:
+                os.mkdir(destpath)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if not os.path.isdir(destpath):
+                    raise IOError('Destination not a directory. source has %s'
+                                  ' destination has %s' % (srcpath, destpath))
+        elif kind == 'f':
+            replace(lambda: os.link(srcpath, destpath), destpath)
+        elif kind == 'l':
+            replace(lambda: os.symlink(entry[2], destpath), destpath)
+        elif kind == 'n':  # pragma: no cover
+            replace(lambda: os.mknod(destpath, entry[2], entry[3]), destpath)
+            os.chmod(destpath, entry[2])
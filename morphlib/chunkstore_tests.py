@@ -0,0 +1,294 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import fcntl
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import morphlib
+
+
+class FakeHandle(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def read(self, *args):
+        raise AssertionError('Chunk was unpacked again')
+
+
+class UnpackedChunkStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.storedir = os.path.join(self.tempdir, 'chunks')
+        os.mkdir(self.storedir)
+        self.store = morphlib.chunkstore.UnpackedChunkStore(self.storedir)
+        self.target = os.path.join(self.tempdir, 'staging')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create_chunk(self, name, files):
+        chunkdir = os.path.join(self.tempdir, name + '.src')
+        os.mkdir(chunkdir)
+        for relpath, contents in files.iteritems():
+            path = os.path.join(chunkdir, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+        chunk_tar = os.path.join(self.tempdir, name)
+        tf = tarfile.TarFile(name=chunk_tar, mode='w')
+        tf.add(chunkdir, arcname='.')
+        tf.close()
+        return chunk_tar
+
+    def install(self, chunk_tar, target=None):
+        with open(chunk_tar, 'rb') as f:
+            self.store.install(f, target or self.target)
+
+    def test_installs_chunk(self):
+        chunk = self.create_chunk('foo.chunk.foo', {'usr/bin/foo': 'foo'})
+        self.install(chunk)
+        with open(os.path.join(self.target, 'usr/bin/foo')) as f:
+            self.assertEqual(f.read(), 'foo')
+
+    def test_keeps_chunk_unpacked(self):
+        chunk = self.create_chunk('foo.chunk.foo', {'usr/bin/foo': 'foo'})
+        self.install(chunk)
+        self.assertTrue(self.store.has('foo.chunk.foo'))
+        self.assertEqual(self.store.list_contents()[0][:2],
+                         ('foo.chunk.foo', 3))
+
+    def test_hardlinks_files_from_store(self):
+        chunk = self.create_chunk('foo.chunk.foo', {'usr/bin/foo': 'foo'})
+        self.install(chunk)
+        stored = os.stat(os.path.join(self.storedir, 'foo.chunk.foo.d',
+                                      'usr/bin/foo'))
+        installed = os.stat(os.path.join(self.target, 'usr/bin/foo'))
+        self.assertEqual(stored.st_ino, installed.st_ino)
+
+    def test_reuses_unpacked_chunk(self):
+        chunk = self.create_chunk('foo.chunk.foo', {'usr/bin/foo': 'foo'})
+        self.install(chunk)
+        os.remove(chunk)
+        other_target = os.path.join(self.tempdir, 'other')
+        self.store.install(FakeHandle(chunk), other_target)
+        self.assertTrue(os.path.exists(
+            os.path.join(other_target, 'usr/bin/foo')))
+
+    def test_installs_into_symlinked_directory(self):
+        os.makedirs(os.path.join(self.target, 'usr/lib'))
+        os.symlink('usr/lib', os.path.join(self.target, 'lib'))
+        chunk = self.create_chunk('foo.chunk.foo', {'lib/libfoo.so': 'foo'})
+        self.install(chunk)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.target, 'usr/lib/libfoo.so')))
+
+    def test_replaces_existing_files(self):
+        old = self.create_chunk('old.chunk.old', {'etc/foo': 'old'})
+        new = self.create_chunk('new.chunk.new', {'etc/foo': 'new'})
+        self.install(old)
+        self.install(new)
+        with open(os.path.join(self.target, 'etc/foo')) as f:
+            self.assertEqual(f.read(), 'new')
+
+    def test_installs_symlinks(self):
+        chunkdir = os.path.join(self.tempdir, 'link.src')
+        os.mkdir(chunkdir)
+        os.symlink('target', os.path.join(chunkdir, 'link'))
+        chunk_tar = os.path.join(self.tempdir, 'link.chunk.link')
+        tf = tarfile.TarFile(name=chunk_tar, mode='w')
+        tf.add(chunkdir, arcname='.')
+        tf.close()
+        self.install(chunk_tar)
+        self.assertEqual(os.readlink(os.path.join(self.target, 'link')),
+                         'target')
+
+    def test_rebuilds_missing_manifest(self):
+        chunk = self.create_chunk('foo.chunk.foo', {'usr/bin/foo': 'foo'})
+        self.install(chunk)
+        os.remove(os.path.join(self.storedir, 'foo.chunk.foo.manifest'))
+        other_target = os.path.join(self.tempdir, 'other')
+        self.install(chunk, other_target)
+        self.assertTrue(os.path.exists(
+            os.path.join(other_target, 'usr/bin/foo')))
+
+    def test_evicts_least_recently_used_chunks(self):
+        old = self.create_chunk('old.chunk.old', {'old': 'x' * 10})
+        new = self.create_chunk('new.chunk.new', {'new': 'x' * 10})
+        self.install(old)
+        self.install(new)
+        os.utime(os.path.join(self.storedir, 'old.chunk.old.manifest'),
+                 (0, 0))
+        self.assertEqual(self.store.evict(15), ['old.chunk.old'])
+        self.assertFalse(self.store.has('old.chunk.old'))
+        self.assertTrue(self.store.has('new.chunk.new'))
+        self.assertTrue(os.path.exists(os.path.join(self.target, 'old')))
+
+    def test_evicts_when_installing_over_max_size(self):
+        self.store.max_size = 15
+        old = self.create_chunk('old.chunk.old', {'old': 'x' * 10})
+        new = self.create_chunk('new.chunk.new', {'new': 'x' * 10})
+        self.install(old)
+        os.utime(os.path.join(self.storedir, 'old.chunk.old.manifest'),
+                 (0, 0))
+        self.install(new)
+        self.assertEqual([name for name, size, last_used
+                          in self.store.list_contents()],
+                         ['new.chunk.new'])
+
+    def test_does_not_remove_chunk_in_use(self):
+        chunk = self.create_chunk('foo.chunk.foo', {'foo': 'foo'})
+        self.install(chunk)
+        with open(os.path.join(self.storedir, 'foo.chunk.foo.lock')) as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            self.assertFalse(self.store.remove('foo.chunk.foo'))
+        self.assertTrue(self.store.has('foo.chunk.foo'))
+        self.assertTrue(self.store.remove('foo.chunk.foo'))
+        self.assertFalse(self.store.has('foo.chunk.foo'))
+
+    def test_uses_chunk_published_first_by_another_build(self):
+        def unpack(handle, dirname):
+            # Another build publishes the chunk while this one unpacks it.
+            os.makedirs(os.path.join(self.storedir, 'foo.chunk.foo.d',
+                                     'foo'))
+            os.mkdir(os.path.join(dirname, 'foo'))
+        unpack_binary_from_file = morphlib.bins.unpack_binary_from_file
+        morphlib.bins.unpack_binary_from_file = unpack
+        try:
+            self.store.install(FakeHandle('foo.chunk.foo'), self.target)
+        finally:
+            morphlib.bins.unpack_binary_from_file = unpack_binary_from_file
+        self.assertTrue(os.path.isdir(os.path.join(self.target, 'foo')))
+        self.assertEqual(sorted(os.listdir(self.storedir)),
+                         ['foo.chunk.foo.d', 'foo.chunk.foo.lock',
+                          'foo.chunk.foo.manifest'])
+
+    def test_lists_chunk_without_manifest_as_unused_and_empty(self):
+        os.mkdir(os.path.join(self.storedir, 'foo.chunk.foo.d'))
+        self.assertEqual(self.store.list_contents(),
+                         [('foo.chunk.foo', 0, 0)])
+
+    def test_does_not_keep_chunk_that_failed_to_unpack(self):
+        def populate(dirname):
+            raise IOError('truncated chunk')
+        self.assertRaises(IOError, self.store.reference, 'foo.chunk.foo',
+                          populate)
+        self.assertFalse(self.store.has('foo.chunk.foo'))
+        self.assertEqual(os.listdir(self.storedir), ['foo.chunk.foo.lock'])
+
+    def test_does_not_remove_missing_chunk(self):
+        self.assertFalse(self.store.remove('foo.chunk.foo'))
+
+    def test_removes_lock_file_with_chunk(self):
+        chunk = self.create_chunk('foo.chunk.foo', {'foo': 'foo'})
+        self.install(chunk)
+        self.assertTrue(self.store.remove('foo.chunk.foo'))
+        self.assertEqual(os.listdir(self.storedir), [])
+
+    def install_while_removing_lock(self, replace):
+        chunk = self.create_chunk('foo.chunk.foo', {'foo': 'foo'})
+        lock = os.path.join(self.storedir, 'foo.chunk.foo.lock')
+        flock = fcntl.flock
+        calls = []
+
+        def remove_then_flock(fd, operation):
+            # Another build removes the chunk while this one waits for
+            # the lock.
+            if not calls:
+                os.remove(lock)
+                if replace:
+                    open(lock, 'w').close()
+            calls.append(operation)
+            flock(fd, operation)
+
+        fcntl.flock = remove_then_flock
+        try:
+            self.install(chunk)
+        finally:
+            fcntl.flock = flock
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.target, 'foo')))
+        self.assertTrue(os.path.exists(lock))
+
+    def test_locks_again_if_lock_file_was_removed(self):
+        self.install_while_removing_lock(replace=False)
+
+    def test_locks_again_if_lock_file_was_replaced(self):
+        self.install_while_removing_lock(replace=True)
+
+
+class ManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_lists_directories_before_their_contents(self):
+        os.makedirs(os.path.join(self.tempdir, 'a/b'))
+        with open(os.path.join(self.tempdir, 'a/b/c'), 'w') as f:
+            f.write('data')
+        os.symlink('b', os.path.join(self.tempdir, 'a/link'))
+        manifest = morphlib.chunkstore.make_manifest(self.tempdir)
+        self.assertEqual(manifest['size'], 4)
+        self.assertEqual(manifest['entries'], [
+            ['d', 'a'],
+            ['d', 'a/b'],
+            ['l', 'a/link', 'b'],
+            ['f', 'a/b/c'],
+        ])
+
+    def test_refuses_unsupported_file_types(self):
+        os.mkfifo(os.path.join(self.tempdir, 'fifo'))
+        self.assertRaises(IOError, morphlib.chunkstore.make_manifest,
+                          self.tempdir)
+
+
+class LinkTreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tempdir, 'src')
+        self.destdir = os.path.join(self.tempdir, 'dest')
+        os.makedirs(os.path.join(self.srcdir, 'dir'))
+        with open(os.path.join(self.srcdir, 'dir/file'), 'w') as f:
+            f.write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_fails_if_directory_is_a_file_in_destination(self):
+        os.mkdir(self.destdir)
+        with open(os.path.join(self.destdir, 'dir'), 'w'):
+            pass
+        self.assertRaises(IOError, morphlib.chunkstore.link_tree,
+                          self.srcdir, self.destdir, [['d', 'dir']])
+
+    def test_fails_if_directory_cannot_be_created(self):
+        self.assertRaises(OSError, morphlib.chunkstore.link_tree,
+                          self.srcdir, self.destdir,
+                          [['d', 'missing/dir']])
+
+    def test_fails_if_file_cannot_be_linked(self):
+        self.assertRaises(OSError, morphlib.chunkstore.link_tree,
+                          self.srcdir, self.destdir, [['f', 'dir/file']])
@@ -19,9 +19,11 @@ import ConfigParser
 import logging
 import os
 import re
+import shutil
 import string
 import StringIO
 import sys
+import tempfile
 
 import morphlib
 
@@ -265,6 +267,28 @@ def copy_repository(runcmd, repo, destdir, is_mirror=True):
     gitcmd(runcmd, 'remote', 'update', 'origin', '--prune', cwd=destdir)
 
 
+def checkout_tree(runcmd, repo, ref, destdir, tempdir=None):
+    '''Write the files in the tree of ref in repo into destdir.
+
+    This does what a checkout of ref would do to the files, but does not
+    copy the repository: destdir does not become a git repository, and
+    nothing is written to repo. The index git needs meanwhile is kept in
+    a temporary directory in ``tempdir``.
+
+    '''
+
+    tempdir = tempfile.mkdtemp(dir=tempdir)
+    try:
+        env = dict(os.environ)
+        env['GIT_INDEX_FILE'] = os.path.join(tempdir, 'index')
+        gitcmd(runcmd, '--git-dir', repo, '--work-tree', destdir,
+               'read-tree', ref, env=env)
+        gitcmd(runcmd, '--git-dir', repo, '--work-tree', destdir,
+               'checkout-index', '--all', '--force', env=env)
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def reset_workdir(runcmd, gitdir):
     '''Removes any differences between the current commit '''
     '''and the status of the working directory'''
@@ -18,8 +18,11 @@
 
 import cliapp
 import itertools
+import logging
 import os
 import re
+import subprocess
+import threading
 
 import morphlib
 
@@ -348,6 +351,96 @@ class Remote(object):
         return ret
 
 
+class CatFileBatchError(Exception):
+
+    pass
+
+
+class CatFileBatch(object):
+
+    '''A long-running ``git cat-file --batch`` process for a repository.
+
+    Reading objects through one process avoids starting a new git
+    process for every object, which is most of the cost of reading a
+    small object. The process may be used from several threads.
+
+    If the process cannot be started or stops working, CatFileBatchError
+    is raised, and the caller should run git directly instead.
+
+    '''
+
+    def __init__(self, dirname):
+        env = dict(os.environ)
+        env['GIT_NO_REPLACE_OBJECTS'] = '1'
+        try:
+            self._process = subprocess.Popen(
+                ['git', 'cat-file', '--batch'], cwd=dirname, env=env,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                close_fds=True)
+        except OSError as e:
+            raise CatFileBatchError(str(e))
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        '''Return (sha1, type, contents) for an object, or None.
+
+        ``name`` may be anything ``git cat-file`` accepts, such as
+        ``ref^{tree}`` or ``tree:path``. None is returned if there is no
+        such object.
+
+        '''
+
+        if '\n' in name:
+            raise CatFileBatchError('Object name contains a newline')
+        with self._lock:
+            if self._process is None:
+                raise CatFileBatchError('git cat-file has been closed')
+            try:
+                self._process.stdin.write(name + '\n')
+                self._process.stdin.flush()
+                header = self._process.stdout.readline()
+                if not header:
+                    raise IOError('git cat-file exited unexpectedly')
+                if header.endswith((' missing\n', ' ambiguous\n')):
+                    return None
+                sha1, kind, size = header.split()
+                contents = self._process.stdout.read(int(size) + 1)
+                if len(contents) != int(size) + 1:
+                    raise IOError('git cat-file output was truncated')
+            except (IOError, OSError, ValueError) as e:
+                self._close()
+                raise CatFileBatchError(str(e))
+        return sha1, kind, contents[:-1]
+
+    def _close(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except IOError:  # pragma: no cover
+                pass
+            self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+def parse_tree(contents):
+    '''Return the (mode, name, sha1) entries of a raw git tree object.'''
+
+    entries = []
+    pos = 0
+    while pos < len(contents):
+        space = contents.index(' ', pos)
+        nul = contents.index('\0', space)
+        sha1 = contents[nul + 1:nul + 21].encode('hex')
+        entries.append((contents[pos:space], contents[space + 1:nul], sha1))
+        pos = nul + 21
+    return entries
+
+
 class GitDirectory(object):
 
     '''Represents a local Git repository.
@@ -381,6 +474,8 @@ class GitDirectory(object):
 
         self.dirname = dirname
         self._config = {}
+        self._cat_file_batch = None
+        self._cat_file_lock = threading.Lock()
 
         self._ensure_is_git_repo()
 
@@ -399,6 +494,40 @@ class GitDirectory(object):
     def _runcmd_unchecked(self, *args, **kwargs):
         return cliapp.runcmd_unchecked(*args, cwd=self.dirname, **kwargs)
 
+    def _get_object(self, name):
+        '''Read an object through the repository's CatFileBatch.
+
+        Return (sha1, type, contents), or None if there is no such
+        object. Raise CatFileBatchError if git must be run directly
+        instead.
+
+        '''
+
+        with self._cat_file_lock:
+            if self._cat_file_batch is None:
+                try:
+                    self._cat_file_batch = CatFileBatch(self.dirname)
+                except CatFileBatchError as e:  # pragma: no cover
+                    logging.warning('Not using git cat-file --batch in %s: '
+                                    '%s' % (self.dirname, e))
+                    self._cat_file_batch = False
+            batch = self._cat_file_batch
+        if batch is False:  # pragma: no cover
+            raise CatFileBatchError('git cat-file --batch is not available')
+        return batch.get(name)
+
+    def close(self):
+        '''Stop the git processes kept running for this repository.
+
+        They are started again if they are needed later.
+
+        '''
+
+        with self._cat_file_lock:
+            batch, self._cat_file_batch = self._cat_file_batch, None
+        if batch:
+            batch.close()
+
     def _ensure_is_git_repo(self):
         try:
             self._runcmd(['git', 'rev-parse', '--git-dir'])
@@ -409,6 +538,7 @@ class GitDirectory(object):
     def checkout(self, branch_name): # pragma: no cover
         '''Check out a git branch.'''
         morphlib.git.gitcmd(self._runcmd, 'checkout', branch_name)
+        self.close()
         if self.has_fat():
             self.fat_init()
             self.fat_pull()
@@ -426,6 +556,7 @@ class GitDirectory(object):
         if base_ref is not None:
             argv.append(base_ref)
         morphlib.git.gitcmd(self._runcmd, *argv)
+        self.close()
 
     def is_currently_checked_out(self, ref): # pragma: no cover
         '''Is ref currently checked out?'''
@@ -458,14 +589,23 @@ class GitDirectory(object):
         blob_id = '%s:%s' % (ref, filename)
         return self.get_blob_contents(blob_id)
 
-    def get_blob_contents(self, blob_id): # pragma: no cover
+    def _get_object_contents(self, name, kind):
+        try:
+            obj = self._get_object(name)
+        except CatFileBatchError:  # pragma: no cover
+            return morphlib.git.gitcmd(self._runcmd, 'cat-file', kind, name)
+        if obj is None or obj[1] != kind:
+            raise cliapp.AppException('%s is not a %s in %s'
+                                      % (name, kind, self.dirname))
+        return obj[2]
+
+    def get_blob_contents(self, blob_id):
         '''Get file contents from git by ID'''
-        return morphlib.git.gitcmd(self._runcmd, 'cat-file', 'blob', blob_id)
+        return self._get_object_contents(blob_id, 'blob')
 
-    def get_commit_contents(self, commit_id): # pragma: no cover
+    def get_commit_contents(self, commit_id):
         '''Get commit contents from git by ID'''
-        return morphlib.git.gitcmd(self._runcmd, 'cat-file', 'commit',
-                                   commit_id)
+        return self._get_object_contents(commit_id, 'commit')
 
     def update_submodules(self, app): # pragma: no cover
         '''Change .gitmodules URLs, and checkout submodules.'''
@@ -508,6 +648,7 @@ class GitDirectory(object):
         '''Run "git remote update --prune".'''
         morphlib.git.gitcmd(self._runcmd, 'remote', 'update', '--prune',
                             echo_stderr=echo_stderr)
+        self.close()
 
     def is_bare(self):
         '''Determine whether the repository has no work tree (is bare)'''
@@ -566,15 +707,25 @@ class GitDirectory(object):
                 return None
             raise
 
+    def _peel(self, ref, kind):
+        name = '%s^{%s}' % (ref, kind)
+        try:
+            obj = self._get_object(name)
+        except CatFileBatchError:  # pragma: no cover
+            return self._rev_parse(name)
+        if obj is None:
+            raise InvalidRefError(self, name)
+        return obj[0]
+
     def resolve_ref_to_commit(self, ref):
-        return self._rev_parse('%s^{commit}' % ref)
+        return self._peel(ref, 'commit')
 
     def resolve_ref_to_tree(self, ref):
-        return self._rev_parse('%s^{tree}' % ref)
+        return self._peel(ref, 'tree')
 
     def ref_exists(self, ref):
         try:
-            self._rev_parse('%s^{commit}' % ref)
+            self.resolve_ref_to_commit(ref)
             return True
         except InvalidRefError:
             return False
@@ -589,7 +740,28 @@ class GitDirectory(object):
                 filepath = os.path.join(dirpath, filename)
                 yield os.path.relpath(filepath, start=self.dirname)
 
+    def _list_tree(self, contents, recurse, prefix=''):
+        for mode, name, sha1 in parse_tree(contents):
+            path = prefix + name
+            if mode == '40000' and recurse:
+                subtree = self._get_object(sha1)
+                if subtree is None:  # pragma: no cover
+                    raise InvalidRefError(self, sha1)
+                for subpath in self._list_tree(subtree[2], recurse,
+                                               path + '/'):
+                    yield subpath
+            else:
+                yield path
+
     def _list_files_in_ref(self, ref, recurse=True):
+        try:
+            tree = self._get_object('%s^{tree}' % ref)
+            if tree is None:
+                raise InvalidRefError(self, ref)
+            return list(self._list_tree(tree[2], recurse))
+        except CatFileBatchError:  # pragma: no cover
+            pass
+
         tree = self.resolve_ref_to_tree(ref)
 
         command = ['ls-tree', '--name-only', '-z']
@@ -629,6 +801,18 @@ class GitDirectory(object):
         if ref is None:
             filepath = os.path.join(self.dirname, filename.lstrip('/'))
             return os.path.islink(filepath)
+        dirname, basename = os.path.split(filename)
+        if basename and not filename.startswith('/'):
+            name = '%s:%s' % (ref, dirname) if dirname else '%s^{tree}' % ref
+            try:
+                tree = self._get_object(name)
+            except CatFileBatchError:  # pragma: no cover
+                pass
+            else:
+                if tree is None or tree[1] != 'tree':
+                    return False
+                return any(mode == '120000' and name == basename
+                           for mode, name, sha1 in parse_tree(tree[2]))
         tree_entry = morphlib.git.gitcmd(self._runcmd, 'ls-tree', ref,
                                          filename)
         file_mode = tree_entry.split(' ', 1)[0]
@@ -691,6 +875,7 @@ class GitDirectory(object):
             args.extend(('-m', message))
         args.extend(ref_args)
         morphlib.git.gitcmd(self._runcmd, *args)
+        self.close()
 
     def add_ref(self, ref, sha1, message=None):
         '''Create a ref called `ref` in the repository pointing to `sha1`.
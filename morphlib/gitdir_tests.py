@@ -16,10 +16,12 @@
 # =*= License: GPL-2 =*=
 
 
+import cliapp
 import contextlib
 import datetime
 import os
 import shutil
+import subprocess
 import tempfile
 import unittest
 
@@ -181,6 +183,46 @@ class GitDirectoryContentsTests(unittest.TestCase):
             self.assertRaises(IOError,
                               gd.read_file, 'non-existant-file', 'HEAD')
 
+    def test_lists_files_in_subdirectories_like_ls_tree(self):
+        gd = morphlib.gitdir.GitDirectory(self.dirname)
+        os.makedirs(os.path.join(self.dirname, 'a/b'))
+        for fn in ('a/b/c', 'a/d', 'a-e'):
+            with open(os.path.join(self.dirname, fn), 'w') as f:
+                f.write('text')
+        morphlib.git.gitcmd(gd._runcmd, 'add', '.')
+        morphlib.git.gitcmd(gd._runcmd, 'commit', '-m', 'Add directories')
+        output = morphlib.git.gitcmd(gd._runcmd, 'ls-tree', '-r',
+                                     '--name-only', '-z', 'HEAD')
+        self.assertEqual(gd.list_files('HEAD'),
+                         output.strip('\0').split('\0'))
+        self.assertEqual(sorted(gd.list_files('HEAD', recurse=False)),
+                         ['a', 'a-e', 'bar.morph', 'baz.morph', 'foo.morph',
+                          'quux'])
+
+    def test_reads_again_after_close(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        self.assertEqual(gd.read_file('bar.morph', 'HEAD'),
+                         'dummy morphology text')
+        gd.close()
+        self.assertEqual(gd.read_file('baz.morph', 'HEAD'),
+                         'dummy morphology text')
+        gd.close()
+
+    def test_runs_git_directly_without_cat_file_batch(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        gd._cat_file_batch = False
+        self.assertEqual(gd.read_file('bar.morph', 'HEAD'),
+                         'dummy morphology text')
+        self.assertEqual(sorted(gd.list_files('HEAD')),
+                         ['bar.morph', 'baz.morph', 'foo', 'quux'])
+
+    def test_get_blob_contents_raises_for_other_objects(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        self.assertRaises(cliapp.AppException,
+                          gd.get_blob_contents, 'HEAD')
+        self.assertRaises(cliapp.AppException,
+                          gd.get_blob_contents, 'HEAD:no-such-file')
+
     def test_HEAD(self):
         gd = morphlib.gitdir.GitDirectory(self.dirname)
         self.assertEqual(gd.HEAD, 'master')
@@ -266,6 +308,62 @@ class GitDirectoryContentsTests(unittest.TestCase):
         self.assertEqual(gd.describe(), 'example')
 
 
+class CatFileBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        gd = morphlib.gitdir.init(self.tempdir)
+        with open(os.path.join(self.tempdir, 'file'), 'w') as f:
+            f.write('text')
+        morphlib.git.gitcmd(gd._runcmd, 'add', '.')
+        morphlib.git.gitcmd(gd._runcmd, 'commit', '-m', 'Initial commit')
+        self.batch = morphlib.gitdir.CatFileBatch(self.tempdir)
+
+    def tearDown(self):
+        self.batch.close()
+        shutil.rmtree(self.tempdir)
+
+    def fake_git(self, script):
+        self.batch.close()
+        self.batch._process = subprocess.Popen(
+            ['sh', '-c', script], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    def test_reads_objects(self):
+        sha1, kind, contents = self.batch.get('HEAD:file')
+        self.assertEqual((kind, contents), ('blob', 'text'))
+        self.assertEqual(self.batch.get('HEAD:no-such-file'), None)
+
+    def test_close_reaps_process(self):
+        process = self.batch._process
+        self.batch.close()
+        self.assertNotEqual(process.returncode, None)
+        self.assertRaises(morphlib.gitdir.CatFileBatchError,
+                          self.batch.get, 'HEAD:file')
+
+    def test_cannot_start_in_missing_directory(self):
+        self.assertRaises(morphlib.gitdir.CatFileBatchError,
+                          morphlib.gitdir.CatFileBatch,
+                          os.path.join(self.tempdir, 'no-such-dir'))
+
+    def test_rejects_names_with_newlines(self):
+        self.assertRaises(morphlib.gitdir.CatFileBatchError,
+                          self.batch.get, 'HEAD:file\nHEAD')
+
+    def test_stops_if_git_exits(self):
+        self.fake_git('read name')
+        process = self.batch._process
+        self.assertRaises(morphlib.gitdir.CatFileBatchError,
+                          self.batch.get, 'HEAD:file')
+        self.assertNotEqual(process.returncode, None)
+
+    def test_stops_if_output_is_truncated(self):
+        self.fake_git('read name; echo "%s blob 100"; echo short' % ('0' * 40))
+        self.assertRaises(morphlib.gitdir.CatFileBatchError,
+                          self.batch.get, 'HEAD:file')
+        self.assertEqual(self.batch._process, None)
+
+
 class GitDirectoryFileTypeTests(unittest.TestCase):
 
     def setUp(self):
@@ -297,6 +395,9 @@ class GitDirectoryFileTypeTests(unittest.TestCase):
         self.assertTrue(gd.is_symlink('link', 'HEAD'))
         self.assertTrue(gd.is_symlink('broken', 'HEAD'))
         self.assertFalse(gd.is_symlink('file', 'HEAD'))
+        self.assertFalse(gd.is_symlink('no-such-file', 'HEAD'))
+        self.assertFalse(gd.is_symlink('no-such-dir/file', 'HEAD'))
+        self.assertFalse(gd.is_symlink('link/', 'HEAD'))
 
     def test_is_symlink_raises_no_ref_no_work_tree(self):
         gd = morphlib.gitdir.GitDirectory(self.mirror)
@@ -0,0 +1,95 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+
+
+class HTTPConnections(object):
+
+    '''Kept-alive HTTP connections to one server, one for each thread.
+
+    The proxy set in the environment (``http_proxy``, ``https_proxy``
+    and ``no_proxy``) is used, as urllib2 would.
+
+    '''
+
+    def __init__(self, server_url):
+        self.server_url = server_url
+        self._local = threading.local()
+
+    def _proxy_netloc(self, parts):
+        '''Return the host:port of the proxy to use, or None.'''
+
+        proxy = urllib.getproxies().get(parts.scheme)
+        if not proxy or urllib.proxy_bypass(parts.hostname):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return urlparse.urlsplit(proxy).netloc
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            parts = urlparse.urlsplit(self.server_url)
+            proxy = self._proxy_netloc(parts)
+            if parts.scheme == 'https':
+                if proxy is None:
+                    connection = httplib.HTTPSConnection(parts.netloc)
+                else:
+                    connection = httplib.HTTPSConnection(proxy)
+                    connection.set_tunnel(parts.hostname, parts.port)
+            else:
+                connection = httplib.HTTPConnection(proxy or parts.netloc)
+            self._local.connection = connection
+            # Plain HTTP proxies need the absolute URL in the request line.
+            self._local.absolute = proxy is not None and \
+                parts.scheme != 'https'
+        return connection
+
+    def request(self, method, path, body=None, headers={}):
+        '''Make a request and return the response.
+
+        ``path`` is the path and query of the URL on the server. The
+        response must be read before the thread makes another request.
+
+        '''
+
+        url = urlparse.urljoin(self.server_url, path)
+        # The server may have closed the kept-alive connection since it
+        # was last used, so try again once on a new one.
+        for attempt in (1, 2):
+            connection = self._connection()
+            try:
+                connection.request(
+                    method, url if self._local.absolute else path,
+                    body, headers)
+                return connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        '''Close the connection of the calling thread, if it has one.'''
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
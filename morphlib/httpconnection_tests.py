@@ -0,0 +1,154 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import BaseHTTPServer
+import httplib
+import os
+import threading
+import unittest
+import urlparse
+
+import morphlib
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.requestline, self.client_address))
+        if self.path.endswith('/drop'):
+            # Hang up without replying.
+            self.close_connection = 1
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+        if self.path.endswith('/close'):
+            # Hang up without telling the client first.
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPConnectionsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = os.environ.copy()
+        for name in ('http_proxy', 'https_proxy', 'no_proxy'):
+            os.environ.pop(name, None)
+            os.environ.pop(name.upper(), None)
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.start()
+        self.server_url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.connections = morphlib.httpconnection.HTTPConnections(
+            self.server_url)
+
+    def tearDown(self):
+        self.connections.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def get(self, path):
+        response = self.connections.request('GET', path)
+        return response.status, response.read()
+
+    def test_keeps_connection_alive(self):
+        self.assertEqual(self.get('/1.0/a'), (200, 'ok'))
+        self.assertEqual(self.get('/1.0/b'), (200, 'ok'))
+        (line1, client1), (line2, client2) = self.server.requests
+        self.assertEqual(line2, 'GET /1.0/b HTTP/1.1')
+        self.assertEqual(client1, client2)
+
+    def test_reconnects_if_server_hung_up(self):
+        self.assertEqual(self.get('/1.0/close'), (200, 'ok'))
+        self.assertEqual(self.get('/1.0/b'), (200, 'ok'))
+        self.assertEqual(self.server.requests[-1][0], 'GET /1.0/b HTTP/1.1')
+
+    def test_gives_up_after_second_attempt(self):
+        self.assertRaises(httplib.HTTPException, self.get, '/1.0/drop')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_close_without_connection_does_nothing(self):
+        self.connections.close()
+        self.connections.close()
+
+    def test_sends_absolute_url_to_http_proxy(self):
+        os.environ['http_proxy'] = self.server_url
+        connections = morphlib.httpconnection.HTTPConnections(
+            'http://cache.example.com:8080/')
+        response = connections.request('GET', '/1.0/a')
+        self.assertEqual(response.read(), 'ok')
+        connections.close()
+        self.assertEqual(self.server.requests[0][0],
+                         'GET http://cache.example.com:8080/1.0/a HTTP/1.1')
+
+    def test_connects_to_https_server_directly_without_proxy(self):
+        connection = morphlib.httpconnection.HTTPConnections(
+            'https://cache.example.com/')._connection()
+        self.assertEqual(connection.host, 'cache.example.com')
+        self.assertEqual(connection._tunnel_host, None)
+
+    def test_tunnels_to_https_server_through_proxy(self):
+        os.environ['https_proxy'] = 'http://proxy.example.com:3128/'
+        connection = morphlib.httpconnection.HTTPConnections(
+            'https://cache.example.com:8443/')._connection()
+        self.assertEqual((connection.host, connection.port),
+                         ('proxy.example.com', 3128))
+        self.assertEqual((connection._tunnel_host, connection._tunnel_port),
+                         ('cache.example.com', 8443))
+
+
+class ProxyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = os.environ.copy()
+        for name in ('http_proxy', 'https_proxy', 'no_proxy'):
+            os.environ.pop(name, None)
+            os.environ.pop(name.upper(), None)
+        self.connections = morphlib.httpconnection.HTTPConnections(
+            'http://cache.example.com:8080/')
+        self.parts = urlparse.urlsplit(self.connections.server_url)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_connects_directly_without_proxy(self):
+        self.assertEqual(self.connections._proxy_netloc(self.parts), None)
+
+    def test_uses_proxy_from_environment(self):
+        os.environ['http_proxy'] = 'http://proxy.example.com:3128/'
+        self.assertEqual(self.connections._proxy_netloc(self.parts),
+                         'proxy.example.com:3128')
+
+    def test_accepts_proxy_without_scheme(self):
+        os.environ['http_proxy'] = 'proxy.example.com:3128'
+        self.assertEqual(self.connections._proxy_netloc(self.parts),
+                         'proxy.example.com:3128')
+
+    def test_bypasses_proxy_for_no_proxy_hosts(self):
+        os.environ['http_proxy'] = 'http://proxy.example.com:3128/'
+        os.environ['no_proxy'] = 'localhost,example.com'
+        self.assertEqual(self.connections._proxy_netloc(self.parts), None)
@@ -15,10 +15,14 @@
 
 
 import collections
+import errno
+import logging
 import os
+import sqlite3
 import time
 
 import morphlib
+from morphlib.savefile import SaveFile
 
 
 class LocalArtifactCache(object):
@@ -43,26 +47,66 @@ class LocalArtifactCache(object):
 
        Since the cleanup logic will be complicated for other reasons it makes
        sense to put the complication there.
+
+       If an ArtifactCacheIndex is given as ``index``, it is kept up to
+       date with the files saved and used, and used to list and remove
+       them without going through every file in the cache. If the index
+       cannot be used, because it is locked, damaged or read-only, the
+       cache goes on without it.
        '''
 
-    def __init__(self, cachefs):
+    def __init__(self, cachefs, index=None):
         self.cachefs = cachefs
+        self.index = index
+
+    def _save_file(self, filename):
+        if self.index is None:
+            return morphlib.savefile.SaveFile(filename, mode='w')
+        return _IndexedSaveFile(self, filename, mode='w')
+
+    def _index_failed(self, e):
+        logging.warning('Not using artifact cache index %s: %s' %
+                        (self.index.filename, e))
+        self.index = None
+
+    def _add_to_index(self, name):
+        if self.index is not None:
+            try:
+                self.index.add(name)
+            except sqlite3.Error as e:
+                self._index_failed(e)
+
+    def flush(self):
+        '''Write any uses of artifacts not yet written to the index.'''
+        if self.index is not None:
+            try:
+                self.index.flush()
+            except sqlite3.Error as e:
+                self._index_failed(e)
 
     def put(self, artifact):
         filename = self.artifact_filename(artifact)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._save_file(filename)
 
     def put_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._save_file(filename)
 
     def put_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._save_file(filename)
+
+    def _touch(self, filename):
+        os.utime(filename, None)
+        if self.index is not None:
+            try:
+                self.index.touch(os.path.basename(filename))
+            except sqlite3.Error as e:
+                self._index_failed(e)
 
     def _has_file(self, filename):
         if os.path.exists(filename):
-            os.utime(filename, None)
+            self._touch(filename)
             return True
         return False
 
@@ -80,12 +124,12 @@ class LocalArtifactCache(object):
 
     def get(self, artifact):
         filename = self.artifact_filename(artifact)
-        os.utime(filename, None)
+        self._touch(filename)
         return open(filename)
 
     def get_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        os.utime(filename, None)
+        self._touch(filename)
         return open(filename)
 
     def get_source_metadata_filename(self, source, cachekey, name):
@@ -93,7 +137,7 @@ class LocalArtifactCache(object):
 
     def get_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
-        os.utime(filename, None)
+        self._touch(filename)
         return open(filename)
 
     def _join(self, basename):
@@ -123,6 +167,22 @@ class LocalArtifactCache(object):
          '''
         for filename in self.cachefs.walkfiles():
             self.cachefs.remove(filename)
+        if self.index is not None:
+            try:
+                self.index.clear()
+            except sqlite3.Error as e:
+                self._index_failed(e)
+
+    def _index_contents(self):
+        if self.index is None:
+            return None
+        try:
+            if self.index.needs_rebuild():
+                self.index.rebuild()
+            return self.index.contents()
+        except sqlite3.Error as e:
+            self._index_failed(e)
+            return None
 
     def list_contents(self):
         '''Return the set of sources cached and related information.
@@ -130,11 +190,18 @@ class LocalArtifactCache(object):
            returns a [(cache_key, set(artifacts), last_used)]
 
         '''
+        contents = self._index_contents()
+        if contents is not None:
+            return ((cachekey, artifacts, last_used)
+                    for cachekey, artifacts, last_used, size in contents)
+
         CacheInfo = collections.namedtuple('CacheInfo', ('artifacts', 'mtime'))
         contents = collections.defaultdict(lambda: CacheInfo(set(), 0))
         for filename in self.cachefs.walkfiles():
-            cachekey = filename[:63]
-            artifact = filename[65:]
+            if '.' not in filename:
+                # Files being saved have temporary names.
+                continue
+            cachekey, artifact = filename.lstrip('/').split('.', 1)
             artifacts, max_mtime = contents[cachekey]
             artifacts.add(artifact)
             art_info = self.cachefs.getinfo(filename)
@@ -144,8 +211,60 @@ class LocalArtifactCache(object):
         return ((cache_key, info.artifacts, info.mtime)
                 for cache_key, info in contents.iteritems())
 
+    def list_usage(self):
+        '''Return the space used by each cached source, and its last use.
+
+           returns a [(cache_key, size_in_bytes, last_used)]
+
+        '''
+        contents = self._index_contents()
+        if contents is not None:
+            return [(cachekey, size, last_used)
+                    for cachekey, artifacts, last_used, size in contents]
+
+        usage = collections.defaultdict(lambda: (0, 0))
+        for filename in self.cachefs.walkfiles():
+            if '.' not in filename:
+                continue
+            cachekey = filename.lstrip('/').split('.', 1)[0]
+            st = os.stat(self._join(filename))
+            size, last_used = usage[cachekey]
+            usage[cachekey] = (size + st.st_size,
+                               max(last_used, st.st_mtime))
+        return [(cachekey, size, last_used)
+                for cachekey, (size, last_used) in usage.iteritems()]
+
     def remove(self, cachekey):
         '''Remove all artifacts associated with the given cachekey.'''
+        names = None
+        if self.index is not None:
+            try:
+                names = self.index.forget(cachekey)
+            except sqlite3.Error as e:
+                self._index_failed(e)
+        if names is not None:
+            for name in names:
+                try:
+                    os.remove(self._join(name))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            return
+
         for filename in (x for x in self.cachefs.walkfiles()
-                         if x.startswith(cachekey)):
+                         if x.lstrip('/').startswith(cachekey + '.')):
             self.cachefs.remove(filename)
+
+
+class _IndexedSaveFile(SaveFile):
+
+    '''A file saved in the artifact cache, added to its index when closed.'''
+
+    def __init__(self, cache, filename, *args, **kwargs):
+        SaveFile.__init__(self, filename, *args, **kwargs)
+        self._cache = cache
+
+    def close(self):
+        ret = SaveFile.close(self)
+        self._cache._add_to_index(os.path.basename(self.real_filename))
+        return ret
@@ -14,8 +14,11 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import logging
 import unittest
 import os
+import shutil
+import tempfile
 
 import fs.tempfs
 
@@ -53,14 +56,17 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.devel_artifact = morphlib.artifact.Artifact(
             self.source, 'chunk-devel')
 
+    def new_cache(self):
+        return morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
     def test_artifact_filename(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
         filename = cache.artifact_filename(self.devel_artifact)
         expected_name = self.tempfs.getsyspath(self.devel_artifact.basename())
         self.assertEqual(filename, expected_name)
 
     def test_get_source_metadata_filename(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
         artifact = self.devel_artifact
         source = self.source
         name = 'foobar'
@@ -72,7 +78,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertEqual(filename, expected_name)
 
     def test_put_artifacts_and_check_whether_the_cache_has_them(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -88,7 +94,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertTrue(cache.has(self.devel_artifact))
 
     def test_put_artifacts_and_get_them_afterwards(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -117,7 +123,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertEqual(stored_data, 'devel')
 
     def test_put_check_and_get_artifact_metadata(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put_artifact_metadata(self.runtime_artifact, 'log')
         handle.write('log line 1\nlog line 2\n')
@@ -133,7 +139,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertEqual(stored_metadata, 'log line 1\nlog line 2\n')
 
     def test_put_check_and_get_source_metadata(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put_source_metadata(self.source, 'mycachekey', 'log')
         handle.write('source log line 1\nsource log line 2\n')
@@ -150,7 +156,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
                          'source log line 1\nsource log line 2\n')
 
     def test_clears_artifact_cache(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -161,7 +167,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertFalse(cache.has(self.runtime_artifact))
 
     def test_put_artifacts_and_list_them_afterwards(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -176,7 +182,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertEqual(len(list(cache.list_contents())), 1)
 
     def test_put_artifacts_and_remove_them_afterwards(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -190,3 +196,158 @@ class LocalArtifactCacheTests(unittest.TestCase):
         cache.remove(key)
 
         self.assertEqual(len(list(cache.list_contents())), 0)
+
+    def test_lists_size_of_each_source(self):
+        cache = self.new_cache()
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+        handle = cache.put(self.devel_artifact)
+        handle.write('devel')
+        handle.close()
+
+        (cachekey, size, last_used), = cache.list_usage()
+        self.assertEqual(cachekey, self.source.cache_key)
+        self.assertEqual(size, len('runtime') + len('devel'))
+
+    def test_lists_ignore_files_being_saved(self):
+        cache = self.new_cache()
+        with open(self.tempfs.getsyspath('tmpABCDEF'), 'w') as f:
+            f.write('partial')
+        self.assertEqual(list(cache.list_contents()), [])
+        self.assertEqual(cache.list_usage(), [])
+
+
+class IndexedLocalArtifactCacheTests(LocalArtifactCacheTests):
+
+    def setUp(self):
+        LocalArtifactCacheTests.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.index = morphlib.artifactcacheindex.ArtifactCacheIndex(
+            os.path.join(self.tempdir, 'artifacts.index'),
+            self.tempfs.getsyspath('/'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_cache(self):
+        return morphlib.localartifactcache.LocalArtifactCache(self.tempfs,
+                                                              self.index)
+
+    def test_remove_only_removes_files_of_the_cache_key(self):
+        cache = self.new_cache()
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+        other = self.tempfs.getsyspath('1' * 64 + '.chunk.other')
+        with open(other, 'w') as f:
+            f.write('other')
+
+        cache.remove(self.source.cache_key)
+
+        self.assertFalse(cache.has(self.runtime_artifact))
+        self.assertTrue(os.path.exists(other))
+        self.assertEqual([c[0] for c in cache.list_contents()], ['1' * 64])
+
+    def test_lists_files_saved_by_other_means_after_rebuild(self):
+        cache = self.new_cache()
+        with open(self.tempfs.getsyspath('1' * 64 + '.chunk.other'),
+                  'w') as f:
+            f.write('other')
+
+        self.index.rebuild()
+        self.assertEqual([c[0] for c in cache.list_contents()], ['1' * 64])
+
+    def test_flush_writes_uses_to_index(self):
+        cache = self.new_cache()
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+        os.utime(cache.artifact_filename(self.runtime_artifact), (100, 100))
+        self.index.rebuild()
+
+        self.assertTrue(cache.has(self.runtime_artifact))
+        cache.flush()
+        cache.index = None
+        cache.flush()
+        (cachekey, names, last_used, size), = self.index.contents()
+        self.assertTrue(last_used > 100)
+
+    def new_cache_with_broken_index(self):
+        cache = self.new_cache()
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+        # Any use of the index now fails, as when it is locked or damaged.
+        self.index._db.close()
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        return cache
+
+    def test_uses_artifacts_if_index_fails(self):
+        cache = self.new_cache_with_broken_index()
+        self.index.flush_count = 1
+        self.assertTrue(cache.has(self.runtime_artifact))
+        self.assertEqual(cache.index, None)
+        self.assertEqual(cache.get(self.runtime_artifact).read(), 'runtime')
+
+    def test_saves_artifacts_if_index_fails(self):
+        cache = self.new_cache_with_broken_index()
+        handle = cache.put(self.devel_artifact)
+        handle.write('devel')
+        handle.close()
+        self.assertEqual(cache.index, None)
+        self.assertTrue(cache.has(self.devel_artifact))
+
+    def test_flush_gives_up_if_index_fails(self):
+        cache = self.new_cache_with_broken_index()
+        self.assertTrue(cache.has(self.runtime_artifact))
+        cache.flush()
+        self.assertEqual(cache.index, None)
+
+    def test_lists_artifacts_if_index_fails(self):
+        cache = self.new_cache_with_broken_index()
+        self.assertEqual([c[0] for c in cache.list_contents()],
+                         [self.source.cache_key])
+        self.assertEqual(cache.index, None)
+
+    def test_lists_usage_if_index_fails(self):
+        cache = self.new_cache_with_broken_index()
+        self.assertEqual([c[0] for c in cache.list_usage()],
+                         [self.source.cache_key])
+        self.assertEqual(cache.index, None)
+
+    def test_removes_artifacts_if_index_fails(self):
+        cache = self.new_cache_with_broken_index()
+        cache.remove(self.source.cache_key)
+        self.assertEqual(cache.index, None)
+        self.assertFalse(cache.has(self.runtime_artifact))
+
+    def test_clears_artifacts_if_index_fails(self):
+        cache = self.new_cache_with_broken_index()
+        cache.clear()
+        self.assertEqual(cache.index, None)
+        self.assertFalse(cache.has(self.runtime_artifact))
+
+    def test_remove_ignores_files_already_removed(self):
+        cache = self.new_cache()
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+        os.remove(cache.artifact_filename(self.runtime_artifact))
+
+        cache.remove(self.source.cache_key)
+        self.assertEqual(list(cache.list_contents()), [])
+
+    def test_remove_reports_other_errors(self):
+        cache = self.new_cache()
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+        filename = cache.artifact_filename(self.runtime_artifact)
+        os.remove(filename)
+        os.mkdir(filename)
+
+        self.assertRaises(OSError, cache.remove, self.source.cache_key)
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import collections
 import logging
 import os
 import re
@@ -22,6 +23,7 @@ import urlparse
 import string
 import sys
 import tempfile
+import threading
 
 import cliapp
 import fs.osfs
@@ -91,9 +93,15 @@ class LocalRepoCache(object):
     git server, we first try to download a tarball from a url, and
     if that works, we unpack the tarball.
 
+    Each cached repository keeps a ``git cat-file`` process running to
+    read objects from. Only the ``max_open_repos`` repositories most
+    recently got with ``get_repo`` keep theirs, and ``close`` stops them
+    all once the cache is no longer needed.
+
     '''
 
-    def __init__(self, app, cachedir, resolver, tarball_base_url=None):
+    def __init__(self, app, cachedir, resolver, tarball_base_url=None,
+                 max_open_repos=64):
         self._app = app
         self.fs = fs.osfs.OSFS('/')
         self._cachedir = cachedir
@@ -102,6 +110,9 @@ class LocalRepoCache(object):
             tarball_base_url += '/'  # pragma: no cover
         self._tarball_base_url = tarball_base_url
         self._cached_repo_objects = {}
+        self._max_open_repos = max_open_repos
+        self._recently_used = collections.OrderedDict()
+        self._recently_used_lock = threading.Lock()
 
     def _git(self, args, **kwargs):  # pragma: no cover
         '''Execute git command.
@@ -234,15 +245,38 @@ class LocalRepoCache(object):
         '''Return an object representing a cached repository.'''
 
         if reponame in self._cached_repo_objects:
-            return self._cached_repo_objects[reponame]
+            repo = self._cached_repo_objects[reponame]
         else:
             repourl = self._resolver.pull_url(reponame)
             path = self._cache_name(repourl)
-            if self.fs.exists(path):
-                repo = self._new_cached_repo_instance(reponame, repourl, path)
-                self._cached_repo_objects[reponame] = repo
-                return repo
-        raise NotCached(reponame)
+            if not self.fs.exists(path):
+                raise NotCached(reponame)
+            repo = self._new_cached_repo_instance(reponame, repourl, path)
+            self._cached_repo_objects[reponame] = repo
+        self._use(reponame, repo)
+        return repo
+
+    def _use(self, reponame, repo):
+        with self._recently_used_lock:
+            self._recently_used.pop(reponame, None)
+            self._recently_used[reponame] = repo
+            evicted = []
+            while len(self._recently_used) > self._max_open_repos:
+                evicted.append(self._recently_used.popitem(last=False)[1])
+        for old_repo in evicted:
+            old_repo.close()
+
+    def close(self):
+        '''Stop the git processes kept running for the cached repos.
+
+        They are started again if the repos are read later.
+
+        '''
+
+        with self._recently_used_lock:
+            self._recently_used.clear()
+        for repo in self._cached_repo_objects.values():
+            repo.close()
 
     def get_updated_repo(self, reponame): # pragma: no cover
         '''Return object representing cached repository, which is updated.'''
@@ -170,3 +170,22 @@ class LocalRepoCacheTests(unittest.TestCase):
         self.lrc.cache_repo('file:///local/repo')
         cached = self.lrc.get_repo('file:///local/repo')
         assert cached.path == '/local/repo'
+
+    def test_closes_least_recently_used_repos(self):
+        closed = []
+
+        def new_cached_repo_instance(*args):
+            repo = self.new_cached_repo_instance(*args)
+            repo.close = lambda: closed.append(repo.original_name)
+            return repo
+
+        self.lrc._new_cached_repo_instance = new_cached_repo_instance
+        self.lrc._max_open_repos = 2
+        for reponame in ('upstream:a', 'upstream:b', 'upstream:a',
+                         'upstream:c'):
+            self.lrc.cache_repo(reponame)
+        self.assertEqual(closed, ['upstream:b'])
+        self.lrc.close()
+        self.assertEqual(sorted(closed),
+                         ['upstream:a', 'upstream:b', 'upstream:b',
+                          'upstream:c'])
@@ -42,47 +42,215 @@ class MorphologyFactory(object):
     '''A way of creating morphologies which will provide a default'''
 
     def __init__(self, local_repo_cache, remote_repo_cache=None,
-                 status_cb=None):
+                 status_cb=None, resolution_cache=None):
         self._lrc = local_repo_cache
         self._rrc = remote_repo_cache
+        self._cache = resolution_cache
 
         null_status_function = lambda **kwargs: None
         self.status = status_cb or null_status_function
 
-    def get_morphology(self, reponame, sha1, filename):
-        morph_name = os.path.splitext(os.path.basename(filename))[0]
-        loader = morphlib.morphloader.MorphologyLoader()
+        self._prefetched = {}
+        self._not_found = set()
+        self._unreadable = set()
+        self._build_systems = {}
+
+    def prefetch(self, keys):
+        '''Get the remote morphologies among ``keys`` in one request.
+
+        Each key is a (reponame, sha1, filename) tuple. Later calls to
+        get_morphology for these keys use what was fetched, rather than
+        asking the remote repo cache for each file separately. The build
+        systems of the commits without the morphology are then detected
+        in one more request.
+
+        '''
+
+        if self._rrc is None:
+            return
+        keys = [key for key in keys if not self._lrc.has_repo(key[0])]
+        to_fetch = [key for key in keys
+                    if key not in self._prefetched
+                    and key not in self._not_found
+                    and key not in self._unreadable]
+        if self._cache is not None:
+            to_fetch = [key for key in to_fetch
+                        if self._cache.get_file(*key) is None]
+        if to_fetch:
+            self.status(msg="Retrieving %(count)d morphologies from the "
+                            "remote git cache", count=len(to_fetch),
+                        chatty=True)
+            found, missing, failed = self._rrc.cat_files(to_fetch)
+            self._prefetched.update(found)
+            self._not_found.update(missing)
+            self._unreadable.update(failed)
+
+        self._prefetch_build_systems(
+            (reponame, sha1) for reponame, sha1, filename in keys
+            if self._is_missing(reponame, sha1, filename))
+
+    def _is_missing(self, reponame, sha1, filename):
+        key = (reponame, sha1, filename)
+        if key in self._not_found or key in self._unreadable:
+            return True
+        return (self._cache is not None and
+                self._cache.get_file(reponame, sha1, filename) is False)
+
+    def _prefetch_build_systems(self, commits):
+        trees = {}
+        for reponame, sha1 in commits:
+            tree = self._tree(reponame, sha1)
+            if tree is not None and self._known_build_system(tree) is None:
+                trees[reponame, sha1] = tree
+        if not trees:
+            return
+        self.status(msg="Listing %(count)d trees in the remote git cache",
+                    count=len(trees), chatty=True)
+        for (reponame, sha1), file_list in \
+                self._rrc.ls_trees(trees).iteritems():
+            if self._cache is not None:
+                self._cache.put_file_list(reponame, sha1, file_list)
+            self._remember_build_system(trees[reponame, sha1],
+                                        self._detect(file_list))
+
+    def _cat_file(self, reponame, sha1, filename):
+        key = (reponame, sha1, filename)
+        if key in self._prefetched:
+            return self._prefetched.pop(key)
+        if key in self._not_found:
+            return None
+        if key in self._unreadable:
+            raise morphlib.remoterepocache.CatFileError(
+                reponame, sha1, filename)
+        self.status(msg="Retrieving %(reponame)s %(sha1)s %(filename)s"
+                    " from the remote git cache.",
+                    reponame=reponame, sha1=sha1, filename=filename,
+                    chatty=True)
+        return self._rrc.cat_file(reponame, sha1, filename)
+
+    def _read_file(self, reponame, sha1, filename):
+        '''Return a file's contents, or None if it does not exist.
+
+        Raise CatFileError if the remote repo cache could not read the
+        file. It answers that way for files that do not exist, but also
+        for commits it does not have, so that is not known for sure.
+
+        '''
+
         if self._lrc.has_repo(reponame):
             self.status(msg="Looking for %s in local repo cache" % filename,
                         chatty=True)
+            repo = self._lrc.get_repo(reponame)
             try:
-                repo = self._lrc.get_repo(reponame)
-                text = repo.read_file(filename, sha1)
-                morph = loader.load_from_string(text)
+                return repo.read_file(filename, sha1)
             except IOError:
-                morph = None
-                file_list = repo.list_files(ref=sha1, recurse=False)
+                return None
         elif self._rrc is not None:
-            self.status(msg="Retrieving %(reponame)s %(sha1)s %(filename)s"
-                        " from the remote git cache.",
-                        reponame=reponame, sha1=sha1, filename=filename,
-                        chatty=True)
-            try:
-                text = self._rrc.cat_file(reponame, sha1, filename)
-                morph = loader.load_from_string(text)
-            except morphlib.remoterepocache.CatFileError:
-                morph = None
-                file_list = self._rrc.ls_tree(reponame, sha1)
+            return self._cat_file(reponame, sha1, filename)
         else:
             raise NotcachedError(reponame)
 
+    def _read_file_cached(self, reponame, sha1, filename):
+        '''Return a file's contents, or None if it cannot be read.'''
+
+        if self._cache is not None:
+            text = self._cache.get_file(reponame, sha1, filename)
+            if text is False:
+                return None
+            elif text is not None:
+                return text
+
+        try:
+            text = self._read_file(reponame, sha1, filename)
+        except morphlib.remoterepocache.CatFileError:
+            # Not remembered, since the file may exist after all.
+            return None
+        if self._cache is not None:
+            if text is None:
+                self._cache.put_missing_file(reponame, sha1, filename)
+            else:
+                self._cache.put_file(reponame, sha1, filename, text)
+        return text
+
+    def _list_files(self, reponame, sha1):
+        '''Return the files at the top of a commit's tree.'''
+
+        if self._cache is not None:
+            file_list = self._cache.get_file_list(reponame, sha1)
+            if file_list is not None:
+                return file_list
+
+        if self._lrc.has_repo(reponame):
+            repo = self._lrc.get_repo(reponame)
+            file_list = repo.list_files(ref=sha1, recurse=False)
+        else:
+            file_list = self._rrc.ls_tree(reponame, sha1)
+
+        if self._cache is not None:
+            self._cache.put_file_list(reponame, sha1, file_list)
+        return file_list
+
+    def _tree(self, reponame, sha1):
+        '''Return the tree SHA1 of a commit, or None if it is not known.'''
+
+        if self._cache is not None:
+            tree = self._cache.get_tree(reponame, sha1)
+            if tree is not None:
+                return tree
+        if self._lrc.has_repo(reponame):
+            return self._lrc.get_repo(reponame).resolve_ref_to_tree(sha1)
+        return None
+
+    def _detect(self, file_list):
+        bs = morphlib.buildsystem.detect_build_system(file_list)
+        return False if bs is None else bs.name
+
+    def _known_build_system(self, tree):
+        if tree is None:
+            return None
+        if tree in self._build_systems:
+            return self._build_systems[tree]
+        if self._cache is not None:
+            return self._cache.get_build_system(tree)
+        return None
+
+    def _remember_build_system(self, tree, name):
+        if tree is None:
+            return
+        self._build_systems[tree] = name
+        if self._cache is not None:
+            self._cache.put_build_system(tree, name)
+
+    def _build_system(self, reponame, sha1):
+        '''Return the name of the build system a commit uses, or False.
+
+        The build system only depends on the files at the top of the
+        commit's tree, so it is remembered by tree SHA1, and the tree
+        is only listed if it has not been seen before.
+
+        '''
+
+        tree = self._tree(reponame, sha1)
+        name = self._known_build_system(tree)
+        if name is None:
+            name = self._detect(self._list_files(reponame, sha1))
+            self._remember_build_system(tree, name)
+        return name
+
+    def get_morphology(self, reponame, sha1, filename):
+        morph_name = os.path.splitext(os.path.basename(filename))[0]
+        loader = morphlib.morphloader.MorphologyLoader()
+        text = self._read_file_cached(reponame, sha1, filename)
+        morph = None if text is None else loader.load_from_string(text)
+
         if morph is None:
             self.status(msg="File %s doesn't exist: attempting to infer "
                             "chunk morph from repo's build system"
                         % filename, chatty=True)
-            bs = morphlib.buildsystem.detect_build_system(file_list)
-            if bs is None:
+            name = self._build_system(reponame, sha1)
+            if not name:
                 raise MorphologyNotFoundError(filename)
+            bs = morphlib.buildsystem.lookup_build_system(name)
             morph = bs.get_morphology(morph_name)
             loader.validate(morph)
             loader.set_commands(morph)
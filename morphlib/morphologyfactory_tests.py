@@ -37,6 +37,9 @@ class FakeRemoteRepoCache(object):
     def ls_tree(self, reponame, sha1):
         return []
 
+    def ls_trees(self, pairs):
+        return {}
+
 
 class FakeLocalRepo(object):
 
@@ -133,6 +136,9 @@ class FakeLocalRepo(object):
     def list_files(self, ref, recurse):
         return self.morphologies.keys()
 
+    def resolve_ref_to_tree(self, ref):
+        return 'a' * 40
+
 
 class FakeLocalRepoCache(object):
 
@@ -279,3 +285,141 @@ class MorphologyFactoryTests(unittest.TestCase):
             morphlib.morphloader.EmptyStratumError,
             self.mf.get_morphology, 'reponame', 'sha1', 'stratum-empty.morph')
 
+
+    def test_uses_prefetched_remote_morphologies(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        requests = []
+        text = self.rrc.cat_file('reponame', 'sha1', 'chunk.morph')
+
+        def cat_files(keys):
+            requests.append(keys)
+            return ({('reponame', 'sha1', 'chunk.morph'): text},
+                    set([('reponame', 'sha1', 'assumed-remote.morph')]),
+                    set())
+
+        self.rrc.cat_files = cat_files
+        self.rrc.cat_file = self.noremotefile
+        self.rrc.ls_tree = self.autotoolsbuildsystem
+        self.mf.prefetch([('reponame', 'sha1', 'chunk.morph'),
+                          ('reponame', 'sha1', 'assumed-remote.morph')])
+        self.assertEqual(len(requests), 1)
+        morph = self.mf.get_morphology('reponame', 'sha1', 'chunk.morph')
+        self.assertEqual(morph['name'], 'chunk')
+        morph = self.mf.get_morphology('reponame', 'sha1',
+                                       'assumed-remote.morph')
+        self.assertEqual(morph['name'], 'assumed-remote')
+
+    def test_uses_resolution_cache(self):
+        cache = morphlib.resolutioncache.ResolutionCache()
+        mf = MorphologyFactory(self.lrc, self.rrc, resolution_cache=cache)
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        mf.get_morphology('reponame', sha1, 'chunk.morph')
+        self.lr.read_file = self.nolocalmorph
+        self.lr.list_files = self.autotoolsbuildsystem
+        mf.get_morphology('reponame', sha1, 'assumed-local.morph')
+
+        self.lr.read_file = self.nolocalfile
+        self.lr.list_files = self.nolocalfile
+        for name in ('chunk', 'assumed-local'):
+            morph = mf.get_morphology('reponame', sha1, name + '.morph')
+            self.assertEqual(morph['name'], name)
+
+    def test_detects_build_system_once_per_tree(self):
+        listed = []
+
+        def list_files(ref, recurse):
+            listed.append(ref)
+            return ['configure.in']
+
+        self.lr.read_file = self.nolocalmorph
+        self.lr.list_files = list_files
+        for sha1 in ('sha1', 'other-sha1-with-same-tree'):
+            morph = self.mf.get_morphology('reponame', sha1,
+                                           'assumed-local.morph')
+            self.assertEqual(morph['build-system'], 'autotools')
+        self.assertEqual(listed, ['sha1'])
+
+    def test_prefetches_remote_build_systems(self):
+        cache = morphlib.resolutioncache.ResolutionCache()
+        mf = MorphologyFactory(self.lrc, self.rrc, resolution_cache=cache)
+        self.lrc.has_repo = self.doesnothaverepo
+        sha1s = ['e28a23812eadf2fce6583b8819b9c5dbd36b9fb9',
+                 'a4da32f5a81c8bc6d660404724cedc3bc0914a75']
+        for i, sha1 in enumerate(sha1s):
+            cache.put_tree('reponame', sha1, str(i) * 40)
+        keys = [('reponame', sha1, 'chunk.morph') for sha1 in sha1s]
+        requests = []
+
+        def ls_trees(pairs):
+            requests.append(sorted(pairs))
+            return dict((pair, ['configure.in']) for pair in pairs)
+
+        self.rrc.cat_files = lambda keys: ({}, set(keys), set())
+        self.rrc.ls_trees = ls_trees
+        self.rrc.cat_file = self.noremotefile
+        self.rrc.ls_tree = self.nolocalfile
+        mf.prefetch(keys)
+        for key in keys:
+            morph = mf.get_morphology(*key)
+            self.assertEqual(morph['build-system'], 'autotools')
+        self.assertEqual(requests, [[('reponame', sha1)
+                                     for sha1 in sorted(sha1s)]])
+        self.assertEqual(cache.get_build_system('0' * 40), 'autotools')
+
+    def test_prefetch_does_nothing_without_remote_repo_cache(self):
+        self.lmf.prefetch([('reponame', 'sha1', 'chunk.morph')])
+
+    def test_prefetches_each_file_only_once(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        key = ('reponame', 'sha1', 'chunk.morph')
+        requests = []
+
+        def cat_files(keys):
+            requests.append(keys)
+            return {}, set(), set(keys)
+
+        self.rrc.cat_files = cat_files
+        self.mf.prefetch([key])
+        self.mf.prefetch([key])
+        self.assertEqual(requests, [[key]])
+
+    def test_remembers_files_the_server_says_do_not_exist(self):
+        cache = morphlib.resolutioncache.ResolutionCache()
+        mf = MorphologyFactory(self.lrc, self.rrc, resolution_cache=cache)
+        self.lrc.has_repo = self.doesnothaverepo
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        key = ('reponame', sha1, 'assumed-remote.morph')
+        self.rrc.cat_files = lambda keys: ({}, set(keys), set())
+        self.rrc.cat_file = self.noremotefile
+        self.rrc.ls_tree = self.autotoolsbuildsystem
+        mf.prefetch([key])
+        morph = mf.get_morphology(*key)
+        self.assertEqual(morph['name'], 'assumed-remote')
+        self.assertEqual(cache.get_file(*key), False)
+
+    def test_does_not_remember_files_the_server_could_not_read(self):
+        cache = morphlib.resolutioncache.ResolutionCache()
+        mf = MorphologyFactory(self.lrc, self.rrc, resolution_cache=cache)
+        self.lrc.has_repo = self.doesnothaverepo
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        keys = [('reponame', sha1, 'prefetched.morph'),
+                ('reponame', sha1, 'single.morph')]
+        self.rrc.cat_files = lambda keys: ({}, set(), set(keys[:1]))
+        self.rrc.cat_file = self.noremotefile
+        self.rrc.ls_tree = self.autotoolsbuildsystem
+        mf.prefetch(keys[:1])
+        for key in keys:
+            morph = mf.get_morphology(*key)
+            self.assertEqual(morph['build-system'], 'autotools')
+            self.assertEqual(cache.get_file(*key), None)
+
+    def test_uses_file_list_from_resolution_cache(self):
+        cache = morphlib.resolutioncache.ResolutionCache()
+        mf = MorphologyFactory(self.lrc, self.rrc, resolution_cache=cache)
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        cache.put_missing_file('reponame', sha1, 'assumed-local.morph')
+        cache.put_file_list('reponame', sha1, ['configure.in'])
+        self.lr.read_file = self.nolocalmorph
+        self.lr.list_files = self.nolocalfile
+        morph = mf.get_morphology('reponame', sha1, 'assumed-local.morph')
+        self.assertEqual(morph['build-system'], 'autotools')
@@ -95,8 +95,7 @@ class WorkerBuild(cliapp.Plugin):
         
         distbuild.add_crash_conditions(self.app.settings['crash-condition'])
 
-        serialized = sys.stdin.readline()
-        artifact = distbuild.deserialise_artifact(serialized)
+        artifact = distbuild.deserialise_artifact(sys.stdin)
         
         bc = morphlib.buildcommand.BuildCommand(self.app)
 
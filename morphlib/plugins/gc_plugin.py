@@ -19,7 +19,6 @@ import os
 import shutil
 import time
 
-import fs.osfs
 import cliapp
 
 import morphlib
@@ -29,7 +28,7 @@ class GCPlugin(cliapp.Plugin):
 
     def enable(self):
         self.app.add_subcommand('gc', self.gc,
-                                arg_synopsis='')
+                                arg_synopsis='[REPO REF FILENAME]...')
         self.app.settings.integer(['cachedir-artifact-delete-older-than'],
                                   'always delete artifacts older than this '
                                   'period in seconds, (default: 1 week)',
@@ -42,6 +41,20 @@ class GCPlugin(cliapp.Plugin):
                                   metavar='PERIOD',
                                   group="Storage Options",
                                   default=(60*60*24))
+        self.app.settings.bytesize(['cachedir-artifact-free-target'],
+                                   'when artifacts must be removed to make '
+                                   'space, remove enough to leave SIZE bytes '
+                                   'free, if that is more than '
+                                   'cachedir-min-space, so that gc is not '
+                                   'needed again by the next build '
+                                   '(default: %default)',
+                                   metavar='SIZE',
+                                   group="Storage Options",
+                                   default='0')
+        self.app.settings.boolean(['gc-dry-run'],
+                                  'report what gc would remove, without '
+                                  'removing anything',
+                                  group="Storage Options")
 
     def disable(self):
         pass
@@ -66,6 +79,21 @@ class GCPlugin(cliapp.Plugin):
            won't be e.g. if morph gets a SIGKILL or the machine running
            morph loses power.
 
+           Artifacts that may be removed are ranked by their size and how
+           long ago they were last used, and removed in batches until
+           there is --cachedir-artifact-free-target (or
+           --cachedir-min-space, if that is more) free space.
+
+           Command line arguments:
+
+           * `REPO REF FILENAME` name a system morphology. The artifacts
+             needed to build it are never removed, so the next build of
+             it does not need to fetch or build them again. Any number
+             of systems may be given.
+
+           With --gc-dry-run, nothing is removed. Instead, what would be
+           removed and how much space it would free is reported.
+
         '''
 
         tempdir = self.app.settings['tempdir']
@@ -74,25 +102,69 @@ class GCPlugin(cliapp.Plugin):
             morphlib.util.unify_space_requirements(
                 tempdir, self.app.settings['tempdir-min-space'],
                 cachedir, self.app.settings['cachedir-min-space'])
+        pinned = self.find_pinned_cache_keys(args)
 
         self.cleanup_tempdir(tempdir, tempdir_min_space)
-        self.cleanup_cachedir(cachedir, cachedir_min_space)
-        
+        self.cleanup_cachedir(cachedir, cachedir_min_space, pinned)
+
+    def find_pinned_cache_keys(self, args):
+        '''Return the cache keys of everything needed to build systems.'''
+
+        pinned = set()
+        if not args:
+            return pinned
+        build_command = morphlib.buildcommand.BuildCommand(self.app)
+        for repo_name, ref, filename in self.app.itertriplets(args):
+            self.app.status(msg='Finding artifacts of %(filename)s to keep',
+                            filename=filename)
+            srcpool = build_command.create_source_pool(
+                repo_name, ref, filename)
+            root_artifact = build_command.resolve_artifacts(srcpool)
+            pinned.update(a.source.cache_key for a in root_artifact.walk())
+        return pinned
+
+    def report(self, text):
+        self.app.output.write('%s\n' % text)
+
+    def disk_usage(self, path):
+        '''Return the space used by the files below ``path``.'''
+
+        used = 0
+        for dirname, subdirs, basenames in os.walk(path):
+            for basename in subdirs + basenames:
+                try:
+                    st = os.lstat(os.path.join(dirname, basename))
+                except OSError:
+                    pass
+                else:
+                    used += st.st_blocks * 512
+        return used
+
     def cleanup_tempdir(self, temp_path, min_space):
         # The subdirectories in tempdir are created at Morph startup time. Code
         # assumes that they exist in various places.
+        dry_run = self.app.settings['gc-dry-run']
+        # In a dry run, the space that would be freed is added up.
+        freed = 0
         self.app.status(msg='Cleaning up temp dir %(temp_path)s',
                         temp_path=temp_path, chatty=True)
-        for subdir in ('deployments', 'failed', 'chunks'):
-            if morphlib.util.get_bytes_free_in_path(temp_path) >= min_space:
+        for subdir in ('deployments', 'failed', 'chunks', 'layers'):
+            free = morphlib.util.get_bytes_free_in_path(temp_path)
+            if free + freed >= min_space:
                 self.app.status(msg='Not Removing subdirectory '
                                     '%(subdir)s, enough space already cleared',
                                 subdir=os.path.join(temp_path, subdir),
                                 chatty=True)
                 break
+            path = os.path.join(temp_path, subdir)
+            if dry_run:
+                used = self.disk_usage(path)
+                self.report('Would remove temp subdirectory %s (%d bytes)'
+                            % (subdir, used))
+                freed += used
+                continue
             self.app.status(msg='Removing temp subdirectory: %(subdir)s',
                             subdir=subdir)
-            path = os.path.join(temp_path, subdir)
             if os.path.exists(path):
                 shutil.rmtree(path)
             os.mkdir(path)
@@ -105,63 +177,106 @@ class GCPlugin(cliapp.Plugin):
             now - self.app.settings['cachedir-artifact-keep-younger-than']
         return always_delete_age, may_delete_age
 
-    def find_deletable_artifacts(self, lac, max_age, min_age):
-        '''Get a list of cache keys in order of how old they are.'''
-        contents = list(lac.list_contents())
-        always = set(cachekey
-                     for cachekey, artifacts, mtime in contents
-                     if mtime < max_age)
-        maybe = ((cachekey, mtime)
-                 for cachekey, artifacts, mtime in contents
-                 if max_age <= mtime < min_age)
-        return always, [cachekey for cachekey, mtime
-                        in sorted(maybe, key=lambda x: x[1])]
-
-    def cleanup_cachedir(self, cache_path, min_space):
-        def sufficient_free():
-            free = morphlib.util.get_bytes_free_in_path(cache_path)
-            return (free >= min_space)
-        if sufficient_free():
+    def rank_deletable_artifacts(self, usage, pinned, max_age, min_age):
+        '''Return the sources that must and may be removed.
+
+        ``usage`` is a list of (cachekey, size, last_used) tuples. Two
+        lists of (cachekey, size) pairs are returned. Sources last used
+        before ``max_age`` must always be removed. Those used before
+        ``min_age`` may be removed, and are given in the order they
+        should be: the most space held for the longest time first,
+        ranked by size multiplied by the time since last use. Pinned
+        sources are never returned.
+
+        '''
+
+        now = time.time()
+        always = []
+        maybe = []
+        for cachekey, size, last_used in usage:
+            if cachekey in pinned:
+                continue
+            if last_used < max_age:
+                always.append((cachekey, size))
+            elif last_used < min_age:
+                maybe.append((size * (now - last_used), cachekey, size))
+        maybe.sort(reverse=True)
+        return always, [(cachekey, size) for rank, cachekey, size in maybe]
+
+    def remove_batch(self, lac, batch):
+        for cachekey, size in batch:
+            if self.app.settings['gc-dry-run']:
+                self.report('Would remove source %s (%d bytes)'
+                            % (cachekey, size))
+                continue
+            self.app.status(msg='Removing source %(cachekey)s',
+                            cachekey=cachekey, chatty=True)
+            lac.remove(cachekey)
+
+    def cleanup_cachedir(self, cache_path, min_space, pinned=()):
+        dry_run = self.app.settings['gc-dry-run']
+        target = max(min_space,
+                     self.app.settings['cachedir-artifact-free-target'])
+        # In a dry run, the space that would be freed is added up.
+        freed = [0]
+
+        def free_space():
+            return morphlib.util.get_bytes_free_in_path(cache_path) + \
+                (freed[0] if dry_run else 0)
+
+        if free_space() >= min_space:
             self.app.status(msg='Not cleaning up cachedir, '
                                 'sufficient space already cleared',
                             chatty=True)
+            if dry_run:
+                self.report('Would not remove any artifacts: %d bytes '
+                            'are free' % free_space())
             return
-        lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(os.path.join(cache_path, 'artifacts')))
+        lac = morphlib.util.new_local_artifact_cache(cache_path)
         max_age, min_age = self.calculate_delete_range()
         logging.debug('Must remove artifacts older than timestamp %d'
                       % max_age)
-        always_delete, may_delete = \
-            self.find_deletable_artifacts(lac, max_age, min_age)
-        removed = 0
-        source_count = len(always_delete) + len(may_delete)
+        usage = lac.list_usage()
+        always_delete, may_delete = self.rank_deletable_artifacts(
+            usage, pinned, max_age, min_age)
+        kept = len([key for key, size, last_used in usage if key in pinned])
         logging.debug('Must remove artifacts %s' % repr(always_delete))
         logging.debug('Can remove artifacts %s' % repr(may_delete))
 
         # Remove all old artifacts
-        for cachekey in always_delete:
-            self.app.status(msg='Removing source %(cachekey)s',
-                            cachekey=cachekey, chatty=True)
-            lac.remove(cachekey)
-            removed += 1
-
-        # Maybe remove remaining middle-aged artifacts
-        for cachekey in may_delete:
-            if sufficient_free():
-                self.app.status(msg='Finished cleaning up cachedir with '
-                                    '%(remaining)d old sources remaining',
-                                remaining=(source_count - removed),
-                                chatty=True)
+        self.remove_batch(lac, always_delete)
+        removed = len(always_delete)
+        freed[0] += sum(size for cachekey, size in always_delete)
+
+        # Remove remaining middle-aged artifacts in batches, each big
+        # enough to reach the target if the sizes are right, checking
+        # the free space only after each batch.
+        while may_delete:
+            needed = target - free_space()
+            if needed <= 0:
                 break
-            self.app.status(msg='Removing source %(cachekey)s',
-                            cachekey=cachekey, chatty=True)
-            lac.remove(cachekey)
-            removed += 1
+            batch_size = 0
+            for count, (cachekey, size) in enumerate(may_delete, 1):
+                batch_size += size
+                if batch_size >= needed:
+                    break
+            batch, may_delete = may_delete[:count], may_delete[count:]
+            self.remove_batch(lac, batch)
+            removed += len(batch)
+            freed[0] += batch_size
+        remaining = len(may_delete)
 
-        if sufficient_free():
+        if dry_run:
+            self.report('Would remove %d sources, freeing %d bytes, and '
+                        'keep %d pinned sources; %d bytes would be free'
+                        % (removed, freed[0], kept, free_space()))
+            return
+        if free_space() >= min_space:
             self.app.status(msg='Made sufficient space in %(cache_path)s '
-                                'after removing %(removed)d sources',
-                            removed=removed, cache_path=cache_path)
+                                'after removing %(removed)d sources, '
+                                '%(remaining)d old sources remaining',
+                            removed=removed, remaining=remaining,
+                            cache_path=cache_path)
             return
         self.app.status(msg='Unable to clear enough space in %(cache_path)s '
                             'after removing %(removed)d sources. Please '
@@ -60,6 +60,9 @@ class ListArtifactsPlugin(cliapp.Plugin):
 
         self.lrc, self.rrc = morphlib.util.new_repo_caches(self.app)
         self.resolver = morphlib.artifactresolver.ArtifactResolver()
+        self.cache_keys = morphlib.util.new_cache_key_store(self.app.settings)
+        self.resolution_cache = morphlib.util.new_resolution_cache(
+            self.app.settings)
 
         artifact_files = set()
         for system_filename in system_filenames:
@@ -87,7 +90,8 @@ class ListArtifactsPlugin(cliapp.Plugin):
         source_pool = morphlib.sourceresolver.create_source_pool(
             self.lrc, self.rrc, repo, ref, system_filename,
             update_repos = not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            resolution_cache=self.resolution_cache)
 
         self.app.status(
             msg='Resolving artifacts for %s' % system_filename, chatty=True)
@@ -106,11 +110,13 @@ class ListArtifactsPlugin(cliapp.Plugin):
             msg='Computing cache keys for %s' % system_filename, chatty=True)
         build_env = morphlib.buildenvironment.BuildEnvironment(
             self.app.settings, system_artifact.source.morphology['arch'])
-        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(
+            build_env, self.cache_keys)
 
         for source in set(a.source for a in system_artifact.walk()):
             source.cache_key = ckc.compute_key(source)
             source.cache_id = ckc.get_cache_id(source)
+        self.cache_keys.save()
 
         artifact_files = set()
         for artifact in system_artifact.walk():
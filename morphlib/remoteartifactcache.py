@@ -15,11 +15,21 @@
 
 
 import cliapp
+import functools
+import httplib
+import json
 import logging
+import Queue
+import shutil
+import socket
+import sys
+import threading
 import urllib
 import urllib2
 import urlparse
 
+import morphlib
+
 
 class HeadRequest(urllib2.Request):  # pragma: no cover
 
@@ -56,8 +66,13 @@ class GetSourceMetadataError(GetError):
 
 class RemoteArtifactCache(object):
 
+    # Number of connections used to download artifacts in parallel by
+    # fetch_artifacts.
+    max_connections = 4
+
     def __init__(self, server_url):
         self.server_url = server_url
+        self._http = morphlib.httpconnection.HTTPConnections(server_url)
 
     def has(self, artifact):
         return self._has_file(artifact.basename())
@@ -90,6 +105,150 @@ class RemoteArtifactCache(object):
         except urllib2.URLError:
             raise GetSourceMetadataError(self, source, cachekey, name)
 
+    def has_files(self, filenames):
+        '''Return the set of ``filenames`` that are in the cache.
+
+        This asks about all the files at once with a POST to the
+        1.0/artifacts method of morph-cache-server, and falls back to
+        asking about each file in turn if the server does not support it.
+
+        '''
+
+        filenames = list(filenames)
+        try:
+            return self._has_files(filenames)
+        except (urllib2.URLError, httplib.HTTPException, socket.error,
+                ValueError), e:
+            logging.debug('Bulk artifact query to %s failed: %s' % (self, e))
+            return set(f for f in filenames if self._has_file(f))
+
+    def fetch_artifacts(self, lac, wanted, log=logging.error):
+        '''Download artifacts and their metadata into a local cache.
+
+        ``wanted`` is a list of ``(artifact, metadata_names)`` pairs.
+        Only files that are missing from the LocalArtifactCache ``lac``
+        are fetched. Before anything is downloaded the server is asked
+        whether it has every file, and if it does not, GetError (or
+        GetArtifactMetadataError) is raised.
+
+        The files are then downloaded over up to ``max_connections``
+        persistent connections at once. Each artifact is committed to
+        the local cache together with its metadata once all of them have
+        been downloaded, so the local cache never has an artifact without
+        its metadata. If a download fails, nothing more is started and
+        GetError is raised for the failing artifact.
+
+        Return the list of artifacts that were fetched.
+
+        '''
+
+        groups = []
+        for artifact, metadata_names in wanted:
+            files = []
+            if not lac.has(artifact):
+                files.append((artifact.basename(), None,
+                              functools.partial(lac.put, artifact)))
+            for name in metadata_names:
+                if not lac.has_artifact_metadata(artifact, name):
+                    files.append((artifact.metadata_basename(name), name,
+                                  functools.partial(lac.put_artifact_metadata,
+                                                    artifact, name)))
+            if files:
+                groups.append((artifact, files))
+
+        if not groups:
+            return []
+
+        present = self.has_files(
+            filename for artifact, files in groups for filename, _, _ in files)
+        for artifact, files in groups:
+            for filename, metadata_name, _ in files:
+                if filename not in present:
+                    log('%s is not in the artifact cache %s'
+                        % (filename, self))
+                    if metadata_name is None:
+                        raise GetError(self, artifact)
+                    raise GetArtifactMetadataError(self, artifact,
+                                                   metadata_name)
+
+        todo = Queue.Queue()
+        for group in groups:
+            todo.put(group)
+        errors = []
+        threads = []
+        for i in xrange(min(self.max_connections, len(groups))):
+            thread = threading.Thread(target=self._fetch_worker,
+                                      args=(todo, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join() without a timeout would not let ^C through.
+            while thread.is_alive():
+                thread.join(1)
+
+        if errors:
+            artifact, exc_info = errors[0]
+            if not issubclass(exc_info[0], (urllib2.URLError,
+                                            httplib.HTTPException,
+                                            socket.error)):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            log(str(exc_info[1]))
+            raise GetError(self, artifact)
+
+        return [artifact for artifact, files in groups]
+
+    def _fetch_worker(self, todo, errors):
+        try:
+            while not errors:
+                try:
+                    artifact, files = todo.get_nowait()
+                except Queue.Empty:
+                    return
+
+                handles = []
+                try:
+                    for filename, _, opener in files:
+                        handle = opener()
+                        handles.append(handle)
+                        self._copy_file(filename, handle)
+                except BaseException:
+                    for handle in handles:
+                        handle.abort()
+                    errors.append((artifact, sys.exc_info()))
+                    return
+                else:
+                    for handle in handles:
+                        handle.close()
+        finally:
+            self._http.close()
+
+    def _has_files(self, filenames):  # pragma: no cover
+        path = '/1.0/artifacts'
+        logging.debug('RemoteArtifactCache._has_files: path=%s' % path)
+        response = self._http.request(
+            'POST', path, json.dumps(filenames),
+            {'Content-Type': 'application/json'})
+        data = response.read()
+        if response.status != httplib.OK:
+            raise urllib2.HTTPError(
+                urlparse.urljoin(self.server_url, path), response.status,
+                response.reason, response.msg, None)
+        results = json.loads(data)
+        return set(f for f, present in results.iteritems() if present)
+
+    def _copy_file(self, filename, handle):  # pragma: no cover
+        url = self._request_url(filename)
+        parts = urlparse.urlsplit(url)
+        logging.debug('RemoteArtifactCache._copy_file: url=%s' % url)
+        response = self._http.request(
+            'GET', '%s?%s' % (parts.path, parts.query))
+        if response.status != httplib.OK:
+            response.read()
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        shutil.copyfileobj(response, handle)
+
     def _has_file(self, filename):  # pragma: no cover
         url = self._request_url(filename)
         logging.debug('RemoteArtifactCache._has_file: url=%s' % url)
@@ -21,6 +21,41 @@ import urllib2
 import morphlib
 
 
+class FakeHandle(StringIO.StringIO):
+
+    def __init__(self, lac, filename):
+        StringIO.StringIO.__init__(self)
+        self.lac = lac
+        self.filename = filename
+
+    def close(self):
+        self.lac.files[self.filename] = self.getvalue()
+        StringIO.StringIO.close(self)
+
+    def abort(self):
+        self.lac.aborted.add(self.filename)
+        StringIO.StringIO.close(self)
+
+
+class FakeLocalArtifactCache(object):
+
+    def __init__(self):
+        self.files = {}
+        self.aborted = set()
+
+    def has(self, artifact):
+        return artifact.basename() in self.files
+
+    def has_artifact_metadata(self, artifact, name):
+        return artifact.metadata_basename(name) in self.files
+
+    def put(self, artifact):
+        return FakeHandle(self, artifact.basename())
+
+    def put_artifact_metadata(self, artifact, name):
+        return FakeHandle(self, artifact.metadata_basename(name))
+
+
 class RemoteArtifactCacheTests(unittest.TestCase):
 
     def setUp(self):
@@ -69,10 +104,21 @@ class RemoteArtifactCacheTests(unittest.TestCase):
             self.server_url)
         self.cache._has_file = self._has_file
         self.cache._get_file = self._get_file
+        self.cache._has_files = self._has_files
+        self.cache._copy_file = self._copy_file
+        self.lac = FakeLocalArtifactCache()
 
     def _has_file(self, filename):
         return filename in self.existing_files
 
+    def _has_files(self, filenames):
+        return set(filenames) & self.existing_files
+
+    def _copy_file(self, filename, handle):
+        if filename not in self.existing_files:
+            raise urllib2.URLError('foo')
+        handle.write(filename)
+
     def _get_file(self, filename):
         if filename in self.existing_files:
             return StringIO.StringIO('%s' % filename)
@@ -162,3 +208,86 @@ class RemoteArtifactCacheTests(unittest.TestCase):
         returned_url = self.cache._request_url('gtk+')
         correct_url = '%s/1.0/artifacts?filename=gtk%%2B' % self.server_url
         self.assertEqual(returned_url, correct_url)
+
+    def test_has_files_returns_existing_files(self):
+        self.assertEqual(
+            self.cache.has_files([self.runtime_artifact.basename(),
+                                  self.doc_artifact.basename()]),
+            set([self.runtime_artifact.basename()]))
+
+    def test_has_files_falls_back_to_one_query_per_file(self):
+        def fail(filenames):
+            raise urllib2.URLError('no bulk queries here')
+        self.cache._has_files = fail
+        self.assertEqual(
+            self.cache.has_files([self.runtime_artifact.basename(),
+                                  self.doc_artifact.basename()]),
+            set([self.runtime_artifact.basename()]))
+
+    def test_fetch_artifacts_fetches_artifacts_and_metadata(self):
+        fetched = self.cache.fetch_artifacts(
+            self.lac, [(self.runtime_artifact, ['meta']),
+                       (self.devel_artifact, [])])
+        self.assertEqual(set(fetched),
+                         set([self.runtime_artifact, self.devel_artifact]))
+        self.assertEqual(self.lac.files, {
+            self.runtime_artifact.basename():
+                self.runtime_artifact.basename(),
+            self.runtime_artifact.metadata_basename('meta'):
+                self.runtime_artifact.metadata_basename('meta'),
+            self.devel_artifact.basename():
+                self.devel_artifact.basename(),
+        })
+
+    def test_fetch_artifacts_skips_locally_cached_files(self):
+        self.lac.files[self.runtime_artifact.basename()] = 'local'
+        fetched = self.cache.fetch_artifacts(
+            self.lac, [(self.runtime_artifact, ['meta'])])
+        self.assertEqual(fetched, [self.runtime_artifact])
+        self.assertEqual(self.lac.files[self.runtime_artifact.basename()],
+                         'local')
+        self.assertTrue(self.runtime_artifact.metadata_basename('meta')
+                        in self.lac.files)
+
+    def test_fetch_artifacts_does_nothing_if_all_cached(self):
+        self.lac.files[self.devel_artifact.basename()] = 'local'
+        self.assertEqual(
+            self.cache.fetch_artifacts(self.lac, [(self.devel_artifact, [])]),
+            [])
+
+    def test_fetch_artifacts_fails_before_download_if_any_missing(self):
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          self.cache.fetch_artifacts, self.lac,
+                          [(self.runtime_artifact, []),
+                           (self.doc_artifact, [])],
+                          log=lambda *args: None)
+        self.assertEqual(self.lac.files, {})
+
+    def test_fetch_artifacts_fails_if_metadata_missing(self):
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetArtifactMetadataError,
+            self.cache.fetch_artifacts, self.lac,
+            [(self.devel_artifact, ['meta'])],
+            log=lambda *args: None)
+
+    def test_fetch_artifacts_aborts_artifact_if_metadata_download_fails(self):
+        def has_everything(filenames):
+            return set(filenames)
+        self.cache._has_files = has_everything
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          self.cache.fetch_artifacts, self.lac,
+                          [(self.devel_artifact, ['meta'])],
+                          log=lambda *args: None)
+        self.assertEqual(self.lac.files, {})
+        self.assertEqual(self.lac.aborted,
+                         set([self.devel_artifact.basename(),
+                              self.devel_artifact.metadata_basename('meta')]))
+
+    def test_fetch_artifacts_reraises_errors_other_than_network_ones(self):
+        def fail(filename, handle):
+            raise RuntimeError('disk full')
+        self.cache._copy_file = fail
+        self.assertRaises(RuntimeError, self.cache.fetch_artifacts,
+                          self.lac, [(self.devel_artifact, [])])
+        self.assertEqual(self.lac.aborted,
+                         set([self.devel_artifact.basename()]))
@@ -14,13 +14,17 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import cliapp
+import httplib
 import json
 import logging
 import urllib2
 import urlparse
 import urllib
 
+import morphlib
+
 
 class ResolveRefError(cliapp.AppException):
 
@@ -45,11 +49,27 @@ class LsTreeError(cliapp.AppException):
             (ref, repo_name))
 
 
+# What a failed batch request can raise: HTTP and socket errors from the
+# connection (urllib2.HTTPError and socket.error are both IOErrors), and
+# ValueError for a reply that is not JSON.
+_request_errors = (httplib.HTTPException, IOError, ValueError)
+
+
 class RemoteRepoCache(object):
 
+    '''Ask a morph-cache-server about the repos it holds.
+
+    Requests are made over one kept-alive HTTP connection per thread,
+    through the proxy set in the environment, if any.
+    ``resolve_refs``, ``cat_files`` and ``ls_trees`` ask about many refs,
+    files or trees in a single request.
+
+    '''
+
     def __init__(self, server_url, resolver):
         self.server_url = server_url
         self._resolver = resolver
+        self._http = morphlib.httpconnection.HTTPConnections(server_url)
 
     def resolve_ref(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
@@ -59,6 +79,28 @@ class RemoteRepoCache(object):
             logging.error('Caught exception: %s' % str(e))
             raise ResolveRefError(repo_name, ref)
 
+    def resolve_refs(self, pairs):
+        '''Resolve a list of (repo_name, ref) pairs in one request.
+
+        Return a dict mapping each pair that could be resolved to its
+        (commit, tree) pair. If the request fails, nothing is resolved.
+
+        '''
+
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        urls = [(self._resolver.pull_url(repo_name), ref)
+                for repo_name, ref in pairs]
+        try:
+            results = self._resolve_refs_for_repo_urls(urls)
+        except _request_errors, e:
+            logging.error('Caught exception: %s' % str(e))
+            return {}
+        return dict((pair, (result['sha1'], result['tree']))
+                    for pair, result in zip(pairs, results)
+                    if 'error' not in result)
+
     def cat_file(self, repo_name, ref, filename):
         repo_url = self._resolver.pull_url(repo_name)
         try:
@@ -69,6 +111,40 @@ class RemoteRepoCache(object):
                 raise CatFileError(repo_name, ref, filename)
             raise # pragma: no cover
 
+    def cat_files(self, triples):
+        '''Get a list of (repo_name, ref, filename) files in one request.
+
+        Return a dict mapping each file that was found to its contents,
+        a set of the files the server said do not exist, and a set of
+        the files it could not read for some other reason, for example
+        because it does not have the commit. Older servers do not say
+        why, so every file they could not read is in the last set. If
+        the request fails, all three are empty.
+
+        '''
+
+        triples = list(triples)
+        if not triples:
+            return {}, set(), set()
+        urls = [(self._resolver.pull_url(repo_name), ref, filename)
+                for repo_name, ref, filename in triples]
+        try:
+            results = self._cat_files_for_repo_urls(urls)
+        except _request_errors, e:
+            logging.error('Caught exception: %s' % str(e))
+            return {}, set(), set()
+        found = {}
+        missing = set()
+        failed = set()
+        for triple, result in zip(triples, results):
+            if 'error' not in result:
+                found[triple] = base64.b64decode(result['data'])
+            elif result.get('missing'):
+                missing.add(triple)
+            else:
+                failed.add(triple)
+        return found, missing, failed
+
     def ls_tree(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
         try:
@@ -78,29 +154,74 @@ class RemoteRepoCache(object):
             logging.error('Caught exception: %s' % str(e))
             raise LsTreeError(repo_name, ref)
 
+    def ls_trees(self, pairs):
+        '''List the top of the trees of (repo_name, ref) pairs at once.
+
+        Return a dict mapping each pair that could be listed to the list
+        of filenames. If the request fails, nothing is listed.
+
+        '''
+
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        urls = [(self._resolver.pull_url(repo_name), ref)
+                for repo_name, ref in pairs]
+        try:
+            results = self._ls_trees_for_repo_urls(urls)
+        except _request_errors, e:
+            logging.error('Caught exception: %s' % str(e))
+            return {}
+        return dict((pair, result['tree'].keys())
+                    for pair, result in zip(pairs, results)
+                    if 'error' not in result)
+
     def _resolve_ref_for_repo_url(self, repo_url, ref):  # pragma: no cover
         data = self._make_request(
             'sha1s?repo=%s&ref=%s' % self._quote_strings(repo_url, ref))
         info = json.loads(data)
         return info['sha1'], info['tree']
 
+    def _resolve_refs_for_repo_urls(self, pairs):  # pragma: no cover
+        body = [{'repo': repo_url, 'ref': ref} for repo_url, ref in pairs]
+        return json.loads(self._make_request('sha1s', json.dumps(body)))
+
     def _cat_file_for_repo_url(self, repo_url, ref,
                                filename):  # pragma: no cover
         return self._make_request(
             'files?repo=%s&ref=%s&filename=%s'
             % self._quote_strings(repo_url, ref, filename))
 
+    def _cat_files_for_repo_urls(self, triples):  # pragma: no cover
+        body = [{'repo': repo_url, 'ref': ref, 'filename': filename}
+                for repo_url, ref, filename in triples]
+        return json.loads(self._make_request('files', json.dumps(body)))
+
     def _ls_tree_for_repo_url(self, repo_url, ref):  # pragma: no cover
         return self._make_request(
             'trees?repo=%s&ref=%s' % self._quote_strings(repo_url, ref))
 
+    def _ls_trees_for_repo_urls(self, pairs):  # pragma: no cover
+        body = [{'repo': repo_url, 'ref': ref} for repo_url, ref in pairs]
+        return json.loads(self._make_request('trees', json.dumps(body)))
+
     def _quote_strings(self, *args):  # pragma: no cover
         return tuple(urllib.quote(string) for string in args)
 
-    def _make_request(self, path):  # pragma: no cover
+    def _make_request(self, path, body=None):  # pragma: no cover
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
-        url = urlparse.urljoin(server_url, '/1.0/%s' % path)
-        handle = urllib2.urlopen(url)
-        return handle.read()
+        selector = '/1.0/%s' % path
+        url = urlparse.urljoin(server_url, selector)
+        if body is None:
+            method, headers = 'GET', {}
+        else:
+            method, headers = 'POST', {'Content-Type': 'application/json'}
+
+        response = self._http.request(method, selector, body, headers)
+        data = response.read()
+        if response.status != 200:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        return data
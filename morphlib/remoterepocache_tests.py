@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import json
 import unittest
 import urllib2
@@ -136,3 +137,116 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.assertRaises(morphlib.remoterepocache.LsTreeError,
                           self.cache.ls_tree, 'non-existent-repo',
                           'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9')
+
+    def test_resolves_many_refs_at_once(self):
+        def resolve_refs(pairs):
+            self.requests.append(pairs)
+            results = []
+            for repo_url, ref in pairs:
+                try:
+                    sha1 = self.sha1s[repo_url][ref]
+                    results.append({'sha1': sha1, 'tree': 'tree'})
+                except KeyError:
+                    results.append({'error': 'not found'})
+            return results
+
+        self.requests = []
+        self.cache._resolve_refs_for_repo_urls = resolve_refs
+        resolved = self.cache.resolve_refs([('baserock:morph', 'master'),
+                                            ('baserock:morph', 'missing')])
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(resolved, {
+            ('baserock:morph', 'master'):
+                ('e28a23812eadf2fce6583b8819b9c5dbd36b9fb9', 'tree'),
+        })
+
+    def test_resolves_nothing_when_batch_request_fails(self):
+        def resolve_refs(pairs):
+            raise urllib2.HTTPError(url='', code=405, msg='Not allowed',
+                                    hdrs={}, fp=None)
+
+        self.cache._resolve_refs_for_repo_urls = resolve_refs
+        self.assertEqual(
+            self.cache.resolve_refs([('baserock:morph', 'master')]), {})
+
+    def test_batch_requests_for_nothing_do_not_ask_the_server(self):
+        def request(items):
+            self.fail('server was asked')  # pragma: no cover
+
+        self.cache._resolve_refs_for_repo_urls = request
+        self.cache._cat_files_for_repo_urls = request
+        self.cache._ls_trees_for_repo_urls = request
+        self.assertEqual(self.cache.resolve_refs([]), {})
+        self.assertEqual(self.cache.cat_files([]), ({}, set(), set()))
+        self.assertEqual(self.cache.ls_trees([]), {})
+
+    def test_cats_and_lists_nothing_when_batch_request_fails(self):
+        def request(items):
+            raise ValueError('No JSON object could be decoded')
+
+        self.cache._cat_files_for_repo_urls = request
+        self.cache._ls_trees_for_repo_urls = request
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        self.assertEqual(
+            self.cache.cat_files([('upstream:linux', sha1, 'linux.morph')]),
+            ({}, set(), set()))
+        self.assertEqual(self.cache.ls_trees([('upstream:linux', sha1)]), {})
+
+    def test_does_not_hide_programming_errors_in_batch_requests(self):
+        def resolve_refs(pairs):
+            raise TypeError('oops')
+
+        self.cache._resolve_refs_for_repo_urls = resolve_refs
+        self.assertRaises(TypeError, self.cache.resolve_refs,
+                          [('baserock:morph', 'master')])
+
+    def test_cats_many_files_at_once(self):
+        def cat_files(triples):
+            results = []
+            for repo_url, sha1, filename in triples:
+                try:
+                    data = self.files[repo_url][sha1][filename]
+                    results.append({'data': base64.b64encode(data)})
+                except KeyError:
+                    results.append({'error': 'not found',
+                                    'missing': sha1 in self.files[repo_url]})
+            return results
+
+        self.cache._cat_files_for_repo_urls = cat_files
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        found, missing, failed = self.cache.cat_files([
+            ('upstream:linux', sha1, 'linux.morph'),
+            ('upstream:linux', sha1, 'missing.morph'),
+            ('upstream:linux', 'unknown', 'linux.morph')])
+        self.assertEqual(found, {
+            ('upstream:linux', sha1, 'linux.morph'): 'linux morphology'})
+        self.assertEqual(missing,
+                         set([('upstream:linux', sha1, 'missing.morph')]))
+        self.assertEqual(failed,
+                         set([('upstream:linux', 'unknown', 'linux.morph')]))
+
+    def test_does_not_trust_errors_from_older_servers(self):
+        def cat_files(triples):
+            return [{'error': 'not found'} for triple in triples]
+
+        self.cache._cat_files_for_repo_urls = cat_files
+        triple = ('upstream:linux', 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9',
+                  'missing.morph')
+        self.assertEqual(self.cache.cat_files([triple]),
+                         ({}, set(), set([triple])))
+
+    def test_lists_many_trees_at_once(self):
+        def ls_trees(pairs):
+            results = []
+            for repo_url, sha1 in pairs:
+                try:
+                    results.append({'tree': self.files[repo_url][sha1]})
+                except KeyError:
+                    results.append({'error': 'not found'})
+            return results
+
+        self.cache._ls_trees_for_repo_urls = ls_trees
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        listed = self.cache.ls_trees([('upstream:linux', sha1),
+                                      ('upstream:linux', 'missing')])
+        self.assertEqual(listed, {('upstream:linux', sha1): ['linux.morph']})
@@ -0,0 +1,166 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import fcntl
+import json
+import logging
+
+import morphlib
+
+
+class ResolutionCache(object):
+
+    '''Remember what was learnt about commits while resolving sources.
+
+    Everything stored here is looked up by commit or tree SHA1, so it
+    can never go out of date: the tree of a commit, the contents of a
+    file in a commit, and the files at the top of a commit's tree. Files
+    that do not exist in a commit are remembered too, since that is how chunks
+    without a morphology are found. The build system detected for such
+    chunks is stored by tree SHA1, so it is shared by every commit and
+    repository with the same tree, and by the version of the detection
+    rules, so that it is detected again when they change. Named refs are
+    never stored, since they move.
+
+    If ``filename`` is given, the cache is loaded from that file, and
+    ``save`` appends what was added since. The file is started again,
+    keeping only what was used or added by this run, once it has more
+    than ``max_entries`` entries.
+
+    '''
+
+    def __init__(self, filename=None, max_entries=50000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self._entries = {}
+        self._added = []
+        self._used = set()
+        self._stored = 0
+        if filename is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        if not isinstance(entry, list) or len(entry) < 2:
+                            raise ValueError('not a key and a value')
+                        key, value = tuple(entry[:-1]), entry[-1]
+                        hash(key)
+                    except (ValueError, TypeError):
+                        logging.warning('Ignoring damaged line in %s'
+                                        % self.filename)
+                        continue
+                    self._entries[key] = value
+                    self._stored += 1
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _get(self, *key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._used.add(key)
+        return value
+
+    def _put(self, value, *key):
+        if morphlib.git.is_valid_sha1(key[2]):
+            self._add(value, *key)
+
+    def _add(self, value, *key):
+        if key not in self._entries:
+            self._entries[key] = value
+            self._added.append(key)
+
+    def get_tree(self, reponame, commit):
+        '''Return the tree SHA1 of a commit, or None.'''
+        tree = self._get('tree', reponame, commit)
+        return tree and str(tree)
+
+    def put_tree(self, reponame, commit, tree):
+        self._put(tree, 'tree', reponame, commit)
+
+    def get_file(self, reponame, commit, filename):
+        '''Return the contents of a file in a commit.
+
+        Return False if the file is known not to exist, or None if
+        nothing is known about it.
+
+        '''
+
+        contents = self._get('file', reponame, commit, filename)
+        return contents and contents.encode('utf-8')
+
+    def put_file(self, reponame, commit, filename, contents):
+        try:
+            contents.decode('utf-8')
+        except UnicodeDecodeError:
+            # Only text can be stored.
+            return
+        self._put(contents, 'file', reponame, commit, filename)
+
+    def put_missing_file(self, reponame, commit, filename):
+        self._put(False, 'file', reponame, commit, filename)
+
+    def get_file_list(self, reponame, commit):
+        '''Return the files at the top of a commit's tree, or None.'''
+        filenames = self._get('files', reponame, commit)
+        return filenames and [name.encode('utf-8') for name in filenames]
+
+    def put_file_list(self, reponame, commit, filenames):
+        self._put(list(filenames), 'files', reponame, commit)
+
+    def get_build_system(self, tree):
+        '''Return the name of the build system detected in a tree.
+
+        Return False if no build system was detected in the tree, or
+        None if nothing is known about it.
+
+        '''
+
+        name = self._get('build-system',
+                         morphlib.buildsystem.detection_version, tree)
+        return name and str(name)
+
+    def put_build_system(self, tree, name):
+        if morphlib.git.is_valid_sha1(tree):
+            self._add(name or False, 'build-system',
+                      morphlib.buildsystem.detection_version, tree)
+
+    def save(self):
+        '''Write what was added since the last save to the file.'''
+
+        if self.filename is None or not self._added:
+            return
+        if self._stored + len(self._added) > self.max_entries:
+            added = set(self._added)
+            keys = [key for key in self._used if key not in added]
+            keys += self._added
+            f = morphlib.savefile.SaveFile(self.filename, 'w')
+            self._stored = 0
+        else:
+            keys = self._added
+            f = open(self.filename, 'a')
+            # Other morph processes may be appending to the file too.
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        with f:
+            f.write(''.join(json.dumps(list(key) + [self._entries[key]]) +
+                            '\n' for key in keys))
+        self._stored += len(keys)
+        self._added = []
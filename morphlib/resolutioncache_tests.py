@@ -0,0 +1,124 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+COMMIT = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+TREE = '8b4a2a8ad1aa2d4cba4a8d6e20ac5cbe4f6e0f4d'
+
+
+class ResolutionCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'resolution-cache')
+        self.cache = morphlib.resolutioncache.ResolutionCache(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def reload(self, **kwargs):
+        self.cache.save()
+        self.cache = morphlib.resolutioncache.ResolutionCache(
+            self.filename, **kwargs)
+
+    def test_knows_nothing_at_first(self):
+        self.assertEqual(self.cache.get_tree('repo', COMMIT), None)
+        self.assertEqual(self.cache.get_file('repo', COMMIT, 'a.morph'),
+                         None)
+        self.assertEqual(self.cache.get_file_list('repo', COMMIT), None)
+        self.assertEqual(self.cache.get_build_system(TREE), None)
+
+    def test_keeps_everything_between_runs(self):
+        self.cache.put_tree('repo', COMMIT, TREE)
+        self.cache.put_file('repo', COMMIT, 'a.morph', 'name: a\n')
+        self.cache.put_missing_file('repo', COMMIT, 'b.morph')
+        self.cache.put_file_list('repo', COMMIT, ['configure.ac'])
+        self.reload()
+        self.assertEqual(self.cache.get_tree('repo', COMMIT), TREE)
+        self.assertEqual(self.cache.get_file('repo', COMMIT, 'a.morph'),
+                         'name: a\n')
+        self.assertEqual(self.cache.get_file('repo', COMMIT, 'b.morph'),
+                         False)
+        self.assertEqual(self.cache.get_file_list('repo', COMMIT),
+                         ['configure.ac'])
+
+    def test_keeps_build_systems_by_tree(self):
+        other = 'f' * 40
+        self.cache.put_build_system(TREE, 'autotools')
+        self.cache.put_build_system(other, None)
+        self.reload()
+        self.assertEqual(self.cache.get_build_system(TREE), 'autotools')
+        self.assertEqual(self.cache.get_build_system(other), False)
+
+    def test_detects_build_systems_again_when_detection_changes(self):
+        self.cache.put_build_system(TREE, 'autotools')
+        self.reload()
+        version = morphlib.buildsystem.detection_version
+        morphlib.buildsystem.detection_version = version + 1
+        try:
+            self.assertEqual(self.cache.get_build_system(TREE), None)
+        finally:
+            morphlib.buildsystem.detection_version = version
+
+    def test_does_not_keep_named_refs(self):
+        self.cache.put_tree('repo', 'master', TREE)
+        self.assertEqual(self.cache.get_tree('repo', 'master'), None)
+
+    def test_does_not_keep_binary_files(self):
+        self.cache.put_file('repo', COMMIT, 'a.morph', '\xff\xfe')
+        self.assertEqual(self.cache.get_file('repo', COMMIT, 'a.morph'),
+                         None)
+
+    def test_ignores_damaged_lines(self):
+        self.cache.put_tree('repo', COMMIT, TREE)
+        self.cache.save()
+        with open(self.filename, 'a') as f:
+            f.write('["tree", "repo"')
+        self.reload()
+        self.assertEqual(self.cache.get_tree('repo', COMMIT), TREE)
+
+    def test_ignores_lines_that_are_not_entries(self):
+        self.cache.put_tree('repo', COMMIT, TREE)
+        self.cache.save()
+        with open(self.filename, 'a') as f:
+            f.write('123\n{}\n[]\n["tree"]\n"tree"\n[["tree"], 1]\n')
+        self.reload()
+        self.assertEqual(self.cache.get_tree('repo', COMMIT), TREE)
+
+    def test_unreadable_file_is_an_error(self):
+        os.mkdir(self.filename)
+        self.assertRaises(IOError, morphlib.resolutioncache.ResolutionCache,
+                          self.filename)
+
+    def test_starts_again_with_used_entries_when_full(self):
+        other = 'f' * 40
+        self.cache.put_tree('repo', COMMIT, TREE)
+        self.cache.put_tree('repo', other, TREE)
+        self.reload(max_entries=2)
+        self.cache.get_tree('repo', COMMIT)
+        self.cache.put_file('repo', COMMIT, 'a.morph', 'name: a\n')
+        self.reload()
+        self.assertEqual(self.cache.get_tree('repo', COMMIT), TREE)
+        self.assertEqual(self.cache.get_tree('repo', other), None)
+        self.assertEqual(self.cache.get_file('repo', COMMIT, 'a.morph'),
+                         'name: a\n')
@@ -18,6 +18,8 @@ import cliapp
 
 import collections
 import logging
+import threading
+import time
 
 import morphlib
 
@@ -47,20 +49,32 @@ class SourceResolver(object):
     '''
 
     def __init__(self, local_repo_cache, remote_repo_cache, update_repos,
-                 status_cb=None):
+                 status_cb=None, max_workers=8, resolution_cache=None):
         self.lrc = local_repo_cache
         self.rrc = remote_repo_cache
+        self.cache = resolution_cache
 
         self.update = update_repos
 
-        self.status = status_cb
+        self.status = status_cb or (lambda **kwargs: None)
+
+        self.max_workers = max_workers
+        self._repo_locks = {}
+        self._locks_lock = threading.Lock()
 
     def resolve_ref(self, reponame, ref):
         '''Resolves commit and tree sha1s of the ref in a repo and returns it.
 
         If update is True then this has the side-effect of updating
-        or cloning the repository into the local repo cache.
+        or cloning the repository into the local repo cache. If the ref
+        is a commit SHA1 whose tree is in the resolution cache, neither
+        repo cache is used.
+
         '''
+        cached = self._cached_resolution(reponame, ref)
+        if cached is not None:
+            return cached
+
         absref = None
 
         if self.lrc.has_repo(reponame):
@@ -94,91 +108,186 @@ class SourceResolver(object):
                 repo = self.lrc.get_repo(reponame)
             absref = repo.resolve_ref_to_commit(ref)
             tree = repo.resolve_ref_to_tree(absref)
+        if self.cache is not None:
+            self.cache.put_tree(reponame, absref, tree)
         return absref, tree
 
+    def _cached_resolution(self, reponame, ref):
+        if self.cache is None or not morphlib.git.is_valid_sha1(ref):
+            return None
+        tree = self.cache.get_tree(reponame, ref)
+        return None if tree is None else (ref, tree)
+
+    def _repo_lock(self, reponame):
+        with self._locks_lock:
+            return self._repo_locks.setdefault(reponame, threading.Lock())
+
+    def _resolve_refs(self, repo_ref_pairs):
+        '''Resolve many (repo, ref) pairs concurrently.
+
+        Return a dict mapping each pair to its (commit, tree) pair. Pairs
+        the remote repo cache can answer are resolved in one request. Of
+        the rest, refs in the same repo are resolved one at a time, since
+        resolving them may update the repo in the local repo cache.
+
+        '''
+
+        pairs = list(collections.OrderedDict.fromkeys(repo_ref_pairs))
+
+        # Refs in repos that are not in the local repo cache can all be
+        # resolved by the remote repo cache in one request.
+        resolved = {}
+        for pair in pairs:
+            cached = self._cached_resolution(*pair)
+            if cached is not None:
+                resolved[pair] = cached
+        pairs = [pair for pair in pairs if pair not in resolved]
+
+        remote = []
+        if self.rrc is not None:
+            remote = [pair for pair in pairs
+                      if not self.lrc.has_repo(pair[0])]
+        if remote:
+            from_remote = self.rrc.resolve_refs(remote)
+            self.status(msg='Resolved %(count)d of %(total)d refs via '
+                        'remote repo cache', count=len(from_remote),
+                        total=len(remote), chatty=True)
+            if self.cache is not None:
+                for (reponame, ref), (absref, tree) in from_remote.items():
+                    self.cache.put_tree(reponame, absref, tree)
+            resolved.update(from_remote)
+        pairs = [pair for pair in pairs if pair not in resolved]
+
+        def resolve(pair):
+            with self._repo_lock(pair[0]):
+                return self.resolve_ref(*pair)
+
+        results = morphlib.util.map_concurrently(
+            resolve, pairs, self.max_workers)
+        resolved.update(zip(pairs, results))
+        return resolved
+
+    def _load_morphologies(self, morph_factory, keys, resolved_morphologies):
+        '''Load the morphologies for the keys not in resolved_morphologies.
+
+        Each key is a (repo, commit, filename) tuple.
+
+        '''
+
+        keys = [key for key in collections.OrderedDict.fromkeys(keys)
+                if key not in resolved_morphologies]
+        morph_factory.prefetch(keys)
+        morphologies = morphlib.util.map_concurrently(
+            lambda key: morph_factory.get_morphology(*key),
+            keys, self.max_workers)
+        resolved_morphologies.update(zip(keys, morphologies))
+
+    def _report_phase(self, what, count, started):
+        elapsed = time.time() - started
+        logging.debug('Resolved %d %s in %.3f seconds'
+                      % (count, what, elapsed))
+        self.status(msg='Resolved %(count)d %(what)s in %(elapsed).1f seconds',
+                    count=count, what=what, elapsed=elapsed, chatty=True)
+
     def traverse_morphs(self, definitions_repo, definitions_ref,
                         system_filenames,
                         visit=lambda rn, rf, fn, arf, m: None,
                         definitions_original_ref=None):
         morph_factory = morphlib.morphologyfactory.MorphologyFactory(
-            self.lrc, self.rrc, self.status)
+            self.lrc, self.rrc, self.status, self.cache)
         definitions_queue = collections.deque(system_filenames)
         chunk_in_definitions_repo_queue = []
         chunk_in_source_repo_queue = []
 
-        resolved_commits = {}
-        resolved_trees = {}
         resolved_morphologies = {}
 
         # Resolve the (repo, ref) pair for the definitions repo, cache result.
+        started = time.time()
         definitions_absref, definitions_tree = self.resolve_ref(
             definitions_repo, definitions_ref)
 
         if definitions_original_ref:
             definitions_ref = definitions_original_ref
 
+        # Systems and strata are loaded a level at a time, since which
+        # ones are needed is only known once their parents are loaded.
+        # The level is still visited in queue order.
         while definitions_queue:
-            filename = definitions_queue.popleft()
-
-            key = (definitions_repo, definitions_absref, filename)
-            if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
-            morphology = resolved_morphologies[key]
-
-            visit(definitions_repo, definitions_ref, filename,
-                  definitions_absref, definitions_tree, morphology)
-            if morphology['kind'] == 'cluster':
-                raise cliapp.AppException(
-                    "Cannot build a morphology of type 'cluster'.")
-            elif morphology['kind'] == 'system':
-                definitions_queue.extend(
-                    morphlib.util.sanitise_morphology_path(s['morph'])
-                    for s in morphology['strata'])
-            elif morphology['kind'] == 'stratum':
-                if morphology['build-depends']:
+            level = list(definitions_queue)
+            definitions_queue.clear()
+            self._load_morphologies(
+                morph_factory,
+                [(definitions_repo, definitions_absref, filename)
+                 for filename in level],
+                resolved_morphologies)
+
+            for filename in level:
+                key = (definitions_repo, definitions_absref, filename)
+                morphology = resolved_morphologies[key]
+
+                visit(definitions_repo, definitions_ref, filename,
+                      definitions_absref, definitions_tree, morphology)
+                if morphology['kind'] == 'cluster':
+                    raise cliapp.AppException(
+                        "Cannot build a morphology of type 'cluster'.")
+                elif morphology['kind'] == 'system':
                     definitions_queue.extend(
                         morphlib.util.sanitise_morphology_path(s['morph'])
-                        for s in morphology['build-depends'])
-                for c in morphology['chunks']:
-                    if 'morph' not in c:
-                        path = morphlib.util.sanitise_morphology_path(
-                            c.get('morph', c['name']))
-                        chunk_in_source_repo_queue.append(
-                            (c['repo'], c['ref'], path))
-                        continue
-                    chunk_in_definitions_repo_queue.append(
-                        (c['repo'], c['ref'], c['morph']))
+                        for s in morphology['strata'])
+                elif morphology['kind'] == 'stratum':
+                    if morphology['build-depends']:
+                        definitions_queue.extend(
+                            morphlib.util.sanitise_morphology_path(s['morph'])
+                            for s in morphology['build-depends'])
+                    for c in morphology['chunks']:
+                        if 'morph' not in c:
+                            path = morphlib.util.sanitise_morphology_path(
+                                c.get('morph', c['name']))
+                            chunk_in_source_repo_queue.append(
+                                (c['repo'], c['ref'], path))
+                            continue
+                        chunk_in_definitions_repo_queue.append(
+                            (c['repo'], c['ref'], c['morph']))
+        self._report_phase('system and stratum morphologies',
+                           len(resolved_morphologies), started)
+
+        started = time.time()
+        resolved = self._resolve_refs(
+            (repo, ref) for repo, ref, filename
+            in chunk_in_definitions_repo_queue + chunk_in_source_repo_queue)
+        self._report_phase('chunk refs', len(resolved), started)
+
+        started = time.time()
+        count = len(resolved_morphologies)
+        self._load_morphologies(
+            morph_factory,
+            [(definitions_repo, definitions_absref, filename)
+             for repo, ref, filename in chunk_in_definitions_repo_queue] +
+            [(repo, resolved[repo, ref][0], filename)
+             for repo, ref, filename in chunk_in_source_repo_queue],
+            resolved_morphologies)
+        self._report_phase('chunk morphologies',
+                           len(resolved_morphologies) - count, started)
 
         for repo, ref, filename in chunk_in_definitions_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
-            absref = resolved_commits[repo, ref]
-            tree = resolved_trees[repo, absref]
+            absref, tree = resolved[repo, ref]
             key = (definitions_repo, definitions_absref, filename)
-            if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
-            morphology = resolved_morphologies[key]
-            visit(repo, ref, filename, absref, tree, morphology)
+            visit(repo, ref, filename, absref, tree,
+                  resolved_morphologies[key])
 
         for repo, ref, filename in chunk_in_source_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
-            absref = resolved_commits[repo, ref]
-            tree = resolved_trees[repo, absref]
+            absref, tree = resolved[repo, ref]
             key = (repo, absref, filename)
-            if key not in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
-            morphology = resolved_morphologies[key]
-            visit(repo, ref, filename, absref, tree, morphology)
+            visit(repo, ref, filename, absref, tree,
+                  resolved_morphologies[key])
+
+        if self.cache is not None:
+            self.cache.save()
 
 
 def create_source_pool(lrc, rrc, repo, ref, filename,
                        original_ref=None, update_repos=True,
-                       status_cb=None):
+                       status_cb=None, resolution_cache=None):
     '''Find all the sources involved in building a given system.
 
     Given a system morphology, this function will traverse the tree of stratum
@@ -190,7 +299,8 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
     implementation, and so they must be handled separately.
 
     The 'lrc' and 'rrc' parameters specify the local and remote Git repository
-    caches used for resolving the sources.
+    caches used for resolving the sources. If 'resolution_cache' is given,
+    what is learnt about commits is kept there for next time.
 
     '''
     pool = morphlib.sourcepool.SourcePool()
@@ -202,7 +312,8 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
         for source in sources:
             pool.add(source)
 
-    resolver = SourceResolver(lrc, rrc, update_repos, status_cb)
+    resolver = SourceResolver(lrc, rrc, update_repos, status_cb,
+                              resolution_cache=resolution_cache)
     resolver.traverse_morphs(repo, ref, [filename],
                              visit=add_to_pool,
                              definitions_original_ref=original_ref)
@@ -14,13 +14,12 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import hashlib
 import logging
 import os
 import shutil
-import stat
 import cliapp
 from urlparse import urlparse
-import tempfile
 
 import morphlib
 
@@ -101,83 +100,32 @@ class StagingArea(object):
         assert filename.startswith(dirname)
         return filename[len(dirname) - 1:]  # include leading slash
 
-    def hardlink_all_files(self, srcpath, destpath): # pragma: no cover
-        '''Hardlink every file in the path to the staging-area
-
-        If an exception is raised, the staging-area is indeterminate.
-
-        '''
-
-        file_stat = os.lstat(srcpath)
-        mode = file_stat.st_mode
-
-        if stat.S_ISDIR(mode):
-            # Ensure directory exists in destination, then recurse.
-            if not os.path.lexists(destpath):
-                os.makedirs(destpath)
-            dest_stat = os.stat(os.path.realpath(destpath))
-            if not stat.S_ISDIR(dest_stat.st_mode):
-                raise IOError('Destination not a directory. source has %s'
-                              ' destination has %s' % (srcpath, destpath))
-
-            for entry in os.listdir(srcpath):
-                self.hardlink_all_files(os.path.join(srcpath, entry),
-                                        os.path.join(destpath, entry))
-        elif stat.S_ISLNK(mode):
-            # Copy the symlink.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.symlink(os.readlink(srcpath), destpath)
-
-        elif stat.S_ISREG(mode):
-            # Hardlink the file.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.link(srcpath, destpath)
-
-        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
-            # Block or character device. Put contents of st_dev in a mknod.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.mknod(destpath, file_stat.st_mode, file_stat.st_rdev)
-            os.chmod(destpath, file_stat.st_mode)
-
-        else:
-            # Unsupported type.
-            raise IOError('Cannot extract %s into staging-area. Unsupported'
-                          ' type.' % srcpath)
-
     def install_artifact(self, handle):
         '''Install a build artifact into the staging area.
 
         We access the artifact via an open file handle. For now, we assume
         the artifact is a tarball.
 
+        The artifact is unpacked into the shared store of unpacked chunks
+        in the tempdir, if it is not there already, and hardlinked into
+        the staging area from there.
+
         '''
 
         chunk_cache_dir = os.path.join(self._app.settings['tempdir'], 'chunks')
-        unpacked_artifact = os.path.join(
-            chunk_cache_dir, os.path.basename(handle.name) + '.d')
-        if not os.path.exists(unpacked_artifact):
-            self._app.status(
-                msg='Unpacking chunk from cache %(filename)s',
-                filename=os.path.basename(handle.name))
-            savedir = tempfile.mkdtemp(dir=chunk_cache_dir)
-            try:
-                morphlib.bins.unpack_binary_from_file(
-                    handle, savedir + '/')
-            except BaseException, e: # pragma: no cover
-                shutil.rmtree(savedir)
-                raise
-            # TODO: This rename is not concurrency safe if two builds are
-            #       extracting the same chunk, one build will fail because
-            #       the other renamed its tempdir here first.
-            os.rename(savedir, unpacked_artifact)
-
-        if not os.path.exists(self.dirname):
-            self._mkdir(self.dirname)
-
-        self.hardlink_all_files(unpacked_artifact, self.dirname)
+        store = morphlib.chunkstore.UnpackedChunkStore(
+            chunk_cache_dir, self._app.settings['chunk-cache-max-size'])
+        store.install(handle, self.dirname, status=self._app.status)
+
+    def install_artifacts(self, handles):
+        '''Install several build artifacts into the staging area, in order.
+
+        Later artifacts overwrite files from earlier ones.
+
+        '''
+
+        for handle in handles:
+            self.install_artifact(handle)
 
     def remove(self):
         '''Remove the entire staging area.
@@ -325,3 +273,112 @@ class StagingArea(object):
         os.rename(self.dirname, dest_dir)
         self.dirname = dest_dir
 
+
+
+class OverlayStagingArea(StagingArea):
+
+    '''Staging area that mounts its build dependencies using overlayfs.
+
+    The chunks given to ``install_artifacts`` are merged into a layer in
+    TEMPDIR/layers, which is named after the list of chunks and kept for
+    later builds with the same build dependencies, such as the other
+    chunks of the same stratum. The layer is used as the read-only lower
+    directory of an overlay mounted on the staging area, so once the
+    layer exists, setting up a staging area does not touch any files.
+    Everything the build writes goes to an upper directory next to the
+    staging area.
+
+    If the overlay cannot be mounted, for example because the kernel
+    has no overlayfs, the layer is hardlinked into the staging area
+    instead, which is still one pass over the files rather than one
+    pass per chunk.
+
+    '''
+
+    def __init__(self, *args, **kwargs):
+        StagingArea.__init__(self, *args, **kwargs)
+        self._upperdir = self.dirname + '.upper'
+        self._workdir = self.dirname + '.work'
+        self._layer = None
+        self._mounted = False
+
+    def install_artifact(self, handle):
+        self.install_artifacts([handle])
+
+    def install_artifacts(self, handles):
+        assert self._layer is None, 'Build dependencies already installed'
+        if not handles:
+            return
+
+        tempdir = self._app.settings['tempdir']
+        max_size = self._app.settings['chunk-cache-max-size']
+        chunk_store = morphlib.chunkstore.UnpackedChunkStore(
+            os.path.join(tempdir, 'chunks'), max_size)
+        layer_store = morphlib.chunkstore.UnpackedChunkStore(
+            os.path.join(tempdir, 'layers'), max_size)
+
+        names = [os.path.basename(handle.name) for handle in handles]
+        layer_name = hashlib.sha1('\n'.join(names)).hexdigest()
+
+        def merge_chunks(dirname):
+            self._app.status(msg='Creating staging area layer %(layer)s',
+                             layer=layer_name[:7])
+            for handle in handles:
+                chunk_store.install(handle, dirname, status=self._app.status)
+
+        if not os.path.isdir(layer_store.dirname):
+            os.makedirs(layer_store.dirname)
+        self._layer = layer_store.reference(layer_name, merge_chunks)
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        try:
+            self._mount_overlay()
+        except cliapp.AppException, e:
+            logging.warning('Could not mount overlay on %s, hardlinking '
+                            'layer instead: %s' % (self.dirname, e))
+            morphlib.chunkstore.link_tree(self._layer.dirname, self.dirname,
+                                          self._layer.manifest['entries'])
+            self._layer.release()
+
+        if max_size:
+            layer_store.evict(max_size)
+
+    def _mount_overlay(self):  # pragma: no cover
+        os.mkdir(self._upperdir)
+        os.mkdir(self._workdir)
+        try:
+            self._app.runcmd(
+                ['mount', '-t', 'overlay', 'overlay', '-o',
+                 'lowerdir=%s,upperdir=%s,workdir=%s' %
+                     (self._layer.dirname, self._upperdir, self._workdir),
+                 self.dirname])
+        except BaseException:
+            shutil.rmtree(self._upperdir)
+            shutil.rmtree(self._workdir)
+            raise
+        self._mounted = True
+
+    def _unmount_overlay(self):  # pragma: no cover
+        if self._mounted:
+            self._app.runcmd(['umount', self.dirname])
+            self._mounted = False
+            shutil.rmtree(self._workdir)
+        if self._layer is not None:
+            self._layer.release()
+
+    def remove(self):
+        self._unmount_overlay()
+        if os.path.exists(self._upperdir):  # pragma: no cover
+            shutil.rmtree(self._upperdir)
+        StagingArea.remove(self)
+
+    def abort(self):  # pragma: no cover
+        # Only the upper directory has anything the build wrote, so that
+        # is what is kept for inspection.
+        if self._mounted:
+            self._unmount_overlay()
+            os.rmdir(self.dirname)
+            os.rename(self._upperdir, self.dirname)
+        else:
+            self._unmount_overlay()
+        StagingArea.abort(self)
@@ -46,6 +46,7 @@ class FakeApplication(object):
         self.settings = {
             'cachedir': cachedir,
             'tempdir': tempdir,
+            'chunk-cache-max-size': 0,
         }
         for leaf in ('chunks',):
             d = os.path.join(tempdir, leaf)
@@ -129,6 +130,12 @@ class StagingAreaTests(unittest.TestCase):
             self.sa.install_artifact(f)
         self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
 
+    def test_installs_artifacts(self):
+        chunk_tar = self.create_chunk()
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f])
+        self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
+
     def test_removes_everything(self):
         chunk_tar = self.create_chunk()
         with open(chunk_tar, 'rb') as f:
@@ -141,3 +148,92 @@ class StagingAreaTests(unittest.TestCase):
             object(), self.staging, self.build_env, use_chroot=False)
         filename = os.path.join(self.staging, 'foobar')
         self.assertEqual(sa.relative(filename), filename)
+
+
+class OverlayStagingAreaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.app = FakeApplication(os.path.join(self.tempdir, 'cachedir'),
+                                   self.tempdir)
+        self.chunk_tar = os.path.join(self.tempdir, 'foo.chunk.foo')
+        chunkdir = os.path.join(self.tempdir, 'chunk')
+        os.mkdir(chunkdir)
+        with open(os.path.join(chunkdir, 'file.txt'), 'w'):
+            pass
+        tf = tarfile.TarFile(name=self.chunk_tar, mode='w')
+        tf.add(chunkdir, arcname='.')
+        tf.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_staging_area(self, name):
+        sa = morphlib.stagingarea.OverlayStagingArea(
+            self.app, os.path.join(self.tempdir, name),
+            FakeBuildEnvironment())
+        def no_overlay():
+            raise cliapp.AppException('no overlayfs here')
+        sa._mount_overlay = no_overlay
+        return sa
+
+    def install(self, sa):
+        with open(self.chunk_tar, 'rb') as f:
+            sa.install_artifacts([f])
+
+    def test_falls_back_to_hardlinking_layer(self):
+        sa = self.new_staging_area('staging')
+        self.install(sa)
+        self.assertTrue(os.path.exists(os.path.join(sa.dirname, 'file.txt')))
+
+    def test_installs_single_artifact_as_layer(self):
+        sa = self.new_staging_area('staging')
+        with open(self.chunk_tar, 'rb') as f:
+            sa.install_artifact(f)
+        self.assertTrue(os.path.exists(os.path.join(sa.dirname, 'file.txt')))
+        self.assertTrue(os.path.isdir(os.path.join(self.tempdir, 'layers')))
+
+    def test_installs_nothing_without_artifacts(self):
+        sa = self.new_staging_area('staging')
+        sa.install_artifacts([])
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'layers')))
+
+    def test_evicts_layers_over_max_size(self):
+        chunkdir = os.path.join(self.tempdir, 'big')
+        os.mkdir(chunkdir)
+        with open(os.path.join(chunkdir, 'big.txt'), 'w') as f:
+            f.write('x' * 10)
+        big_tar = os.path.join(self.tempdir, 'big.chunk.big')
+        tf = tarfile.TarFile(name=big_tar, mode='w')
+        tf.add(chunkdir, arcname='.')
+        tf.close()
+        self.app.settings['chunk-cache-max-size'] = 5
+
+        sa = self.new_staging_area('staging')
+        with open(big_tar, 'rb') as f:
+            sa.install_artifacts([f])
+        self.assertTrue(os.path.exists(os.path.join(sa.dirname, 'big.txt')))
+        self.assertEqual(
+            [name for name in os.listdir(os.path.join(self.tempdir, 'layers'))
+             if name.endswith('.d')], [])
+
+    def test_shares_layer_between_staging_areas(self):
+        first = self.new_staging_area('first')
+        second = self.new_staging_area('second')
+        self.install(first)
+        self.install(second)
+        layers = [name for name in
+                  os.listdir(os.path.join(self.tempdir, 'layers'))
+                  if name.endswith('.d')]
+        self.assertEqual(len(layers), 1)
+        layer_file = os.path.join(self.tempdir, 'layers', layers[0],
+                                  'file.txt')
+        self.assertEqual(
+            os.stat(layer_file).st_ino,
+            os.stat(os.path.join(second.dirname, 'file.txt')).st_ino)
+
+    def test_removes_everything(self):
+        sa = self.new_staging_area('staging')
+        self.install(sa)
+        sa.remove()
+        self.assertFalse(os.path.exists(sa.dirname))
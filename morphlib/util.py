@@ -13,14 +13,18 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import atexit
 import contextlib
 import itertools
+import logging
 import os
 import pipes
 import re
+import sqlite3
 import subprocess
 import textwrap
 import sys
+import threading
 
 import fs.osfs
 
@@ -121,20 +125,43 @@ def get_git_resolve_cache_server(settings): # pragma: no cover
     return None
 
 
-def new_artifact_caches(settings):  # pragma: no cover
-    '''Create new objects for local and remote artifact caches.
+def new_local_artifact_cache(cachedir):  # pragma: no cover
+    '''Create a LocalArtifactCache in a cache directory.
 
-    This includes creating the directories on disk, if missing.
+    The artifacts are kept in its ``artifacts`` directory, which is
+    created if missing, and indexed in ``artifacts.index`` unless that
+    cannot be used. Uses of artifacts are written to the index when the
+    process exits, if not before.
 
     '''
 
-    cachedir = create_cachedir(settings)
     artifact_cachedir = os.path.join(cachedir, 'artifacts')
     if not os.path.exists(artifact_cachedir):
         os.mkdir(artifact_cachedir)
 
+    index_filename = os.path.join(cachedir, 'artifacts.index')
+    try:
+        index = morphlib.artifactcacheindex.ArtifactCacheIndex(
+            index_filename, artifact_cachedir)
+    except sqlite3.Error as e:
+        logging.warning('Not using artifact cache index %s: %s' %
+                        (index_filename, e))
+        index = None
     lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(artifact_cachedir))
+        fs.osfs.OSFS(artifact_cachedir), index)
+    atexit.register(lac.flush)
+    return lac
+
+
+def new_artifact_caches(settings):  # pragma: no cover
+    '''Create new objects for local and remote artifact caches.
+
+    This includes creating the directories on disk, if missing.
+
+    '''
+
+    cachedir = create_cachedir(settings)
+    lac = new_local_artifact_cache(cachedir)
 
     rac_url = get_artifact_cache_server(settings)
     rac = None
@@ -143,6 +170,22 @@ def new_artifact_caches(settings):  # pragma: no cover
     return lac, rac
 
 
+def new_cache_key_store(settings):  # pragma: no cover
+    '''Create a CacheKeyStore that keeps its keys in the cache directory.'''
+
+    cachedir = create_cachedir(settings)
+    return morphlib.cachekeycomputer.CacheKeyStore(
+        os.path.join(cachedir, 'cache-keys'))
+
+
+def new_resolution_cache(settings):  # pragma: no cover
+    '''Create a ResolutionCache that is kept in the cache directory.'''
+
+    cachedir = create_cachedir(settings)
+    return morphlib.resolutioncache.ResolutionCache(
+        os.path.join(cachedir, 'resolution-cache'))
+
+
 def combine_aliases(app):  # pragma: no cover
     '''Create a full repo-alias set from the app's settings.
 
@@ -510,6 +553,52 @@ def iter_trickle(iterable, limit):
         yield buf
 
 
+def map_concurrently(func, iterable, max_workers):
+    '''Return [func(x) for x in iterable], using up to max_workers threads.
+
+    The results are in the same order as the items. If any of the calls
+    raise an exception, the one raised for the earliest item is raised
+    again once all the calls have finished.
+
+    '''
+
+    items = list(iterable)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    todo = iter(enumerate(items))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    i, item = next(todo)
+                except StopIteration:
+                    return
+            try:
+                results[i] = func(item)
+            except BaseException:
+                errors[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker)
+               for i in xrange(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join() without a timeout would not let ^C through.
+        while thread.is_alive():
+            thread.join(1)
+
+    for exc_info in errors:
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return results
+
+
 def get_data_path(relative_path): # pragma: no cover
     '''Return path to a data file in the morphlib Python package.
 
@@ -17,6 +17,7 @@
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 
 import morphlib
@@ -136,3 +137,41 @@ class IterTrickleTests(unittest.TestCase):
     def test_truncated_final_sequence(self):
         self.assertEqual(list(morphlib.util.iter_trickle("barquux", 3)),
                          [["b", "a", "r"], ["q", "u", "u"], ["x"]])
+
+
+class MapConcurrentlyTests(unittest.TestCase):
+
+    def test_returns_results_in_order(self):
+        self.assertEqual(
+            morphlib.util.map_concurrently(lambda x: x * 2, range(20), 4),
+            [x * 2 for x in range(20)])
+
+    def test_runs_calls_concurrently(self):
+        both_started = threading.Event()
+        started = []
+
+        def func(x):
+            started.append(x)
+            if len(started) == 2:
+                both_started.set()
+            both_started.wait(5)
+            return both_started.is_set()
+
+        self.assertEqual(morphlib.util.map_concurrently(func, [1, 2], 2),
+                         [True, True])
+
+    def test_raises_error_for_earliest_item(self):
+        def func(x):
+            if x > 0:
+                raise ValueError(x)
+            return x
+
+        with self.assertRaises(ValueError) as cm:
+            morphlib.util.map_concurrently(func, range(10), 4)
+        self.assertEqual(cm.exception.args, (1,))
+
+    def test_calls_func_in_this_thread_with_one_worker(self):
+        self.assertEqual(
+            morphlib.util.map_concurrently(
+                lambda x: threading.current_thread(), range(3), 1),
+            [threading.current_thread()] * 3)